@@ -0,0 +1,253 @@
+"""
+Реестр типов активностей.
+
+Тип описывается одной строкой ACTIVITY_TYPES: схемы записи и ответа, таблица, колонка
+времени, колонка конца у сессий и вклад в дневные агрегаты. По реестру работают создание
+(POST /activities/<тип>/ и пакетная запись), лента, экспорт, импорт, сессии и агрегаты.
+"""
+from datetime import datetime
+from typing import Callable, NamedTuple, Optional
+
+from pydantic import BaseModel, ConfigDict
+
+from models import SleepActivity, FeedingActivity, WalkActivity, DiaperActivity, \
+    TemperatureActivity, MedicationActivity, MoodActivity
+
+
+# Схемы записи: время разбирает и проверяет pydantic (ISO 8601, в том числе с 'Z')
+class SleepCreate(BaseModel):
+    child_id: int
+    start_time: datetime
+    end_time: Optional[datetime] = None
+    duration_minutes: Optional[int] = None
+    quality: Optional[str] = None
+    location: Optional[str] = None
+    notes: Optional[str] = None
+
+
+class FeedingCreate(BaseModel):
+    child_id: int
+    time: datetime
+    type: str
+    duration_minutes: Optional[int] = None
+    amount_ml: Optional[int] = None
+    food_name: Optional[str] = None
+    side: Optional[str] = None
+    notes: Optional[str] = None
+
+
+class WalkCreate(BaseModel):
+    child_id: int
+    start_time: datetime
+    end_time: Optional[datetime] = None
+    duration_minutes: Optional[int] = None
+    weather: Optional[str] = None
+    location: Optional[str] = None
+    notes: Optional[str] = None
+
+
+class DiaperCreate(BaseModel):
+    child_id: int
+    time: datetime
+    type: str  # pee, poop, both
+    consistency: Optional[str] = None
+    color: Optional[str] = None
+    notes: Optional[str] = None
+
+
+class TemperatureCreate(BaseModel):
+    child_id: int
+    time: datetime
+    temperature: float
+    measurement_type: Optional[str] = None
+    notes: Optional[str] = None
+
+
+class MedicationCreate(BaseModel):
+    child_id: int
+    time: datetime
+    medication_name: str
+    dosage: Optional[str] = None
+    notes: Optional[str] = None
+
+
+class MoodCreate(BaseModel):
+    child_id: int
+    time: datetime
+    mood: str
+    intensity: Optional[int] = None
+    notes: Optional[str] = None
+
+
+# Схемы ответов
+class ActivityRead(BaseModel):
+    model_config = ConfigDict(from_attributes=True)
+
+    id: int
+    child_id: int
+    conversation_id: Optional[int] = None
+    notes: Optional[str] = None
+    created_at: Optional[datetime] = None
+
+
+class SleepRead(ActivityRead):
+    start_time: datetime
+    end_time: Optional[datetime] = None
+    duration_minutes: Optional[int] = None
+    quality: Optional[str] = None
+    location: Optional[str] = None
+
+
+class FeedingRead(ActivityRead):
+    time: datetime
+    type: str
+    duration_minutes: Optional[int] = None
+    amount_ml: Optional[int] = None
+    food_name: Optional[str] = None
+    side: Optional[str] = None
+
+
+class WalkRead(ActivityRead):
+    start_time: datetime
+    end_time: Optional[datetime] = None
+    duration_minutes: Optional[int] = None
+    weather: Optional[str] = None
+    location: Optional[str] = None
+
+
+class DiaperRead(ActivityRead):
+    time: datetime
+    type: str
+    consistency: Optional[str] = None
+    color: Optional[str] = None
+
+
+class TemperatureRead(ActivityRead):
+    time: datetime
+    temperature: float
+    measurement_type: Optional[str] = None
+
+
+class MedicationRead(ActivityRead):
+    time: datetime
+    medication_name: str
+    dosage: Optional[str] = None
+
+
+class MoodRead(ActivityRead):
+    time: datetime
+    mood: str
+    intensity: Optional[int] = None
+
+
+# Вклады в дневные агрегаты (см. rollups.py): строка таблицы -> приращения колонок или None
+def _session_rollup(prefix: str):
+    def deltas(row: dict) -> Optional[dict]:
+        # Как и в статистике, учитывается только завершенная сессия
+        if row.get("duration_minutes") is None:
+            return None
+        return {f"{prefix}_count": 1, f"{prefix}_minutes": row["duration_minutes"]}
+    return deltas
+
+
+def _feeding_rollup(row: dict) -> dict:
+    amount = row.get("amount_ml")
+    return {
+        "feeding_count": 1,
+        "feeding_ml": amount or 0,
+        "feeding_ml_count": 1 if amount is not None else 0,
+        "feeding_by_type": {row["type"]: 1},
+    }
+
+
+def _diaper_rollup(row: dict) -> dict:
+    return {"diaper_count": 1, "diaper_by_type": {row["type"]: 1}}
+
+
+def _temperature_rollup(row: dict) -> dict:
+    temperature = row["temperature"]
+    return {
+        "temperature_count": 1,
+        "temperature_sum": temperature,
+        "temperature_min": temperature,
+        "temperature_max": temperature,
+    }
+
+
+class ActivityType(NamedTuple):
+    name: str  # дискриминатор типа в ленте активностей
+    model: type
+    time_column: str  # колонка, по которой активность ложится на ось времени
+    collection: str  # ключ в ответах /activities/child/{id} и /today
+    create_schema: type
+    read_schema: type
+    end_column: Optional[str] = None  # у сессий: конец, длительность считается от time_column
+    rollup: Optional[Callable[[dict], Optional[dict]]] = None  # вклад в агрегаты дня; None - не агрегируется
+
+
+ACTIVITY_TYPES = {
+    activity.name: activity for activity in (
+        ActivityType("sleep", SleepActivity, "start_time", "sleep", SleepCreate, SleepRead,
+                     end_column="end_time", rollup=_session_rollup("sleep")),
+        ActivityType("feeding", FeedingActivity, "time", "feeding", FeedingCreate, FeedingRead,
+                     rollup=_feeding_rollup),
+        ActivityType("walk", WalkActivity, "start_time", "walks", WalkCreate, WalkRead,
+                     end_column="end_time", rollup=_session_rollup("walk")),
+        ActivityType("diaper", DiaperActivity, "time", "diapers", DiaperCreate, DiaperRead,
+                     rollup=_diaper_rollup),
+        ActivityType("temperature", TemperatureActivity, "time", "temperatures", TemperatureCreate, TemperatureRead,
+                     rollup=_temperature_rollup),
+        ActivityType("medication", MedicationActivity, "time", "medications", MedicationCreate, MedicationRead),
+        ActivityType("mood", MoodActivity, "time", "moods", MoodCreate, MoodRead),
+    )
+}
+
+
+def duration_minutes(start: datetime, end: datetime) -> int:
+    """Длительность сессии в целых минутах"""
+    return int((end - start).total_seconds() / 60)
+
+
+def prepare_row(activity: ActivityType, payload) -> dict:
+    """
+    Валидирует запись (dict или уже разобранную схему) по схеме типа и приводит ее к строке таблицы.
+    У сессий с концом длительность считается по началу и концу; ValueError - конец раньше начала
+    или у одного из времен нет часового пояса.
+    """
+    row = activity.create_schema.model_validate(payload).model_dump()
+    if activity.end_column is not None and row.get(activity.end_column) is not None:
+        start, end = row[activity.time_column], row[activity.end_column]
+        if (start.tzinfo is None) != (end.tzinfo is None):
+            raise ValueError(f"{activity.time_column} and {activity.end_column} must both have a timezone or neither")
+        if end < start:
+            raise ValueError(f"{activity.end_column} is earlier than {activity.time_column}")
+        row["duration_minutes"] = duration_minutes(start, end)
+    return row
+
+
+def resolve_types(types: str = None):
+    """Разбирает список типов вида "sleep,feeding"; пустой список - все типы"""
+    if not types:
+        return list(ACTIVITY_TYPES.values())
+
+    names = [name.strip() for name in types.split(",") if name.strip()]
+    unknown = [name for name in names if name not in ACTIVITY_TYPES]
+    if unknown:
+        raise ValueError(f"Unknown activity types: {', '.join(unknown)}")
+    return [ACTIVITY_TYPES[name] for name in names]
+
+
+def resolve_fields(fields: str = None, types=None):
+    """
+    Разбирает список колонок вида "time,type"; пустой список - все колонки.
+    Колонка должна быть хотя бы в одной из таблиц types.
+    """
+    if not fields:
+        return None
+
+    names = list(dict.fromkeys(name.strip() for name in fields.split(",") if name.strip()))
+    known = {column for activity in types or ACTIVITY_TYPES.values() for column in activity.model.__table__.c.keys()}
+    unknown = [name for name in names if name not in known]
+    if unknown:
+        raise ValueError(f"Unknown fields: {', '.join(unknown)}")
+    return names
@@ -0,0 +1,148 @@
+"""
+Кэш ответов аналитики (/analytics/child/{id}/stats и /daily) в памяти процесса.
+
+LRU с TTL. Ключ - (эндпоинт, ребенок, дни, часовой пояс, сегодняшняя дата), значение
+хранится вместе с версией данных ребенка, на которой посчитано. Версия читается на каждый
+запрос ради ETag, и ответ из кэша отдается, только если она совпадает: после коммита
+записи ребенка его старые ответы не отдаются ни одним процессом.
+
+Рассылка инвалидаций (ANALYTICS_CACHE_BACKEND) удаляет такие записи сразу, не дожидаясь
+вытеснения, чтобы они не занимали место:
+  local    - только в своем процессе;
+  postgres - NOTIFY в транзакции записи; Postgres доставляет его всем процессам после коммита.
+"""
+import time
+from collections import OrderedDict
+from typing import Awaitable, Callable, Iterable
+
+import asyncpg
+from sqlalchemy import text
+
+from config import ANALYTICS_CACHE_BACKEND, ANALYTICS_CACHE_SIZE, ANALYTICS_CACHE_TTL, DATABASE_URL
+
+_MISSING = object()
+
+
+class AnalyticsCache:
+    """LRU с TTL; записи проверяются по версии данных ребенка"""
+
+    def __init__(self, max_entries: int, ttl_seconds: float):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        # (эндпоинт, child_id, ...) -> (версия, срок, ответ); порядок - от давно использованных
+        self._entries = OrderedDict()
+        self._keys_by_child = {}
+        self.counters = dict.fromkeys(("hits", "misses", "evictions", "expired", "invalidations"), 0)
+
+    def _drop(self, key):
+        self._entries.pop(key, None)
+        keys = self._keys_by_child.get(key[1])
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self._keys_by_child[key[1]]
+
+    def get(self, key, version: int):
+        entry = self._entries.get(key)
+        if entry is not None:
+            entry_version, expires_at, value = entry
+            if expires_at <= time.monotonic():
+                self._drop(key)
+                self.counters["expired"] += 1
+            elif entry_version != version:
+                self._drop(key)
+                self.counters["invalidations"] += 1
+            else:
+                self._entries.move_to_end(key)
+                self.counters["hits"] += 1
+                return value
+        self.counters["misses"] += 1
+        return _MISSING
+
+    def put(self, key, version: int, value):
+        if self.max_entries <= 0:
+            return
+        self._entries[key] = (version, time.monotonic() + self.ttl_seconds, value)
+        self._entries.move_to_end(key)
+        self._keys_by_child.setdefault(key[1], set()).add(key)
+        while len(self._entries) > self.max_entries:
+            self._drop(next(iter(self._entries)))
+            self.counters["evictions"] += 1
+
+    def invalidate(self, child_ids: Iterable[int]):
+        for child_id in child_ids:
+            for key in self._keys_by_child.pop(child_id, ()):
+                self._entries.pop(key, None)
+                self.counters["invalidations"] += 1
+
+    async def get_or_compute(self, endpoint: str, child_id: int, params: tuple, version: int,
+                             compute: Callable[[], Awaitable]):
+        """Ответ из кэша для версии version или посчитанный compute() и сохраненный"""
+        key = (endpoint, child_id) + params
+        value = self.get(key, version)
+        if value is _MISSING:
+            value = await compute()
+            self.put(key, version, value)
+        return value
+
+    def stats(self) -> dict:
+        return {
+            **self.counters,
+            "entries": len(self._entries),
+            "max_entries": self.max_entries,
+            "ttl_seconds": self.ttl_seconds,
+            "backend": invalidation.name,
+        }
+
+
+class LocalInvalidation:
+    """Инвалидация только в своем процессе"""
+    name = "local"
+    statements_per_write = 0  # запросов к БД в publish
+
+    async def start(self):
+        pass
+
+    async def stop(self):
+        pass
+
+    async def publish(self, db, child_ids: Iterable[int]):
+        cache.invalidate(child_ids)
+
+
+class PostgresInvalidation:
+    """Инвалидация через LISTEN/NOTIFY: слушатель держит отдельное соединение asyncpg"""
+    name = "postgres"
+    statements_per_write = 1
+    CHANNEL = "analytics_cache"
+
+    def __init__(self):
+        self._connection = None
+
+    async def start(self):
+        self._connection = await asyncpg.connect(DATABASE_URL)
+        await self._connection.add_listener(self.CHANNEL, self._on_notify)
+
+    async def stop(self):
+        if self._connection is not None:
+            await self._connection.close()
+            self._connection = None
+
+    def _on_notify(self, connection, pid, channel, payload):
+        cache.invalidate(int(child_id) for child_id in payload.split(","))
+
+    async def publish(self, db, child_ids: Iterable[int]):
+        await db.execute(text("SELECT pg_notify(:channel, :payload)"), {
+            "channel": self.CHANNEL, "payload": ",".join(str(child_id) for child_id in child_ids)
+        })
+
+
+BACKENDS = {backend.name: backend for backend in (LocalInvalidation, PostgresInvalidation)}
+
+cache = AnalyticsCache(ANALYTICS_CACHE_SIZE, ANALYTICS_CACHE_TTL)
+invalidation = BACKENDS[ANALYTICS_CACHE_BACKEND]()
+
+
+async def publish_invalidation(db, child_ids: Iterable[int]):
+    """Сообщает процессам, что данные детей изменились; вызывается в транзакции записи"""
+    await invalidation.publish(db, child_ids)
@@ -1,78 +1,88 @@
-from fastapi import FastAPI, Depends, HTTPException
-from sqlalchemy.orm import Session
-from datetime import datetime
-from typing import Optional, List, Union
-from pydantic import BaseModel
+from fastapi import FastAPI, BackgroundTasks, Depends, HTTPException, Query, Request, Response
+from fastapi.responses import FileResponse, StreamingResponse, ORJSONResponse
+from sqlalchemy.ext.asyncio import AsyncSession
+from datetime import datetime, date, timedelta
+import orjson
+from contextlib import asynccontextmanager
+from typing import Optional, List, Union, Dict, Any
+from pydantic import BaseModel, ConfigDict, ValidationError
+from sqlalchemy import select, insert
+from sqlalchemy.exc import IntegrityError
 import pytz
-from models import get_db, User, Child, SleepActivity, FeedingActivity, WalkActivity, DiaperActivity, \
-    TemperatureActivity, MedicationActivity, MoodActivity, Conversation
+from models import get_db, read_session_scope, REPLICAS, ImportJob, User, Child, SleepActivity, Conversation, \
+    FOREIGN_KEY_VIOLATION, UNIQUE_VIOLATION, integrity_violation
+from activity_types import ACTIVITY_TYPES, ActivityType, SleepRead, WalkRead, duration_minutes, prepare_row, resolve_types, resolve_fields
+from timeline import TimelineCursor, fetch_timeline, stream_timeline, timeline_entry, group_timeline
+from rollups import activity_contribution, apply_rollups, daily_series, window_totals, children_daily_series, \
+    children_window_totals, rebuild_statements
+from versions import bump_versions, version_state, children_state, build_etag, etag_matches
+from timezones import child_timezones, day_bounds, get_zone, is_valid as is_valid_timezone, local_now, local_today, \
+    today_bounds, zone_name
+from config import READ_YOUR_WRITES_SECONDS, SQL_TRACE
+from sessions import SESSION_KINDS, start_session, stop_session, open_sessions
+from distributions import distributions
+from predictions import load_state, observe_activities, predict
+from idempotency import IdempotentReplay, IdempotencyConflict, claim_key, remember_response, request_hash
+from imports import ImportOptions, parse_mapping, run_import
+from export import csv_chunks, parquet_available, parquet_chunks
+from analytics_cache import cache as analytics_cache, invalidation as cache_invalidation
+from changefeed import feed as change_feed, stream_changes
+from metrics import MetricsMiddleware, metrics_response
+from querytrace import QueryBudgetExceeded, QueryTraceMiddleware, stats as sql_stats
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    await cache_invalidation.start()
+    try:
+        yield
+    finally:
+        await change_feed.stop()
+        await cache_invalidation.stop()
 
-app = FastAPI(title="BabyFlow Activity Service")
 
+app = FastAPI(title="BabyFlow Activity Service", default_response_class=ORJSONResponse, lifespan=lifespan)
+app.add_middleware(MetricsMiddleware)
+if SQL_TRACE:
+    app.add_middleware(QueryTraceMiddleware)
 
-# Pydantic модели для API
-class SleepCreate(BaseModel):
-    child_id: int
-    start_time: Union[datetime, str]
-    end_time: Optional[Union[datetime, str]] = None
-    duration_minutes: Optional[int] = None
-    quality: Optional[str] = None
-    location: Optional[str] = None
-    notes: Optional[str] = None
+# Максимальный размер пакета для /activities/batch
+MAX_BATCH_SIZE = 5000
 
+# Максимальное окно аналитики в днях (10 лет): агрегаты дневные, стоимость растет с числом дней
+MAX_ANALYTICS_DAYS = 3660
 
-class FeedingCreate(BaseModel):
-    child_id: int
-    time: Union[datetime, str]
-    type: str
-    duration_minutes: Optional[int] = None
-    amount_ml: Optional[int] = None
-    food_name: Optional[str] = None
-    side: Optional[str] = None
-    notes: Optional[str] = None
+# Пакетная аналитика: детей за запрос и точек (ребенок x день) в ответе /analytics/children/daily
+MAX_ANALYTICS_CHILDREN = 1000
+MAX_ANALYTICS_POINTS = 100000
 
+# Максимальный размер файла импорта истории
+MAX_IMPORT_BYTES = 64 * 1024 * 1024
 
-class WalkCreate(BaseModel):
-    child_id: int
-    start_time: Union[datetime, str]
-    end_time: Optional[Union[datetime, str]] = None
-    duration_minutes: Optional[int] = None
-    weather: Optional[str] = None
-    location: Optional[str] = None
-    notes: Optional[str] = None
+# Размер страницы ленты по умолчанию и максимальный
+DEFAULT_TIMELINE_PAGE = 200
+MAX_TIMELINE_PAGE = 5000
 
 
-class DiaperCreate(BaseModel):
-    child_id: int
-    time: Union[datetime, str]
-    type: str  # pee, poop, both
-    consistency: Optional[str] = None
-    color: Optional[str] = None
-    notes: Optional[str] = None
+# Pydantic модели для API
+class BatchActivity(BaseModel):
+    activity_type: str  # sleep, feeding, walk, diaper, temperature, medication, mood
+    data: Dict[str, Any]
 
 
-class TemperatureCreate(BaseModel):
-    child_id: int
-    time: Union[datetime, str]
-    temperature: float
-    measurement_type: Optional[str] = None
-    notes: Optional[str] = None
+class BatchCreate(BaseModel):
+    activities: List[BatchActivity]
 
 
-class MedicationCreate(BaseModel):
-    child_id: int
-    time: Union[datetime, str]
-    medication_name: str
-    dosage: Optional[str] = None
+class SessionStart(BaseModel):
+    start_time: Optional[datetime] = None  # по умолчанию - сейчас
+    location: Optional[str] = None
     notes: Optional[str] = None
+    conversation_id: Optional[int] = None
 
 
-class MoodCreate(BaseModel):
-    child_id: int
-    time: Union[datetime, str]
-    mood: str
-    intensity: Optional[int] = None
-    notes: Optional[str] = None
+class SessionStop(BaseModel):
+    end_time: Optional[datetime] = None  # по умолчанию - сейчас
 
 
 class UserCreate(BaseModel):
@@ -81,6 +91,10 @@ class UserCreate(BaseModel):
     first_name: Optional[str] = None
 
 
+class UserTimezone(BaseModel):
+    timezone: str  # имя из базы tz, например Europe/Berlin
+
+
 class ChildCreate(BaseModel):
     user_id: int
     name: str
@@ -88,36 +102,175 @@ class ChildCreate(BaseModel):
     gender: Optional[str] = None
 
 
+# Схемы ответов: FastAPI сериализует их через pydantic-core, без обхода ORM-объектов jsonable_encoder
+class UserRead(BaseModel):
+    model_config = ConfigDict(from_attributes=True)
+
+    id: int
+    telegram_id: int
+    username: Optional[str] = None
+    first_name: Optional[str] = None
+    timezone: Optional[str] = None
+    created_at: Optional[datetime] = None
+
+
+class ChildRead(BaseModel):
+    model_config = ConfigDict(from_attributes=True)
+
+    id: int
+    user_id: int
+    name: str
+    birth_date: date
+    gender: Optional[str] = None
+    created_at: Optional[datetime] = None
+
+
+@app.exception_handler(IdempotentReplay)
+async def idempotent_replay_handler(request: Request, exc: IdempotentReplay):
+    return ORJSONResponse(exc.response, status_code=exc.status_code, headers={"Idempotent-Replayed": "true"})
+
+
+@app.exception_handler(IdempotencyConflict)
+async def idempotency_conflict_handler(request: Request, exc: IdempotencyConflict):
+    return ORJSONResponse({"detail": exc.detail}, status_code=exc.status_code)
+
+
+@app.exception_handler(QueryBudgetExceeded)
+async def query_budget_handler(request: Request, exc: QueryBudgetExceeded):
+    # Только в строгом режиме трассировки SQL (SQL_TRACE_STRICT): проверка числа запросов не прошла
+    return ORJSONResponse({"detail": str(exc)}, status_code=500)
+
+
+async def idempotency_key(request: Request, db: AsyncSession = Depends(get_db)) -> Optional[str]:
+    """
+    Заголовок Idempotency-Key создающих запросов. Ключ занимается в транзакции запроса,
+    а повтор уже выполненного запроса обрывается здесь сохраненным ответом.
+    """
+    key = request.headers.get("idempotency-key")
+    if not key:
+        return None
+    if len(key) > 255:
+        raise HTTPException(status_code=400, detail="Idempotency-Key is longer than 255 characters")
+    await claim_key(db, key, f"{request.method} {request.url.path}",
+                    request_hash(request.url.query, await request.body()))
+    return key
+
+
+def _integrity_http_error(error: IntegrityError, conflict_detail: Optional[str] = None) -> Optional[HTTPException]:
+    """
+    Ответ на нарушение ограничения записи активности: второй открытой сессии - 409 с conflict_detail,
+    ссылки на несуществующего ребенка - 404, на несуществующую беседу - 422. None - ошибка не ожидалась.
+    """
+    sqlstate, constraint = integrity_violation(error)
+    if sqlstate == UNIQUE_VIOLATION and conflict_detail is not None:
+        return HTTPException(status_code=409, detail=conflict_detail)
+    if sqlstate == FOREIGN_KEY_VIOLATION and constraint:
+        # Имена внешних ключей - <таблица>_<колонка>_fkey, у секций тоже
+        if constraint.endswith("_child_id_fkey"):
+            return HTTPException(status_code=404, detail="Child not found")
+        if constraint.endswith("_conversation_id_fkey"):
+            return HTTPException(status_code=422, detail="Conversation not found")
+    return None
+
+
+async def _commit_created(db, instance, schema, key: Optional[str]):
+    """Фиксирует созданную запись; ответ сохраняется под ключом идемпотентности в той же транзакции"""
+    await db.flush()
+    await db.refresh(instance)
+    result = schema.model_validate(instance)
+    await remember_response(db, key, result.model_dump(mode="json"))
+    await db.commit()
+    return result
+
+
 @app.get("/")
-def root():
+async def root():
     return {"service": "Activity Service", "status": "running"}
 
 
+@app.get("/metrics", include_in_schema=False)
+async def metrics():
+    """Метрики Prometheus (см. metrics.py)"""
+    body, content_type = metrics_response()
+    return Response(body, media_type=content_type)
+
+
+def _require_sql_trace():
+    if not SQL_TRACE:
+        raise HTTPException(status_code=404, detail="SQL tracing is disabled, set SQL_TRACE=1")
+
+
+@app.get("/debug/sql", include_in_schema=False, dependencies=[Depends(_require_sql_trace)])
+async def sql_trace_report(top: int = Query(20, ge=1, le=1000)):
+    """Самые дорогие отпечатки SQL и число запросов по маршрутам (см. querytrace.py)"""
+    return sql_stats.report(top)
+
+
+@app.get("/debug/sql/budgets", include_in_schema=False, dependencies=[Depends(_require_sql_trace)])
+async def sql_trace_budgets():
+    """Наблюдаемый максимум запросов по маршрутам - в формате SQL_QUERY_BUDGETS"""
+    return sql_stats.observed_budgets()
+
+
+@app.delete("/debug/sql", include_in_schema=False, dependencies=[Depends(_require_sql_trace)])
+async def sql_trace_reset():
+    sql_stats.reset()
+    return {"status": "reset"}
+
+
 # User endpoints
-@app.post("/users/")
-def create_user(user: UserCreate, db: Session = Depends(get_db)):
-    db_user = db.query(User).filter(User.telegram_id == user.telegram_id).first()
+@app.post("/users/", response_model=UserRead)
+async def create_user(user: UserCreate, db: AsyncSession = Depends(get_db)):
+    db_user = (await db.execute(select(User).where(User.telegram_id == user.telegram_id))).scalars().first()
     if db_user:
         return db_user
 
     new_user = User(**user.dict())
     db.add(new_user)
-    db.commit()
-    db.refresh(new_user)
+    await db.commit()
+    await db.refresh(new_user)
     return new_user
 
 
-@app.get("/users/telegram/{telegram_id}")
-def get_user_by_telegram(telegram_id: int, db: Session = Depends(get_db)):
-    user = db.query(User).filter(User.telegram_id == telegram_id).first()
+@app.get("/users/telegram/{telegram_id}", response_model=UserRead)
+async def get_user_by_telegram(telegram_id: int, db: AsyncSession = Depends(get_db)):
+    user = (await db.execute(select(User).where(User.telegram_id == telegram_id))).scalars().first()
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
     return user
 
 
+@app.put("/users/{user_id}/timezone", response_model=UserRead)
+async def set_user_timezone(user_id: int, body: UserTimezone, db: AsyncSession = Depends(get_db)):
+    """
+    Часовой пояс пользователя: в нем считаются дни его детей. Агрегаты детей
+    пересчитываются по новому поясу, версии увеличиваются - ETag и кэш аналитики сбрасываются.
+    """
+    if not is_valid_timezone(body.timezone):
+        raise HTTPException(status_code=400, detail=f"Unknown timezone: {body.timezone}")
+    user = await db.get(User, user_id)
+    if not user:
+        raise HTTPException(status_code=404, detail="User not found")
+    if user.timezone == body.timezone:
+        return user
+
+    user.timezone = body.timezone
+    await db.flush()
+    # Версии первыми, как при любой записи: блокируют строки детей до пересчета их агрегатов
+    child_ids = (await db.execute(select(Child.id).where(Child.user_id == user_id))).scalars().all()
+    await bump_versions(db, child_ids)
+    for child_id in child_ids:
+        for statement, params in rebuild_statements(child_id):
+            await db.execute(statement, params)
+    await db.commit()
+    await db.refresh(user)
+    return user
+
+
 # Child endpoints
-@app.post("/children/")
-def create_child(child: ChildCreate, db: Session = Depends(get_db)):
+@app.post("/children/", response_model=ChildRead)
+async def create_child(child: ChildCreate, db: AsyncSession = Depends(get_db),
+                       key: Optional[str] = Depends(idempotency_key)):
     new_child = Child(
         user_id=child.user_id,
         name=child.name,
@@ -125,434 +278,700 @@ def create_child(child: ChildCreate, db: Session = Depends(get_db)):
         gender=child.gender
     )
     db.add(new_child)
-    db.commit()
-    db.refresh(new_child)
-    return new_child
+    return await _commit_created(db, new_child, ChildRead, key)
 
 
-@app.get("/children/user/{user_id}")
-def get_children_by_user(user_id: int, db: Session = Depends(get_db)):
-    children = db.query(Child).filter(Child.user_id == user_id).all()
+@app.get("/children/user/{user_id}", response_model=List[ChildRead])
+async def get_children_by_user(user_id: int, db: AsyncSession = Depends(get_db)):
+    children = (await db.execute(select(Child).where(Child.user_id == user_id))).scalars().all()
     return children
 
 
-# Sleep endpoints
-@app.post("/activities/sleep/")
-def create_sleep(sleep: SleepCreate, db: Session = Depends(get_db)):
-    # Если есть end_time, вычисляем duration
-    if sleep.end_time and sleep.start_time:
-        duration = int((sleep.end_time - sleep.start_time).total_seconds() / 60)
-        sleep.duration_minutes = duration
-
-    # Создаем объект для БД
-    sleep_data = sleep.dict()
-
-    # Обрабатываем datetime если они строки
-    if isinstance(sleep_data.get('start_time'), str):
-        sleep_data['start_time'] = datetime.fromisoformat(sleep_data['start_time'].replace('Z', '+00:00'))
-    if isinstance(sleep_data.get('end_time'), str):
-        sleep_data['end_time'] = datetime.fromisoformat(sleep_data['end_time'].replace('Z', '+00:00'))
-
-    new_sleep = SleepActivity(**sleep_data)
-    db.add(new_sleep)
-    db.commit()
-    db.refresh(new_sleep)
-    return new_sleep
-
-
-@app.get("/activities/sleep/{child_id}/open")
-def get_open_sleep(child_id: int, db: Session = Depends(get_db)):
-    sleep = db.query(SleepActivity).filter(
+# Создание активностей: один обработчик по реестру типов на все POST /activities/<тип>/
+async def _create_activity(db, activity: ActivityType, payload, key: Optional[str]):
+    """Записывает активность одного типа: строка, версия ребенка, агрегаты и модель прогноза одной транзакцией"""
+    try:
+        row = prepare_row(activity, payload)
+    except ValueError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+    table = activity.model.__table__
+    try:
+        created = (await db.execute(insert(table).values(**row).returning(*table.c))).first()
+    except IntegrityError as e:
+        # У сессий частичный уникальный индекс допускает одну открытую на ребенка
+        error = _integrity_http_error(
+            e, f"{activity.name.capitalize()} already in progress" if activity.end_column else None
+        )
+        if error is None:
+            raise
+        raise error
+
+    timezones = await bump_versions(db, [row["child_id"]])
+    await apply_rollups(db, [activity_contribution(activity.name, row)], timezones)
+    await observe_activities(db, [(activity.name, row)])
+    result = activity.read_schema.model_validate(created)
+    await remember_response(db, key, result.model_dump(mode="json"))
+    await db.commit()
+    return result
+
+
+def _create_endpoint(activity: ActivityType):
+    async def endpoint(payload: activity.create_schema, db: AsyncSession = Depends(get_db),
+                       key: Optional[str] = Depends(idempotency_key)):
+        return await _create_activity(db, activity, payload, key)
+    endpoint.__name__ = f"create_{activity.name}"
+    return endpoint
+
+
+for _activity in ACTIVITY_TYPES.values():
+    app.post(f"/activities/{_activity.name}/", response_model=_activity.read_schema)(_create_endpoint(_activity))
+
+
+@app.get("/activities/sleep/{child_id}/open", response_model=Optional[SleepRead])
+async def get_open_sleep(child_id: int, db: AsyncSession = Depends(get_db)):
+    sleep = (await db.execute(select(SleepActivity).where(
         SleepActivity.child_id == child_id,
         SleepActivity.end_time == None
-    ).first()
+    ))).scalars().first()
     return sleep
 
 
-@app.put("/activities/sleep/{sleep_id}/end")
-def end_sleep(sleep_id: int, end_time: str, db: Session = Depends(get_db)):
-    sleep = db.query(SleepActivity).filter(SleepActivity.id == sleep_id).first()
+@app.put("/activities/sleep/{sleep_id}/end", response_model=SleepRead)
+async def end_sleep(sleep_id: int, end_time: datetime, db: AsyncSession = Depends(get_db)):
+    sleep = await db.get(SleepActivity, sleep_id)
     if not sleep:
         raise HTTPException(status_code=404, detail="Sleep not found")
 
-    # Парсим строку времени в datetime
-    try:
-        end_datetime = datetime.fromisoformat(end_time.replace('Z', '+00:00').replace(' ', 'T'))
-    except:
-        end_datetime = datetime.now()
-
-    sleep.end_time = end_datetime
+    # Время без пояса считается UTC, как в БД
+    end_datetime = end_time if end_time.tzinfo is not None else end_time.replace(tzinfo=pytz.UTC)
+    # Отрицательная длительность попала бы в агрегаты
+    if end_datetime < sleep.start_time:
+        raise HTTPException(status_code=422,
+                            detail=f"end_time is earlier than the sleep start ({sleep.start_time.isoformat()})")
 
-    # Вычисляем длительность
-    if hasattr(sleep.start_time, 'timestamp'):
-        duration = int((end_datetime.timestamp() - sleep.start_time.timestamp()) / 60)
-    else:
-        duration = int((end_datetime - sleep.start_time).total_seconds() / 60)
+    # Если сон уже был завершен, его прежний вклад в агрегаты снимается
+    previous_rollup = activity_contribution("sleep", {
+        "child_id": sleep.child_id, "start_time": sleep.start_time, "duration_minutes": sleep.duration_minutes
+    }, sign=-1)
 
+    sleep.end_time = end_datetime
+    duration = duration_minutes(sleep.start_time, end_datetime)
     sleep.duration_minutes = duration
 
-    db.commit()
-    db.refresh(sleep)
+    timezones = await bump_versions(db, [sleep.child_id])
+    await apply_rollups(db, [previous_rollup, activity_contribution("sleep", {
+        "child_id": sleep.child_id, "start_time": sleep.start_time, "duration_minutes": duration
+    })], timezones)
+    await observe_activities(db, [("sleep_end", {
+        "child_id": sleep.child_id, "start_time": sleep.start_time, "end_time": end_datetime
+    })])
+    await db.commit()
+    await db.refresh(sleep)
     return sleep
 
 
-# Feeding endpoints
-@app.post("/activities/feeding/")
-def create_feeding(feeding: FeedingCreate, db: Session = Depends(get_db)):
-    feeding_data = feeding.dict()
-
-    # Обрабатываем datetime если строка
-    if isinstance(feeding_data.get('time'), str):
-        feeding_data['time'] = datetime.fromisoformat(feeding_data['time'].replace('Z', '+00:00'))
-
-    new_feeding = FeedingActivity(**feeding_data)
-    db.add(new_feeding)
-    db.commit()
-    db.refresh(new_feeding)
-    return new_feeding
-
-
-# Walk endpoints
-@app.post("/activities/walk/")
-def create_walk(walk: WalkCreate, db: Session = Depends(get_db)):
-    walk_data = walk.dict()
-
-    # Обрабатываем datetime если строки
-    if isinstance(walk_data.get('start_time'), str):
-        walk_data['start_time'] = datetime.fromisoformat(walk_data['start_time'].replace('Z', '+00:00'))
-    if isinstance(walk_data.get('end_time'), str):
-        walk_data['end_time'] = datetime.fromisoformat(walk_data['end_time'].replace('Z', '+00:00'))
-
-    if walk_data.get('end_time') and walk_data.get('start_time'):
-        duration = int((walk_data['end_time'] - walk_data['start_time']).total_seconds() / 60)
-        walk_data['duration_minutes'] = duration
-
-    new_walk = WalkActivity(**walk_data)
-    db.add(new_walk)
-    db.commit()
-    db.refresh(new_walk)
-    return new_walk
-
-
-# Diaper endpoints
-@app.post("/activities/diaper/")
-def create_diaper(diaper: DiaperCreate, db: Session = Depends(get_db)):
-    diaper_data = diaper.dict()
+# Batch endpoints
+def _prepare_batch_item(item: BatchActivity) -> dict:
+    """Строка таблицы для записи пакета; ValueError - неизвестный тип или невалидная запись"""
+    if item.activity_type not in ACTIVITY_TYPES:
+        raise ValueError(f"Unknown activity type: {item.activity_type}")
+    return prepare_row(ACTIVITY_TYPES[item.activity_type], item.data)
+
+
+@app.post("/activities/batch")
+async def create_activities_batch(batch: BatchCreate, db: AsyncSession = Depends(get_db),
+                                  key: Optional[str] = Depends(idempotency_key)):
+    """
+    Пакетная запись активностей разных типов одной транзакцией.
+    Невалидные записи не прерывают пакет и возвращаются с ошибкой на своей позиции.
+    """
+    if len(batch.activities) > MAX_BATCH_SIZE:
+        raise HTTPException(status_code=400, detail=f"Batch is larger than {MAX_BATCH_SIZE} activities")
+
+    results = [None] * len(batch.activities)
+    prepared = []
+    for index, item in enumerate(batch.activities):
+        try:
+            prepared.append((index, item.activity_type, _prepare_batch_item(item)))
+        except ValidationError as e:
+            results[index] = {"index": index, "activity_type": item.activity_type,
+                              "error": [{"loc": err["loc"], "msg": err["msg"]} for err in e.errors()]}
+        except ValueError as e:
+            results[index] = {"index": index, "activity_type": item.activity_type, "error": str(e)}
+
+    # Несуществующие дети проверяются одним запросом, а не нарушением FK посреди вставки;
+    # тот же запрос дает пояса владельцев для агрегатов
+    timezones = await child_timezones(db, {row["child_id"] for _, _, row in prepared})
+
+    rows_by_type = {}
+    for index, activity_type, row in prepared:
+        if row["child_id"] not in timezones:
+            results[index] = {"index": index, "activity_type": activity_type, "error": "Child not found"}
+            continue
+        rows_by_type.setdefault(activity_type, []).append((index, row))
+
+    # Один multi-row INSERT ... RETURNING на тип, один commit на весь пакет
+    for activity_type, items in rows_by_type.items():
+        table = ACTIVITY_TYPES[activity_type].model.__table__
+        try:
+            ids = (await db.execute(
+                insert(table).returning(table.c.id, sort_by_parameter_order=True),
+                [row for _, row in items]
+            )).scalars().all()
+        except IntegrityError as e:
+            # Дети уже проверены: остается вторая открытая сессия, прочие нарушения не ожидаются
+            error = _integrity_http_error(e, f"Batch opens a second {activity_type} session for a child")
+            if error is None:
+                raise
+            raise error
+        for (index, _), new_id in zip(items, ids):
+            results[index] = {"index": index, "activity_type": activity_type, "id": new_id}
+
+    await bump_versions(db, [row["child_id"] for items in rows_by_type.values() for _, row in items])
+    await apply_rollups(db, [
+        activity_contribution(activity_type, row)
+        for activity_type, items in rows_by_type.items() for _, row in items
+    ], timezones)
+    await observe_activities(db, [
+        (activity_type, row) for activity_type, items in rows_by_type.items() for _, row in items
+    ])
+
+    failed = sum(1 for result in results if "error" in result)
+    response = {"inserted": len(results) - failed, "failed": failed, "results": results}
+    await remember_response(db, key, response)
+    await db.commit()
+    return response
+
+
+# Import endpoints
+IMPORT_CONTENT_TYPES = {"text/csv": "csv", "application/json": "json", "application/x-ndjson": "json"}
+
+
+@app.post("/import/child/{child_id}", status_code=202)
+async def import_child_history(child_id: int, request: Request, background_tasks: BackgroundTasks,
+                               format: Optional[str] = Query(None, pattern="^(csv|json)$"),
+                               activity_type: Optional[str] = None, columns: Optional[str] = None,
+                               types: Optional[str] = None, tz: Optional[str] = None,
+                               db: AsyncSession = Depends(get_db), key: Optional[str] = Depends(idempotency_key)):
+    """
+    Импорт истории из CSV/JSON в теле запроса. Файл проверяется и загружается в фоне;
+    прогресс и файл ошибок - GET /import/jobs/{job_id}. Формат берется из format
+    или Content-Type; columns и types переименовывают колонки и типы другого приложения.
+    Время без смещения считается временем tz, по умолчанию - пояса владельца ребенка.
+    """
+    import_format = format or IMPORT_CONTENT_TYPES.get(request.headers.get("content-type", "").split(";")[0].strip())
+    if import_format is None:
+        raise HTTPException(status_code=400, detail="Pass format=csv|json or a text/csv or application/json body")
+    if activity_type is not None and activity_type not in ACTIVITY_TYPES:
+        raise HTTPException(status_code=400, detail=f"Unknown activity type: {activity_type}")
+    if tz is not None and not is_valid_timezone(tz):
+        raise HTTPException(status_code=400, detail=f"Unknown timezone: {tz}")
+    try:
+        mappings = parse_mapping(columns), parse_mapping(types)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    body = await request.body()
+    if len(body) > MAX_IMPORT_BYTES:
+        raise HTTPException(status_code=413, detail=f"Import is larger than {MAX_IMPORT_BYTES} bytes")
+    owner_timezone = (await child_timezones(db, [child_id])).get(child_id)
+    if owner_timezone is None:
+        raise HTTPException(status_code=404, detail="Child not found")
+    options = ImportOptions(import_format, activity_type, *mappings, tz or owner_timezone)
+
+    job = ImportJob(child_id=child_id, format=import_format, status="pending")
+    db.add(job)
+    await db.flush()
+    response = {"job_id": job.id, "status": job.status}
+    await remember_response(db, key, response, status_code=202)
+    await db.commit()
+    background_tasks.add_task(run_import, job.id, child_id, body, options)
+    return response
+
+
+@app.get("/import/jobs/{job_id}")
+async def get_import_job(job_id: int, db: AsyncSession = Depends(get_db)):
+    """Состояние задания импорта: строки всего, проверено, загружено, с ошибками"""
+    job = await db.get(ImportJob, job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Import job not found")
+    return {
+        "job_id": job.id,
+        "child_id": job.child_id,
+        "format": job.format,
+        "status": job.status,
+        "total_rows": job.total_rows,
+        "validated_rows": job.validated_rows,
+        "inserted_rows": job.inserted_rows,
+        "failed_rows": job.failed_rows,
+        "error": job.error,
+        "errors_url": f"/import/jobs/{job.id}/errors" if job.error_file else None,
+        "created_at": job.created_at,
+        "finished_at": job.finished_at,
+    }
 
-    # Обрабатываем datetime если строка
-    if isinstance(diaper_data.get('time'), str):
-        diaper_data['time'] = datetime.fromisoformat(diaper_data['time'].replace('Z', '+00:00'))
 
-    new_diaper = DiaperActivity(**diaper_data)
-    db.add(new_diaper)
-    db.commit()
-    db.refresh(new_diaper)
-    return new_diaper
+@app.get("/import/jobs/{job_id}/errors")
+async def get_import_errors(job_id: int, db: AsyncSession = Depends(get_db)):
+    """Файл ошибок импорта: CSV с номером строки, колонкой, сообщением и исходной строкой"""
+    job = await db.get(ImportJob, job_id)
+    if job is None or not job.error_file:
+        raise HTTPException(status_code=404, detail="Import job has no error file")
+    return FileResponse(job.error_file, media_type="text/csv", filename=f"import-{job_id}-errors.csv")
 
 
-# Temperature endpoints
-@app.post("/activities/temperature/")
-def create_temperature(temp: TemperatureCreate, db: Session = Depends(get_db)):
-    temp_data = temp.dict()
+# Session endpoints
+def _session_kind(kind: str):
+    if kind not in SESSION_KINDS:
+        raise HTTPException(status_code=404, detail=f"Unknown session kind: {kind}")
+    return kind
 
-    # Обрабатываем datetime если строка
-    if isinstance(temp_data.get('time'), str):
-        temp_data['time'] = datetime.fromisoformat(temp_data['time'].replace('Z', '+00:00'))
 
-    new_temp = TemperatureActivity(**temp_data)
-    db.add(new_temp)
-    db.commit()
-    db.refresh(new_temp)
-    return new_temp
+@app.post("/children/{child_id}/sessions/{kind}/start", response_model=Union[SleepRead, WalkRead])
+async def start_child_session(child_id: int, kind: str, session: Optional[SessionStart] = None,
+                              db: AsyncSession = Depends(get_db), key: Optional[str] = Depends(idempotency_key)):
+    """Начать сон или прогулку; 409, если сессия этого вида уже открыта"""
+    kind = _session_kind(kind)
+    values = (session or SessionStart()).dict(exclude_none=True)
+    values.setdefault("start_time", datetime.now(pytz.UTC))
 
+    try:
+        started = await start_session(db, kind, child_id, values)
+    except IntegrityError as e:
+        # Вторую открытую сессию вставка пропускает сама (None ниже), здесь - только внешние ключи
+        error = _integrity_http_error(e)
+        if error is None:
+            raise
+        raise error
+    if started is None:
+        raise HTTPException(status_code=409, detail=f"{kind.capitalize()} already in progress")
+
+    await bump_versions(db, [child_id])
+    await observe_activities(db, [(kind, started)])
+    result = SESSION_KINDS[kind].read_schema.model_validate(started)
+    await remember_response(db, key, result.model_dump(mode="json"))
+    await db.commit()
+    return result
+
+
+@app.post("/children/{child_id}/sessions/{kind}/stop", response_model=Union[SleepRead, WalkRead])
+async def stop_child_session(child_id: int, kind: str, session: Optional[SessionStop] = None,
+                             db: AsyncSession = Depends(get_db), key: Optional[str] = Depends(idempotency_key)):
+    """Завершить открытый сон или прогулку; 404, если открытой сессии нет, 422, если end_time раньше ее начала"""
+    kind = _session_kind(kind)
+    end_time = (session or SessionStop()).end_time or datetime.now(pytz.UTC)
 
-# Medication endpoints
-@app.post("/activities/medication/")
-def create_medication(med: MedicationCreate, db: Session = Depends(get_db)):
-    med_data = med.dict()
+    try:
+        stopped = await stop_session(db, kind, child_id, end_time)
+    except ValueError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+    if stopped is None:
+        raise HTTPException(status_code=404, detail=f"No {kind} in progress")
+
+    timezones = await bump_versions(db, [child_id])
+    await apply_rollups(db, [activity_contribution(kind, stopped)], timezones)
+    await observe_activities(db, [(f"{kind}_end", stopped)])
+    result = SESSION_KINDS[kind].read_schema.model_validate(stopped)
+    await remember_response(db, key, result.model_dump(mode="json"))
+    await db.commit()
+    return result
+
+
+@app.get("/children/{child_id}/sessions/open")
+async def get_open_sessions(child_id: int, db: AsyncSession = Depends(get_db)):
+    """Открытые сессии ребенка всех видов"""
+    return await open_sessions(db, child_id)
+
+
+async def child_version(child_id: int, db: AsyncSession = Depends(get_db)):
+    """
+    Версия данных ребенка, признак недавней записи и пояс владельца (VersionState).
+    Читается из основной базы один раз на запрос: ее используют ETag, выбор реплики и окна аналитики.
+    """
+    return await version_state(db, child_id, READ_YOUR_WRITES_SECONDS)
+
+
+async def read_from_primary(child_id: int, version=Depends(child_version)) -> bool:
+    """
+    Читать ли ребенка из основной базы: если его записывали последние
+    READ_YOUR_WRITES_SECONDS секунд или реплика еще не догнала его версию.
+    Иначе ответ с реплики ушел бы под ETag новой версии со старыми данными.
+    """
+    if version.recent_write or not REPLICAS:
+        return True
+    async with read_session_scope() as db:
+        replica = await version_state(db, child_id, 0)
+    return replica.version < version.version
+
+
+async def get_read_db(use_primary: bool = Depends(read_from_primary)):
+    """Сессия для чтений одного ребенка: реплика или основная база по read_from_primary"""
+    async with read_session_scope(use_primary) as db:
+        yield db
+
+
+async def not_modified(child_id: int, request: Request, response: Response, version=Depends(child_version)):
+    """
+    ETag по версии данных ребенка. Если у клиента актуальная копия, запрос
+    обрывается ответом 304 до выполнения запросов самого эндпоинта.
+    """
+    # Accept входит в ресурс: по одному URL отдаются и JSON, и NDJSON
+    resource = f"{request.url.path}?{request.url.query}|{request.headers.get('accept', '')}"
+    etag = build_etag(child_id, version.version, resource, version.timezone)
+    if etag_matches(request.headers.get("if-none-match", ""), etag):
+        raise HTTPException(status_code=304, headers={"ETag": etag})
+    response.headers["ETag"] = etag
+
+
+def _json(content, response: Response) -> ORJSONResponse:
+    """
+    Ответ сериализуется orjson напрямую, минуя jsonable_encoder. Заголовки, выставленные
+    зависимостями (ETag) и эндпоинтом, переносятся из внедренного response.
+    """
+    return ORJSONResponse(content, headers=dict(response.headers))
+
+
+def _resolve_filters(types: Optional[str], fields: Optional[str]):
+    try:
+        activity_types = resolve_types(types)
+        return activity_types, resolve_fields(fields, activity_types)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
 
-    # Обрабатываем datetime если строка
-    if isinstance(med_data.get('time'), str):
-        med_data['time'] = datetime.fromisoformat(med_data['time'].replace('Z', '+00:00'))
 
-    new_med = MedicationActivity(**med_data)
-    db.add(new_med)
-    db.commit()
-    db.refresh(new_med)
-    return new_med
+# Get all activities for a child
+@app.get("/activities/child/{child_id}/timeline", dependencies=[Depends(not_modified)])
+async def get_child_timeline(child_id: int, request: Request, response: Response,
+                       from_time: Optional[datetime] = Query(None, alias="from"),
+                       to_time: Optional[datetime] = Query(None, alias="to"), types: Optional[str] = None,
+                       fields: Optional[str] = None, after: Optional[str] = None,
+                       limit: Optional[int] = Query(None, ge=1, le=MAX_TIMELINE_PAGE),
+                       format: Optional[str] = Query(None, pattern="^(json|ndjson)$"),
+                       order: str = Query("asc", pattern="^(asc|desc)$"),
+                       use_primary: bool = Depends(read_from_primary), db: AsyncSession = Depends(get_read_db)):
+    """
+    Все активности ребенка одной лентой, упорядоченной по времени (order=desc - от новых к старым:
+    первая страница - самые свежие записи).
+    JSON отдается страницами: курсор следующей страницы в заголовке X-Next-Cursor,
+    его значение передается в after. Формат ndjson (?format=ndjson или
+    Accept: application/x-ndjson) отдает всю выборку потоком без ограничения limit.
+    fields - список колонок через запятую; из БД читаются только они.
+    """
+    activity_types, columns = _resolve_filters(types, fields)
+    try:
+        cursor = TimelineCursor.parse(after) if after else None
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    if format == "ndjson" or (format is None and "application/x-ndjson" in request.headers.get("accept", "")):
+        return StreamingResponse(
+            _timeline_ndjson(child_id, from_time, to_time, activity_types, cursor, columns, use_primary,
+                             order == "desc"),
+            media_type="application/x-ndjson"
+        )
+
+    limit = limit or DEFAULT_TIMELINE_PAGE
+    rows = await fetch_timeline(db, child_id, from_time, to_time, activity_types, cursor, limit, columns, order == "desc")
+    if len(rows) == limit:
+        response.headers["X-Next-Cursor"] = str(TimelineCursor.from_row(rows[-1]))
+    return _json([timeline_entry(row) for row in rows], response)
+
+
+async def _timeline_ndjson(child_id: int, from_time, to_time, activity_types, cursor, columns, use_primary: bool,
+                           descending: bool):
+    # Сессия зависимости закрывается до начала отдачи тела, поэтому поток держит свою
+    async with read_session_scope(use_primary) as db:
+        async for rows in stream_timeline(db, child_id, from_time, to_time, activity_types, cursor, columns,
+                                          descending=descending):
+            yield b"".join(orjson.dumps(timeline_entry(row), option=orjson.OPT_APPEND_NEWLINE) for row in rows)
+
+
+EXPORT_FORMATS = {
+    "csv": (csv_chunks, "text/csv; charset=utf-8"),
+    "parquet": (parquet_chunks, "application/vnd.apache.parquet"),
+}
+
+
+async def _export_stream(chunks, child_id: int, from_time, to_time, activity_types, use_primary: bool):
+    # Как и NDJSON ленты, поток держит свою сессию: сессия зависимости закрывается до отдачи тела
+    async with read_session_scope(use_primary) as db:
+        async for chunk in chunks(db, child_id, from_time, to_time, activity_types):
+            yield chunk
+
+
+def _export_response(child_id: int, export_format: str, from_time, to_time, types, use_primary: bool):
+    activity_types, _ = _resolve_filters(types, None)
+    if export_format == "parquet" and not parquet_available():
+        raise HTTPException(status_code=501, detail="Parquet export requires pyarrow")
+    chunks, media_type = EXPORT_FORMATS[export_format]
+    return StreamingResponse(
+        _export_stream(chunks, child_id, from_time, to_time, activity_types, use_primary),
+        media_type=media_type,
+        headers={"Content-Disposition": f'attachment; filename="child-{child_id}.{export_format}"'}
+    )
 
 
-# Mood endpoints
-@app.post("/activities/mood/")
-def create_mood(mood: MoodCreate, db: Session = Depends(get_db)):
-    mood_data = mood.dict()
+@app.get("/export/child/{child_id}.csv")
+async def export_child_csv(child_id: int, from_time: Optional[datetime] = Query(None, alias="from"),
+                           to_time: Optional[datetime] = Query(None, alias="to"), types: Optional[str] = None,
+                           use_primary: bool = Depends(read_from_primary)):
+    """Дневник ребенка в CSV, потоком; фильтры from/to и types как у ленты"""
+    return _export_response(child_id, "csv", from_time, to_time, types, use_primary)
 
-    # Обрабатываем datetime если строка
-    if isinstance(mood_data.get('time'), str):
-        mood_data['time'] = datetime.fromisoformat(mood_data['time'].replace('Z', '+00:00'))
 
-    new_mood = MoodActivity(**mood_data)
-    db.add(new_mood)
-    db.commit()
-    db.refresh(new_mood)
-    return new_mood
+@app.get("/export/child/{child_id}.parquet")
+async def export_child_parquet(child_id: int, from_time: Optional[datetime] = Query(None, alias="from"),
+                               to_time: Optional[datetime] = Query(None, alias="to"), types: Optional[str] = None,
+                               use_primary: bool = Depends(read_from_primary)):
+    """Дневник ребенка в Parquet, потоком по группе строк на пачку; фильтры как у ленты"""
+    return _export_response(child_id, "parquet", from_time, to_time, types, use_primary)
 
 
-# Get all activities for a child
-@app.get("/activities/child/{child_id}")
-def get_child_activities(child_id: int, db: Session = Depends(get_db)):
-    sleep = db.query(SleepActivity).filter(SleepActivity.child_id == child_id).all()
-    feeding = db.query(FeedingActivity).filter(FeedingActivity.child_id == child_id).all()
-    walks = db.query(WalkActivity).filter(WalkActivity.child_id == child_id).all()
-    diapers = db.query(DiaperActivity).filter(DiaperActivity.child_id == child_id).all()
-    temperatures = db.query(TemperatureActivity).filter(TemperatureActivity.child_id == child_id).all()
-    medications = db.query(MedicationActivity).filter(MedicationActivity.child_id == child_id).all()
-    moods = db.query(MoodActivity).filter(MoodActivity.child_id == child_id).all()
+@app.get("/activities/child/{child_id}", dependencies=[Depends(not_modified)])
+async def get_child_activities(child_id: int, response: Response, fields: Optional[str] = None,
+                               db: AsyncSession = Depends(get_read_db)):
+    _, columns = _resolve_filters(None, fields)
+    return _json(group_timeline(await fetch_timeline(db, child_id, fields=columns)), response)
 
-    return {
-        "sleep": sleep,
-        "feeding": feeding,
-        "walks": walks,
-        "diapers": diapers,
-        "temperatures": temperatures,
-        "medications": medications,
-        "moods": moods
-    }
 
+@app.get("/activities/child/{child_id}/today", dependencies=[Depends(not_modified)])
+async def get_today_activities(child_id: int, response: Response, fields: Optional[str] = None,
+                               version=Depends(child_version), db: AsyncSession = Depends(get_read_db)):
+    """Активности с полуночи в поясе владельца ребенка"""
+    _, columns = _resolve_filters(None, fields)
+    today_start, _ = today_bounds(version.timezone)
 
-@app.get("/activities/child/{child_id}/today")
-def get_today_activities(child_id: int, db: Session = Depends(get_db)):
-    from datetime import timezone
-    import pytz
-
-    moscow_tz = pytz.timezone('Europe/Moscow')
-    today_moscow = datetime.now(moscow_tz).date()
-    today_start = moscow_tz.localize(datetime.combine(today_moscow, datetime.min.time()))
-
-    sleep = db.query(SleepActivity).filter(
-        SleepActivity.child_id == child_id,
-        SleepActivity.start_time >= today_start
-    ).all()
-
-    feeding = db.query(FeedingActivity).filter(
-        FeedingActivity.child_id == child_id,
-        FeedingActivity.time >= today_start
-    ).all()
-
-    walks = db.query(WalkActivity).filter(
-        WalkActivity.child_id == child_id,
-        WalkActivity.start_time >= today_start
-    ).all()
-
-    diapers = db.query(DiaperActivity).filter(
-        DiaperActivity.child_id == child_id,
-        DiaperActivity.time >= today_start
-    ).all()
-
-    temperatures = db.query(TemperatureActivity).filter(
-        TemperatureActivity.child_id == child_id,
-        TemperatureActivity.time >= today_start
-    ).all()
-
-    medications = db.query(MedicationActivity).filter(
-        MedicationActivity.child_id == child_id,
-        MedicationActivity.time >= today_start
-    ).all()
-
-    moods = db.query(MoodActivity).filter(
-        MoodActivity.child_id == child_id,
-        MoodActivity.time >= today_start
-    ).all()
-
-    return {
-        "sleep": sleep,
-        "feeding": feeding,
-        "walks": walks,
-        "diapers": diapers,
-        "temperatures": temperatures,
-        "medications": medications,
-        "moods": moods
-    }
+    return _json(group_timeline(await fetch_timeline(db, child_id, start=today_start, fields=columns)), response)
 
 
 # Analytics endpoints
-@app.get("/analytics/child/{child_id}/stats")
-def get_child_stats(child_id: int, days: int = 7, db: Session = Depends(get_db)):
-    """Получить статистику за период"""
-    from datetime import timedelta
-    from sqlalchemy import func
-
-    moscow_tz = pytz.timezone('Europe/Moscow')
-    end_date = datetime.now(moscow_tz)
-    start_date = end_date - timedelta(days=days)
-
-    # Статистика сна
-    sleep_stats = db.query(
-        func.count(SleepActivity.id).label('count'),
-        func.avg(SleepActivity.duration_minutes).label('avg_duration'),
-        func.sum(SleepActivity.duration_minutes).label('total_duration')
-    ).filter(
-        SleepActivity.child_id == child_id,
-        SleepActivity.start_time >= start_date,
-        SleepActivity.duration_minutes.isnot(None)
-    ).first()
-
-    # Статистика кормлений
-    feeding_stats = db.query(
-        func.count(FeedingActivity.id).label('count'),
-        func.avg(FeedingActivity.amount_ml).label('avg_amount'),
-        func.sum(FeedingActivity.amount_ml).label('total_amount')
-    ).filter(
-        FeedingActivity.child_id == child_id,
-        FeedingActivity.time >= start_date
-    ).first()
-
-    # Подсчет по типам кормления
-    feeding_by_type = db.query(
-        FeedingActivity.type,
-        func.count(FeedingActivity.id).label('count')
-    ).filter(
-        FeedingActivity.child_id == child_id,
-        FeedingActivity.time >= start_date
-    ).group_by(FeedingActivity.type).all()
-
-    # Статистика прогулок
-    walk_stats = db.query(
-        func.count(WalkActivity.id).label('count'),
-        func.avg(WalkActivity.duration_minutes).label('avg_duration'),
-        func.sum(WalkActivity.duration_minutes).label('total_duration')
-    ).filter(
-        WalkActivity.child_id == child_id,
-        WalkActivity.start_time >= start_date,
-        WalkActivity.duration_minutes.isnot(None)
-    ).first()
-
-    # Статистика подгузников
-    diaper_stats = db.query(
-        func.count(DiaperActivity.id).label('count')
-    ).filter(
-        DiaperActivity.child_id == child_id,
-        DiaperActivity.time >= start_date
-    ).first()
-
-    # Подсчет по типам подгузников
-    diaper_by_type = db.query(
-        DiaperActivity.type,
-        func.count(DiaperActivity.id).label('count')
-    ).filter(
-        DiaperActivity.child_id == child_id,
-        DiaperActivity.time >= start_date
-    ).group_by(DiaperActivity.type).all()
-
-    # Статистика температуры
-    temp_stats = db.query(
-        func.count(TemperatureActivity.id).label('count'),
-        func.avg(TemperatureActivity.temperature).label('avg_temp'),
-        func.max(TemperatureActivity.temperature).label('max_temp'),
-        func.min(TemperatureActivity.temperature).label('min_temp')
-    ).filter(
-        TemperatureActivity.child_id == child_id,
-        TemperatureActivity.time >= start_date
-    ).first()
+def _stats_payload(totals, days: int, start_date: datetime, end_date: datetime) -> dict:
+    sleep_avg = totals.sleep_minutes / totals.sleep_count if totals.sleep_count else 0
+    walk_avg = totals.walk_minutes / totals.walk_count if totals.walk_count else 0
 
     return {
         "period_days": days,
         "start_date": start_date.isoformat(),
         "end_date": end_date.isoformat(),
         "sleep": {
-            "count": sleep_stats.count or 0,
-            "avg_duration_minutes": float(sleep_stats.avg_duration) if sleep_stats.avg_duration else 0,
-            "total_duration_minutes": sleep_stats.total_duration or 0,
-            "avg_duration_hours": round(float(sleep_stats.avg_duration) / 60, 1) if sleep_stats.avg_duration else 0,
-            "total_duration_hours": round(float(sleep_stats.total_duration or 0) / 60, 1)
+            "count": totals.sleep_count,
+            "avg_duration_minutes": float(sleep_avg),
+            "total_duration_minutes": totals.sleep_minutes,
+            "avg_duration_hours": round(float(sleep_avg) / 60, 1),
+            "total_duration_hours": round(float(totals.sleep_minutes) / 60, 1)
         },
         "feeding": {
-            "count": feeding_stats.count or 0,
-            "avg_amount_ml": float(feeding_stats.avg_amount) if feeding_stats.avg_amount else 0,
-            "total_amount_ml": feeding_stats.total_amount or 0,
-            "by_type": {item.type: item.count for item in feeding_by_type}
+            "count": totals.feeding_count,
+            "avg_amount_ml": float(totals.feeding_ml / totals.feeding_ml_count) if totals.feeding_ml_count else 0,
+            "total_amount_ml": totals.feeding_ml,
+            "by_type": totals.feeding_by_type
         },
         "walks": {
-            "count": walk_stats.count or 0,
-            "avg_duration_minutes": float(walk_stats.avg_duration) if walk_stats.avg_duration else 0,
-            "total_duration_minutes": walk_stats.total_duration or 0,
-            "avg_duration_hours": round(float(walk_stats.avg_duration) / 60, 1) if walk_stats.avg_duration else 0
+            "count": totals.walk_count,
+            "avg_duration_minutes": float(walk_avg),
+            "total_duration_minutes": totals.walk_minutes,
+            "avg_duration_hours": round(float(walk_avg) / 60, 1)
         },
         "diapers": {
-            "count": diaper_stats.count or 0,
-            "by_type": {item.type: item.count for item in diaper_by_type}
+            "count": totals.diaper_count,
+            "by_type": totals.diaper_by_type
         },
         "temperature": {
-            "count": temp_stats.count or 0,
-            "avg": float(temp_stats.avg_temp) if temp_stats.avg_temp else 0,
-            "max": float(temp_stats.max_temp) if temp_stats.max_temp else 0,
-            "min": float(temp_stats.min_temp) if temp_stats.min_temp else 0
+            "count": totals.temperature_count,
+            "avg": float(totals.temperature_sum / totals.temperature_count) if totals.temperature_count else 0,
+            "max": float(totals.temperature_max) if totals.temperature_max else 0,
+            "min": float(totals.temperature_min) if totals.temperature_min else 0
         }
     }
 
 
-@app.get("/analytics/child/{child_id}/daily")
-def get_daily_stats(child_id: int, days: int = 7, db: Session = Depends(get_db)):
-    """Получить ежедневную статистику для графиков"""
-    from datetime import timedelta, date
-    from sqlalchemy import func, cast, Date
-
-    moscow_tz = pytz.timezone('Europe/Moscow')
-    end_date = datetime.now(moscow_tz).date()
-    start_date = end_date - timedelta(days=days - 1)
-
-    # Статистика сна по дням
-    sleep_by_day = db.query(
-        cast(SleepActivity.start_time, Date).label('date'),
-        func.count(SleepActivity.id).label('count'),
-        func.sum(SleepActivity.duration_minutes).label('total_minutes')
-    ).filter(
-        SleepActivity.child_id == child_id,
-        cast(SleepActivity.start_time, Date) >= start_date,
-        SleepActivity.duration_minutes.isnot(None)
-    ).group_by(cast(SleepActivity.start_time, Date)).all()
-
-    # Кормления по дням
-    feeding_by_day = db.query(
-        cast(FeedingActivity.time, Date).label('date'),
-        func.count(FeedingActivity.id).label('count'),
-        func.sum(FeedingActivity.amount_ml).label('total_ml')
-    ).filter(
-        FeedingActivity.child_id == child_id,
-        cast(FeedingActivity.time, Date) >= start_date
-    ).group_by(cast(FeedingActivity.time, Date)).all()
-
-    # Подгузники по дням
-    diaper_by_day = db.query(
-        cast(DiaperActivity.time, Date).label('date'),
-        func.count(DiaperActivity.id).label('count')
-    ).filter(
-        DiaperActivity.child_id == child_id,
-        cast(DiaperActivity.time, Date) >= start_date
-    ).group_by(cast(DiaperActivity.time, Date)).all()
-
-    # Формируем результат для каждого дня
-    result = []
-    current_date = start_date
-    while current_date <= end_date:
-        sleep_data = next((s for s in sleep_by_day if s.date == current_date), None)
-        feeding_data = next((f for f in feeding_by_day if f.date == current_date), None)
-        diaper_data = next((d for d in diaper_by_day if d.date == current_date), None)
-
-        result.append({
-            "date": current_date.isoformat(),
+def _daily_payload(series: list) -> list:
+    return [
+        {
+            "date": day.day.isoformat(),
             "sleep": {
-                "count": sleep_data.count if sleep_data else 0,
-                "total_hours": round(float(sleep_data.total_minutes or 0) / 60, 1) if sleep_data else 0
+                "count": day.sleep_count,
+                "total_hours": round(day.sleep_minutes / 60, 1)
             },
             "feeding": {
-                "count": feeding_data.count if feeding_data else 0,
-                "total_ml": feeding_data.total_ml if feeding_data else 0
+                "count": day.feeding_count,
+                "total_ml": day.feeding_ml
             },
             "diapers": {
-                "count": diaper_data.count if diaper_data else 0
+                "count": day.diaper_count
             }
-        })
-        current_date += timedelta(days=1)
+        }
+        for day in series
+    ]
+
+
+def _stats_window(days: int, timezone: str):
+    """Те же days календарных дней владельца, что и у _daily_window: с полуночи первого дня до текущего момента"""
+    start_day, _ = _daily_window(days, timezone)
+    start_date = day_bounds(zone_name(timezone), start_day)[0].astimezone(get_zone(timezone))
+    return start_date, local_now(timezone)
+
+
+def _daily_window(days: int, timezone: str):
+    end_date = local_today(timezone)
+    return end_date - timedelta(days=days - 1), end_date
+
+
+def _cache_params(days: int, timezone: str) -> tuple:
+    # Пояс и дата входят в ключ: окна считаются от сегодняшнего дня владельца
+    return days, timezone, local_today(timezone)
+
+
+@app.get("/analytics/child/{child_id}/stats", dependencies=[Depends(not_modified)])
+async def get_child_stats(child_id: int, days: int = Query(7, ge=1, le=MAX_ANALYTICS_DAYS),
+                          version=Depends(child_version)):
+    """Получить статистику за период"""
+    async def compute():
+        start_date, end_date = _stats_window(days, version.timezone)
+        async with read_session_scope(await read_from_primary(child_id, version)) as db:
+            totals = await window_totals(db, child_id, start_date.date(), end_date.date())
+        return _stats_payload(totals, days, start_date, end_date)
+
+    return await analytics_cache.get_or_compute(
+        "stats", child_id, _cache_params(days, version.timezone), version.version, compute
+    )
+
+
+@app.get("/analytics/child/{child_id}/daily", dependencies=[Depends(not_modified)])
+async def get_daily_stats(child_id: int, days: int = Query(7, ge=1, le=MAX_ANALYTICS_DAYS),
+                          version=Depends(child_version)):
+    """Получить ежедневную статистику для графиков"""
+    async def compute():
+        start_date, end_date = _daily_window(days, version.timezone)
+        async with read_session_scope(await read_from_primary(child_id, version)) as db:
+            return _daily_payload(await daily_series(db, child_id, start_date, end_date))
+
+    return await analytics_cache.get_or_compute(
+        "daily", child_id, _cache_params(days, version.timezone), version.version, compute
+    )
+
+
+@app.get("/analytics/cache")
+async def get_analytics_cache_stats():
+    """Счетчики кэша аналитики: попадания, промахи, вытеснения, истекшие и инвалидированные записи"""
+    return analytics_cache.stats()
+
+
+@app.get("/analytics/child/{child_id}/distributions", dependencies=[Depends(not_modified)])
+async def get_distributions(child_id: int, days: int = Query(30, ge=1, le=MAX_ANALYTICS_DAYS),
+                            bin_minutes: int = Query(30, ge=5, le=240), version=Depends(child_version),
+                            db: AsyncSession = Depends(get_read_db)):
+    """
+    Распределения за период: длительность сна, окна бодрствования между снами,
+    промежутки между кормлениями (перцентили p10/p50/p90 и гистограмма, в минутах)
+    """
+    start_date, end_date = _stats_window(days, version.timezone)
+    return {
+        "period_days": days,
+        "start_date": start_date.isoformat(),
+        "end_date": end_date.isoformat(),
+        "bin_minutes": bin_minutes,
+        **await distributions(db, child_id, start_date, end_date, bin_minutes)
+    }
+
+
+@app.get("/analytics/child/{child_id}/predict", dependencies=[Depends(not_modified)])
+async def get_prediction(child_id: int, db: AsyncSession = Depends(get_db)):
+    """
+    Ожидаемое время следующего сна и кормления по сглаженным интервалам ребенка.
+    Модель хранится готовой и обновляется при записи; подбирается по истории, только если ее нет.
+    """
+    try:
+        state, fitted = await load_state(db, child_id)
+        if fitted:
+            await db.commit()
+    except IntegrityError:
+        raise HTTPException(status_code=404, detail="Child not found")
+    return predict(state)
+
+
+async def analytics_children(child_ids: Optional[str] = None, user_id: Optional[int] = None,
+                             db: AsyncSession = Depends(get_db)) -> List[int]:
+    """Дети пакетного запроса: список child_ids через запятую или все дети пользователя user_id"""
+    if (child_ids is None) == (user_id is None):
+        raise HTTPException(status_code=400, detail="Pass either child_ids or user_id")
+    if user_id is not None:
+        return list((await db.execute(
+            select(Child.id).where(Child.user_id == user_id).order_by(Child.id)
+        )).scalars().all())
+
+    try:
+        ids = list(dict.fromkeys(int(value) for value in child_ids.split(",") if value.strip()))
+    except ValueError:
+        raise HTTPException(status_code=400, detail="child_ids must be comma-separated integers")
+    if len(ids) > MAX_ANALYTICS_CHILDREN:
+        raise HTTPException(status_code=400, detail=f"At most {MAX_ANALYTICS_CHILDREN} children per request")
+    return ids
+
+
+async def analytics_children_state(children: List[int] = Depends(analytics_children),
+                                   db: AsyncSession = Depends(get_db)):
+    """Записывали ли кого-то из детей последние секунды и пояса их владельцев - одним запросом к основной базе"""
+    return await children_state(db, children, READ_YOUR_WRITES_SECONDS)
+
+
+async def get_children_read_db(state=Depends(analytics_children_state)):
+    """Сессия пакетной аналитики: реплика, если никого из детей не записывали последние секунды"""
+    recent_write, _ = state
+    async with read_session_scope(use_primary=recent_write) as read_db:
+        yield read_db
+
+
+def _children_windows(children: List[int], state, window) -> dict:
+    """{child_id: окно} пакетного запроса; окно считается один раз на пояс"""
+    _, timezones = state
+    by_timezone, windows = {}, {}
+    for child_id in children:
+        timezone = timezones.get(child_id)
+        if timezone not in by_timezone:
+            by_timezone[timezone] = window(timezone)
+        windows[child_id] = by_timezone[timezone]
+    return windows
+
+
+@app.get("/analytics/children/stats")
+async def get_children_stats(days: int = Query(7, ge=1, le=MAX_ANALYTICS_DAYS),
+                             children: List[int] = Depends(analytics_children),
+                             state=Depends(analytics_children_state),
+                             db: AsyncSession = Depends(get_children_read_db)):
+    """Статистика за период для нескольких детей одним запросом: {child_id: статистика}; окна - в поясах владельцев"""
+    windows = _children_windows(children, state, lambda timezone: _stats_window(days, timezone))
+    totals = await children_window_totals(db, {
+        child_id: (start_date.date(), end_date.date()) for child_id, (start_date, end_date) in windows.items()
+    })
+    return {
+        str(child_id): _stats_payload(child_totals, days, *windows[child_id])
+        for child_id, child_totals in totals.items()
+    }
+
 
-    return result
\ No newline at end of file
+@app.get("/analytics/children/daily")
+async def get_children_daily_stats(days: int = Query(7, ge=1, le=MAX_ANALYTICS_DAYS),
+                                   children: List[int] = Depends(analytics_children),
+                                   state=Depends(analytics_children_state),
+                                   db: AsyncSession = Depends(get_children_read_db)):
+    """Ежедневная статистика для нескольких детей одним запросом: {child_id: [дни]}; дни - в поясах владельцев"""
+    if len(children) * days > MAX_ANALYTICS_POINTS:
+        raise HTTPException(status_code=400, detail=f"children x days must not exceed {MAX_ANALYTICS_POINTS}")
+    windows = _children_windows(children, state, lambda timezone: _daily_window(days, timezone))
+    series = await children_daily_series(db, windows)
+    return {str(child_id): _daily_payload(child_series) for child_id, child_series in series.items()}
+
+
+@app.get("/changes")
+async def get_changes(children: List[int] = Depends(analytics_children), db: AsyncSession = Depends(get_db)):
+    """
+    Изменения активностей детей (child_ids или user_id) потоком server-sent events:
+    ready при подписке, change на каждую закоммиченную вставку или изменение, reset - перечитать данные
+    """
+    if set(children) - (await child_timezones(db, children)).keys():
+        raise HTTPException(status_code=404, detail="Child not found")
+    # Соединение LISTEN открывается до ответа: его ошибка - 5xx, а не оборванный поток
+    await change_feed.start()
+    return StreamingResponse(stream_changes(children), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
@@ -0,0 +1,78 @@
+"""
+Задержка аналитики в зависимости от длины окна.
+
+Гоняет /analytics/.../stats и /analytics/.../daily для окон 7/30/365/1000 дней
+против уже запущенного сервиса. У ребенка должна быть история за нужный период.
+
+Повтор одного URL при включенном кэше аналитики (analytics_cache.py) отдается из кэша и
+меряет только его. Стоимость самого запроса меряется на втором экземпляре сервиса с
+ANALYTICS_CACHE_SIZE=0 (--uncached-base-url); в отчете числа разделены на cached и uncached.
+Режим каждого экземпляра проверяется по /analytics/cache.
+
+    cd activity-service
+    ANALYTICS_CACHE_SIZE=0 uvicorn app:app --port 8004 &
+    python -m bench.analytics_windows --child-id 1 --requests 500 --concurrency 20 \\
+        --uncached-base-url http://127.0.0.1:8004
+"""
+import argparse
+import asyncio
+
+import httpx
+
+from bench.common import run_load, wait_until_ready, write_report
+
+ENDPOINTS = {
+    "stats": "/analytics/child/{child_id}/stats?days={days}",
+    "daily": "/analytics/child/{child_id}/daily?days={days}",
+}
+
+
+async def cache_enabled(base_url: str) -> bool:
+    async with httpx.AsyncClient(base_url=base_url) as client:
+        return (await client.get("/analytics/cache")).json()["max_entries"] > 0
+
+
+async def measure(base_url: str, url: str, requests: int, concurrency: int) -> dict:
+    # Прогрев: соединения, а при включенном кэше - его запись
+    await run_load(base_url, lambda client, i: client.get(url), concurrency, concurrency)
+    return await run_load(base_url, lambda client, i: client.get(url), requests, concurrency)
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--base-url", default="http://127.0.0.1:8003")
+    parser.add_argument("--uncached-base-url", help="экземпляр сервиса с ANALYTICS_CACHE_SIZE=0")
+    parser.add_argument("--child-id", type=int, required=True)
+    parser.add_argument("--windows", default="7,30,365,1000")
+    parser.add_argument("--requests", type=int, default=500)
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--output")
+    args = parser.parse_args()
+
+    # Режим -> сервис; сервис без кэша по --base-url меряет uncached
+    targets = {}
+    await wait_until_ready(args.base_url)
+    targets["cached" if await cache_enabled(args.base_url) else "uncached"] = args.base_url
+    if args.uncached_base_url:
+        await wait_until_ready(args.uncached_base_url)
+        if await cache_enabled(args.uncached_base_url):
+            parser.error(f"{args.uncached_base_url} has the analytics cache enabled, start it with ANALYTICS_CACHE_SIZE=0")
+        if "uncached" in targets:
+            parser.error("both services run without the analytics cache")
+        targets["uncached"] = args.uncached_base_url
+
+    report = {"concurrency": args.concurrency, "modes": sorted(targets), "windows": {}}
+    for days in (int(value) for value in args.windows.split(",")):
+        report["windows"][days] = {
+            mode: {
+                name: await measure(base_url, path.format(child_id=args.child_id, days=days),
+                                    args.requests, args.concurrency)
+                for name, path in ENDPOINTS.items()
+            }
+            for mode, base_url in targets.items()
+        }
+    write_report(report, args.output)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
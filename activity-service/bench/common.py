@@ -0,0 +1,91 @@
+"""
+Общие утилиты нагрузочных замеров activity-service
+"""
+import asyncio
+import json
+import time
+from typing import Awaitable, Callable, List
+
+import httpx
+
+
+def percentile(sorted_values: List[float], q: float) -> float:
+    """Перцентиль по методу ближайшего ранга"""
+    if not sorted_values:
+        return 0.0
+    rank = max(0, min(len(sorted_values) - 1, int(round(q / 100 * len(sorted_values))) - 1))
+    return sorted_values[rank]
+
+
+def summarize(latencies_ms: List[float], errors: int, elapsed_s: float) -> dict:
+    """Сводка замера в машиночитаемом виде"""
+    ordered = sorted(latencies_ms)
+    total = len(ordered) + errors
+    return {
+        "requests": total,
+        "errors": errors,
+        "elapsed_s": round(elapsed_s, 3),
+        "throughput_rps": round(total / elapsed_s, 1) if elapsed_s else 0.0,
+        "p50_ms": round(percentile(ordered, 50), 2),
+        "p95_ms": round(percentile(ordered, 95), 2),
+        "p99_ms": round(percentile(ordered, 99), 2),
+        "max_ms": round(ordered[-1], 2) if ordered else 0.0,
+    }
+
+
+async def run_load(base_url: str, make_request: Callable[[httpx.AsyncClient, int], Awaitable[httpx.Response]],
+                   total: int, concurrency: int, timeout: float = 60.0) -> dict:
+    """
+    Выполняет total запросов, держа в полете не более concurrency одновременно.
+    make_request(client, i) отправляет i-й запрос.
+    """
+    latencies_ms = []
+    errors = 0
+    requests_left = iter(range(total))
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+
+    async with httpx.AsyncClient(base_url=base_url, timeout=timeout, limits=limits) as client:
+        async def worker():
+            nonlocal errors
+            for i in requests_left:
+                started = time.perf_counter()
+                try:
+                    response = await make_request(client, i)
+                except httpx.HTTPError:
+                    errors += 1
+                    continue
+                if response.status_code >= 400:
+                    errors += 1
+                    continue
+                latencies_ms.append((time.perf_counter() - started) * 1000)
+
+        started = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+        elapsed = time.perf_counter() - started
+
+    return summarize(latencies_ms, errors, elapsed)
+
+
+async def wait_until_ready(base_url: str, timeout: float = 30.0):
+    """Ждет, пока сервис начнет отвечать на /"""
+    deadline = time.monotonic() + timeout
+    async with httpx.AsyncClient(base_url=base_url) as client:
+        while True:
+            try:
+                if (await client.get("/")).status_code == 200:
+                    return
+            except httpx.HTTPError:
+                pass
+            if time.monotonic() > deadline:
+                raise RuntimeError(f"{base_url} did not start in {timeout}s")
+            await asyncio.sleep(0.2)
+
+
+def write_report(report: dict, output: str = None):
+    """Печатает отчет JSON в stdout или пишет в файл"""
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    if output:
+        with open(output, "w") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
@@ -0,0 +1,71 @@
+"""
+Сравнение DB_MODE=sync и DB_MODE=async под высокой конкурентностью.
+
+Для каждого режима поднимает отдельный uvicorn с той же DATABASE_URL и гоняет
+чтения /today и /analytics/.../stats. Ребенок должен существовать и иметь данные.
+
+    cd activity-service
+    python -m bench.db_modes --child-id 1 --concurrency 1000 --requests 20000
+"""
+import argparse
+import asyncio
+import os
+import subprocess
+import sys
+
+from bench.common import run_load, wait_until_ready, write_report
+
+SERVICE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+SCENARIOS = {
+    "today": "/activities/child/{child_id}/today",
+    "stats": "/analytics/child/{child_id}/stats?days=7",
+}
+
+
+def start_service(mode: str, port: int) -> subprocess.Popen:
+    env = {**os.environ, "DB_MODE": mode}
+    return subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "app:app", "--host", "127.0.0.1", "--port", str(port),
+         "--log-level", "warning", "--no-access-log"],
+        cwd=SERVICE_DIR, env=env
+    )
+
+
+async def bench_mode(mode: str, port: int, args) -> dict:
+    process = start_service(mode, port)
+    base_url = f"http://127.0.0.1:{port}"
+    try:
+        await wait_until_ready(base_url)
+        results = {}
+        for name, path in SCENARIOS.items():
+            url = path.format(child_id=args.child_id)
+            # Прогрев пула соединений
+            await run_load(base_url, lambda client, i: client.get(url), args.concurrency, args.concurrency)
+            results[name] = await run_load(
+                base_url, lambda client, i: client.get(url), args.requests, args.concurrency
+            )
+        return results
+    finally:
+        process.terminate()
+        process.wait()
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--child-id", type=int, required=True)
+    parser.add_argument("--requests", type=int, default=5000)
+    parser.add_argument("--concurrency", type=int, default=500)
+    parser.add_argument("--modes", default="sync,async")
+    parser.add_argument("--port", type=int, default=8103)
+    parser.add_argument("--output")
+    args = parser.parse_args()
+
+    report = {"concurrency": args.concurrency, "modes": {}}
+    for mode in args.modes.split(","):
+        report["modes"][mode] = await bench_mode(mode, args.port, args)
+    write_report(report, args.output)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
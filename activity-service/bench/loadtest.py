@@ -0,0 +1,168 @@
+"""
+Нагрузочный прогон основных эндпоинтов против уже запущенного сервиса.
+
+Сценарии: чтения дня и аналитики (today, stats, daily), создание кормления, подгузника и
+сна и mixed - взвешенная смесь всех как у живого бота. Каждый сценарий гоняется отдельно
+(--requests запросов, --concurrency одновременно) по детям из отчета bench.seed или --child-ids,
+запрос i идет к ребенку i по кругу. Отчет - p50/p95/p99 и пропускная способность по сценариям
+с версией кода и параметрами прогона.
+
+С --baseline (отчет прошлого прогона) сравниваются p95: сценарий, ставший медленнее больше
+чем на --max-regression, попадает в regressions, и команда завершается с кодом 1.
+
+    cd activity-service
+    python -m bench.seed --users 50 --years 2 --output seed.json
+    python -m bench.loadtest --seed-report seed.json --concurrency 50 --output run.json
+    python -m bench.loadtest --seed-report seed.json --baseline run.json
+"""
+import argparse
+import asyncio
+import json
+import random
+import subprocess
+from datetime import datetime, timedelta, timezone
+
+from bench.common import run_load, wait_until_ready, write_report
+
+
+def _moment(rng: random.Random, hours: float = 12) -> str:
+    # Записи за последние часы: попадают в сегодняшние агрегаты и ленту
+    return (datetime.now(timezone.utc) - timedelta(minutes=rng.uniform(1, hours * 60))).isoformat()
+
+
+def today(client, child_id, rng):
+    return client.get(f"/activities/child/{child_id}/today")
+
+
+def stats(client, child_id, rng):
+    return client.get(f"/analytics/child/{child_id}/stats", params={"days": 7})
+
+
+def daily(client, child_id, rng):
+    return client.get(f"/analytics/child/{child_id}/daily", params={"days": 30})
+
+
+def create_feeding(client, child_id, rng):
+    return client.post("/activities/feeding/", json={
+        "child_id": child_id, "time": _moment(rng), "type": "смесь", "amount_ml": rng.randrange(60, 240, 10)
+    })
+
+
+def create_diaper(client, child_id, rng):
+    return client.post("/activities/diaper/", json={
+        "child_id": child_id, "time": _moment(rng), "type": rng.choice(("pee", "poop", "both"))
+    })
+
+
+def create_sleep(client, child_id, rng):
+    # Закрытый сон: открытый может быть только один на ребенка
+    start = datetime.now(timezone.utc) - timedelta(minutes=rng.uniform(60, 720))
+    end = start + timedelta(minutes=rng.randint(20, 120))
+    return client.post("/activities/sleep/", json={
+        "child_id": child_id, "start_time": start.isoformat(), "end_time": end.isoformat()
+    })
+
+
+SCENARIOS = {scenario.__name__: scenario for scenario in (
+    today, stats, daily, create_feeding, create_diaper, create_sleep
+)}
+
+# Доли запросов в mixed: чтений больше, чем записей
+MIXED_WEIGHTS = {"today": 30, "stats": 20, "daily": 15, "create_feeding": 15, "create_diaper": 15, "create_sleep": 5}
+
+
+def mixed(client, child_id, rng):
+    name = rng.choices(list(MIXED_WEIGHTS), weights=list(MIXED_WEIGHTS.values()))[0]
+    return SCENARIOS[name](client, child_id, rng)
+
+
+SCENARIOS["mixed"] = mixed
+
+
+def parse_child_ids(value: str) -> list:
+    """"1,2,5-9" -> [1, 2, 5, 6, 7, 8, 9]"""
+    child_ids = []
+    for part in value.split(","):
+        first, _, last = part.partition("-")
+        child_ids.extend(range(int(first), int(last or first) + 1))
+    return child_ids
+
+
+def code_version() -> str:
+    try:
+        return subprocess.run(["git", "describe", "--always", "--dirty"], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def regressions(report: dict, baseline: dict, max_regression: float) -> list:
+    """Сценарии, у которых p95 вырос больше чем в 1 + max_regression раз относительно baseline"""
+    found = []
+    for name, result in report["scenarios"].items():
+        previous = baseline.get("scenarios", {}).get(name)
+        if not previous or not previous["p95_ms"]:
+            continue
+        ratio = result["p95_ms"] / previous["p95_ms"]
+        if ratio > 1 + max_regression:
+            found.append({"scenario": name, "baseline_p95_ms": previous["p95_ms"], "p95_ms": result["p95_ms"],
+                          "ratio": round(ratio, 2)})
+    return found
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--base-url", default="http://127.0.0.1:8003")
+    children = parser.add_mutually_exclusive_group(required=True)
+    children.add_argument("--seed-report", help="отчет bench.seed с child_ids")
+    children.add_argument("--child-ids", help="например 1,2,5-9")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS))
+    parser.add_argument("--requests", type=int, default=1000)
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--warmup", type=int, default=50, help="запросов прогрева на сценарий, не в отчете")
+    parser.add_argument("--seed", type=int, default=1, help="случайность тел запросов и смеси mixed")
+    parser.add_argument("--baseline", help="отчет прошлого прогона для сравнения p95")
+    parser.add_argument("--max-regression", type=float, default=0.2)
+    parser.add_argument("--output")
+    args = parser.parse_args()
+
+    if args.seed_report:
+        with open(args.seed_report) as f:
+            child_ids = json.load(f)["child_ids"]
+    else:
+        child_ids = parse_child_ids(args.child_ids)
+    names = args.scenarios.split(",")
+    unknown = [name for name in names if name not in SCENARIOS]
+    if unknown:
+        parser.error(f"unknown scenarios: {', '.join(unknown)}")
+
+    await wait_until_ready(args.base_url)
+    report = {
+        "version": code_version(),
+        "started_at": datetime.now(timezone.utc).isoformat(),
+        "base_url": args.base_url,
+        "children": len(child_ids),
+        "concurrency": args.concurrency,
+        "requests": args.requests,
+        "seed": args.seed,
+        "scenarios": {},
+    }
+    for name in names:
+        def make_request(client, i, name=name, scenario=SCENARIOS[name]):
+            return scenario(client, child_ids[i % len(child_ids)], random.Random(f"{args.seed}:{name}:{i}"))
+
+        if args.warmup:
+            await run_load(args.base_url, make_request, args.warmup, args.concurrency)
+        report["scenarios"][name] = await run_load(args.base_url, make_request, args.requests, args.concurrency)
+
+    exit_code = 0
+    if args.baseline:
+        with open(args.baseline) as f:
+            report["regressions"] = regressions(report, json.load(f), args.max_regression)
+        exit_code = 1 if report["regressions"] else 0
+    write_report(report, args.output)
+    raise SystemExit(exit_code)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,147 @@
+"""
+Проверка числа запросов к БД по маршрутам против бюджетов (SQL_QUERY_BUDGETS, sql_budgets.json).
+
+Приложение поднимается в этом же процессе в строгом режиме трассировки SQL (SQL_TRACE_STRICT):
+запрос, превысивший бюджет своего маршрута, обрывается ошибкой. Скрипт проходит по основным
+эндпоинтам для каждого ребенка (чтения - до и после записей) и завершается
+с кодом 1, если какой-то маршрут вышел за бюджет. Нужна база с историей детей (bench.seed).
+
+Записи проходятся без ключа идемпотентности и с ним, как их шлют бот и NLP сервис, а с ключом
+еще и повторяются. Бюджеты в файле - без накладных запросов записи (рассылка инвалидации у бэкенда
+postgres, захват и сохранение ключа): querytrace добавляет их к бюджету каждого запроса сам, и
+--update пишет бюджеты без них. Проверка гоняется под обоими бэкендами (--backend, иначе
+ANALYTICS_CACHE_BACKEND окружения).
+
+С --update бюджеты не проверяются, а записываются: наблюдаемый максимум по маршрутам.
+Файл коммитится вместе с изменением, которое меняет число запросов.
+
+    cd activity-service
+    python -m bench.query_budgets --child-ids 1-3 --backend local
+    python -m bench.query_budgets --child-ids 1-3 --backend postgres
+    python -m bench.query_budgets --seed-report seed.json --update
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import uuid
+
+import httpx
+
+from bench.common import write_report
+from bench.loadtest import create_diaper, create_feeding, create_sleep, daily, parse_child_ids, stats, today
+
+
+def timeline(client, child_id, rng):
+    return client.get(f"/activities/child/{child_id}/timeline", params={"limit": 200})
+
+
+def activities(client, child_id, rng):
+    return client.get(f"/activities/child/{child_id}")
+
+
+def distributions(client, child_id, rng):
+    return client.get(f"/analytics/child/{child_id}/distributions")
+
+
+def predict(client, child_id, rng):
+    return client.get(f"/analytics/child/{child_id}/predict")
+
+
+def open_sessions(client, child_id, rng):
+    return client.get(f"/children/{child_id}/sessions/open")
+
+
+def children_stats(client, child_id, rng):
+    return client.get("/analytics/children/stats", params={"child_ids": str(child_id)})
+
+
+def start_walk(client, child_id, rng):
+    # Начало и конец прогулки: открытая прогулка у ребенка может быть только одна
+    return client.post(f"/children/{child_id}/sessions/walk/start")
+
+
+def stop_walk(client, child_id, rng):
+    return client.post(f"/children/{child_id}/sessions/walk/stop")
+
+
+# Чтения проходятся до и после записей: холодные, из кэша и после смены версии ребенка
+READS = (today, stats, daily, timeline, activities, distributions, predict, open_sessions, children_stats)
+WRITES = (create_feeding, create_diaper, create_sleep, start_walk, stop_walk)
+
+
+async def _add_key(request: httpx.Request):
+    if request.method != "GET" and "Idempotency-Key" not in request.headers:
+        request.headers["Idempotency-Key"] = uuid.uuid4().hex
+
+
+async def exercise(app, child_ids: list, seed: int) -> list:
+    """Проходит по эндпоинтам; возвращает ошибки 5xx (в строгом режиме - превышения бюджета)"""
+    failures = []
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://budgets") as client, \
+            httpx.AsyncClient(transport=transport, base_url="http://budgets",
+                              event_hooks={"request": [_add_key]}) as keyed:
+        for child_id in child_ids:
+            rng = random.Random(f"{seed}:{child_id}")
+            # Перед записями с ключом - снова чтения: прогноз заново строит модель ребенка, и ее
+            # обновление попадает в самый дорогой путь записи
+            runs = [(client, scenario) for scenario in READS + READS + WRITES + READS] \
+                + [(keyed, scenario) for scenario in WRITES] + [(client, scenario) for scenario in READS]
+            for http, scenario in runs:
+                responses = [await scenario(http, child_id, rng)]
+                if http is keyed:
+                    # Повтор того же запроса с тем же ключом - ответ из idempotency_keys
+                    responses.append(await keyed.send(responses[0].request))
+                for response in responses:
+                    if response.status_code >= 500:
+                        failures.append({"scenario": scenario.__name__, "child_id": child_id,
+                                         "status": response.status_code, "detail": response.text[:500]})
+    return failures
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    children = parser.add_mutually_exclusive_group(required=True)
+    children.add_argument("--seed-report", help="отчет bench.seed с child_ids")
+    children.add_argument("--child-ids", help="например 1,2,5-9")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--backend", choices=("local", "postgres"), help="ANALYTICS_CACHE_BACKEND")
+    parser.add_argument("--update", action="store_true", help="записать наблюдаемые бюджеты вместо проверки")
+    parser.add_argument("--output")
+    args = parser.parse_args()
+
+    if args.seed_report:
+        with open(args.seed_report) as f:
+            child_ids = json.load(f)["child_ids"]
+    else:
+        child_ids = parse_child_ids(args.child_ids)
+
+    # Режим трассировки читается config.py при импорте приложения
+    os.environ["SQL_TRACE"] = "1"
+    os.environ["SQL_TRACE_STRICT"] = "0" if args.update else "1"
+    if args.backend:
+        os.environ["ANALYTICS_CACHE_BACKEND"] = args.backend
+    from analytics_cache import invalidation
+    from app import app
+    from config import SQL_QUERY_BUDGETS
+    from querytrace import stats as sql_stats
+
+    failures = await exercise(app, child_ids, args.seed)
+    if args.update:
+        observed = sql_stats.observed_budgets()
+        with open(SQL_QUERY_BUDGETS, "w") as f:
+            f.write(json.dumps(observed, indent=2) + "\n")
+        write_report({"budgets": SQL_QUERY_BUDGETS, "routes": observed, "failures": failures}, args.output)
+        raise SystemExit(1 if failures else 0)
+
+    routes = sql_stats.report(top=0)["routes"]
+    over_budget = {route: counts for route, counts in routes.items() if counts["over_budget"]}
+    write_report({"backend": invalidation.name, "routes": routes, "over_budget": over_budget,
+                  "failures": failures}, args.output)
+    raise SystemExit(1 if over_budget or failures else 0)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,322 @@
+"""
+Синтетическая история для замеров: N пользователей × M детей × Y лет активностей.
+
+Потоки похожи на настоящие и зависят от возраста ребенка: ночной сон и дневные сны
+по окнам бодрствования (у младенцев ночь прерывается кормлениями), кормления с интервалом
+от 2.5 ч у новорожденного до 4.5 ч после года (грудь/смесь, с полугода - прикорм),
+подгузники 10 в день у новорожденного и меньше с возрастом, прогулки, настроение,
+редкие болезни с температурой и лекарствами. Значения - те же, что описаны в init.sql.
+
+Одинаковый --seed дает одинаковые данные. Строки грузятся COPY по ребенку за транзакцию,
+в ней же пересчитываются дневные агрегаты ребенка; секции месяцев создаются заранее.
+Отчет JSON (id детей, число строк, время) принимает bench.loadtest.
+
+    cd activity-service
+    python -m bench.seed --users 100 --children-per-user 2 --years 2 --output seed.json
+"""
+import argparse
+import asyncio
+import random
+import time
+from datetime import date, datetime, timedelta
+from decimal import Decimal
+
+from sqlalchemy import text
+
+from bench.common import write_report
+from models import copy_records, session_scope
+from partitions import PARTITIONED_TABLES
+from rollups import rebuild_statements
+from timezones import DEFAULT_TIMEZONE, get_zone
+
+# telegram_id синтетических пользователей: не пересекаются с настоящими и между --seed
+TELEGRAM_ID_BASE = 9 * 10 ** 12
+TELEGRAM_IDS_PER_SEED = 10 ** 6
+
+NAMES = {"male": ("Миша", "Саша", "Ваня", "Лёва", "Марк", "Тимофей"),
+         "female": ("Маша", "Аня", "Соня", "Ева", "Алиса", "Вера")}
+SOLID_FOODS = ("каша", "пюре кабачок", "пюре яблоко", "творог", "банан", "суп")
+ANTIPYRETICS = (("Нурофен", "5мл"), ("Парацетамол", "5мл"))
+
+COLUMNS = {
+    "sleep_activities": ("child_id", "start_time", "end_time", "duration_minutes", "quality", "location"),
+    "feeding_activities": ("child_id", "time", "type", "duration_minutes", "amount_ml", "food_name", "side"),
+    "diaper_activities": ("child_id", "time", "type", "consistency"),
+    "walk_activities": ("child_id", "start_time", "end_time", "duration_minutes", "weather", "location"),
+    "temperature_activities": ("child_id", "time", "temperature", "measurement_type"),
+    "medication_activities": ("child_id", "time", "medication_name", "dosage"),
+    "mood_activities": ("child_id", "time", "mood", "intensity"),
+}
+SESSION_TABLES = ("sleep_activities", "walk_activities")
+
+
+def nap_count(age_days: int) -> int:
+    if age_days < 90:
+        return 4
+    if age_days < 180:
+        return 3
+    if age_days < 450:
+        return 2
+    if age_days < 1400:
+        return 1
+    return 0
+
+
+def feeding_interval_hours(age_days: int) -> float:
+    if age_days < 30:
+        return 2.5
+    if age_days < 90:
+        return 3.0
+    if age_days < 180:
+        return 3.5
+    if age_days < 365:
+        return 4.0
+    return 4.5
+
+
+def night_feedings(age_days: int) -> int:
+    if age_days < 90:
+        return 3
+    if age_days < 180:
+        return 2
+    if age_days < 365:
+        return 1
+    return 0
+
+
+def diapers_per_day(age_days: int) -> int:
+    if age_days < 90:
+        return 10
+    if age_days < 365:
+        return 8
+    if age_days < 730:
+        return 6
+    return 4
+
+
+class ChildHistory:
+    """Генератор строк одного ребенка; дни идут подряд, ночь переходит в утро следующего дня"""
+
+    def __init__(self, rng: random.Random, child_id: int, birth_date: date, breastfed: bool):
+        self.rng = rng
+        self.child_id = child_id
+        self.birth_date = birth_date
+        self.breastfed = breastfed
+        self.rows = {table: [] for table in COLUMNS}
+        self.sick_days_left = 0
+        self.side = "левая"
+
+    def at(self, day: date, hours: float) -> datetime:
+        moment = datetime.combine(day, datetime.min.time()) + timedelta(hours=hours)
+        return get_zone(DEFAULT_TIMEZONE).localize(moment)
+
+    def jitter(self, minutes: float) -> timedelta:
+        return timedelta(minutes=self.rng.gauss(0, minutes))
+
+    def _session(self, table: str, start: datetime, end: datetime, *extra):
+        self.rows[table].append((self.child_id, start, end, int((end - start).total_seconds() / 60)) + extra)
+
+    def _feeding(self, moment: datetime, age_days: int):
+        rng = self.rng
+        solids = age_days >= 180 and rng.random() < min(0.8, (age_days - 150) / 400)
+        if solids:
+            row = ("прикорм", None, rng.randrange(80, 220, 10), rng.choice(SOLID_FOODS), None)
+        elif self.breastfed:
+            self.side = "правая" if self.side == "левая" else "левая"
+            row = ("грудь", rng.randint(8, 25), None, None, self.side)
+        else:
+            amount = min(240, 60 + age_days * 0.8)
+            row = ("смесь", None, int(rng.gauss(amount, 15)) // 10 * 10, None, None)
+        self.rows["feeding_activities"].append((self.child_id, moment) + row)
+
+    def day(self, day: date, wake: datetime) -> datetime:
+        """Строки дня с утреннего подъема wake; возвращает подъем следующего утра"""
+        rng = self.rng
+        age_days = (day - self.birth_date).days
+        bedtime = self.at(day, 20 + (0.5 if age_days > 730 else 0)) + self.jitter(30)
+
+        # Дневные сны делят время бодрствования на равные окна
+        naps = nap_count(age_days)
+        nap_minutes = 120 if age_days > 450 else 75 if age_days > 180 else 50
+        awake_window = ((bedtime - wake) - timedelta(minutes=naps * nap_minutes)) / (naps + 1)
+        cursor = wake
+        for _ in range(naps):
+            start = cursor + awake_window + self.jitter(15)
+            end = start + timedelta(minutes=max(20.0, rng.gauss(nap_minutes, nap_minutes / 4)))
+            self._session("sleep_activities", start, end, rng.choice(("хорошо", "хорошо", "беспокойно")),
+                          rng.choice(("кроватка", "коляска", "на руках")))
+            cursor = end
+
+        # Дневные кормления по интервалу, ночные - в пробуждениях
+        interval = timedelta(hours=feeding_interval_hours(age_days))
+        moment = wake + timedelta(minutes=rng.randint(5, 30))
+        while moment < bedtime:
+            self._feeding(moment, age_days)
+            moment += interval + self.jitter(20)
+
+        night_hours = 10.0 if age_days < 90 else 11.0 if age_days < 1100 else 10.5
+        next_wake = bedtime + timedelta(hours=night_hours) + self.jitter(30)
+        wakings = night_feedings(age_days)
+        segment = (next_wake - bedtime) / (wakings + 1)
+        start = bedtime
+        for index in range(wakings + 1):
+            end = next_wake if index == wakings else bedtime + segment * (index + 1) + self.jitter(20)
+            self._session("sleep_activities", start, end, "хорошо" if wakings == 0 else "беспокойно", "кроватка")
+            if index < wakings:
+                self._feeding(end + timedelta(minutes=5), age_days)
+                start = end + timedelta(minutes=rng.randint(20, 40))
+
+        # Подгузники: равномерно за сутки, у младенцев чаще стул
+        baby = age_days < 180
+        for _ in range(max(1, int(rng.gauss(diapers_per_day(age_days), 1)))):
+            moment = wake + (next_wake - wake) * rng.random()
+            kind = rng.choices(("pee", "poop", "both"), weights=(55, 15, 30) if baby else (70, 20, 10))[0]
+            consistency = None
+            if kind != "pee":
+                consistency = rng.choices(("жидкий", "нормальный", "твердый"),
+                                          weights=(60, 40, 0) if baby else (10, 75, 15))[0]
+            self.rows["diaper_activities"].append((self.child_id, moment, kind, consistency))
+
+        sick = self._sickness(day)
+        walks = 0 if sick else 1 + (rng.random() < 0.3)
+        for _ in range(walks):
+            start = self.at(day, rng.uniform(10, 17.5))
+            end = start + timedelta(minutes=rng.randint(30, 120))
+            self._session("walk_activities", start, end, rng.choice(("солнечно", "облачно", "дождь", "снег")),
+                          rng.choice(("парк", "двор", "набережная")))
+
+        for _ in range(rng.randint(1, 3)):
+            mood = rng.choices(("веселое", "спокойное", "капризное", "плачет"),
+                               weights=(10, 30, 40, 20) if sick else (40, 40, 15, 5))[0]
+            self.rows["mood_activities"].append(
+                (self.child_id, wake + (bedtime - wake) * rng.random(), mood, rng.randint(1, 5))
+            )
+        return next_wake
+
+    def _sickness(self, day: date) -> bool:
+        """Болезнь раз в полтора месяца: 2-4 дня температуры и жаропонижающее"""
+        rng = self.rng
+        if not self.sick_days_left and rng.random() < 1 / 45:
+            self.sick_days_left = rng.randint(2, 4)
+        if not self.sick_days_left:
+            if rng.random() < 0.05:
+                temperature = Decimal(str(round(rng.uniform(36.4, 36.9), 1)))
+                self.rows["temperature_activities"].append(
+                    (self.child_id, self.at(day, rng.uniform(8, 20)), temperature, "подмышка")
+                )
+            return False
+        self.sick_days_left -= 1
+        method = "ректально" if (day - self.birth_date).days < 365 else rng.choice(("подмышка", "лоб"))
+        for hours in sorted(rng.uniform(7, 22) for _ in range(rng.randint(2, 4))):
+            moment = self.at(day, hours)
+            temperature = Decimal(str(round(rng.uniform(37.2, 39.4), 1)))
+            self.rows["temperature_activities"].append((self.child_id, moment, temperature, method))
+            if temperature >= 38.5:
+                name, dosage = rng.choice(ANTIPYRETICS)
+                self.rows["medication_activities"].append(
+                    (self.child_id, moment + timedelta(minutes=5), name, dosage)
+                )
+        return True
+
+
+def generate(rng: random.Random, child_id: int, birth_date: date, first_day: date, now: datetime) -> dict:
+    """Строки активностей ребенка с first_day (не раньше рождения) по now"""
+    history = ChildHistory(rng, child_id, birth_date, breastfed=rng.random() < 0.6)
+    day = max(first_day, birth_date)
+    wake = history.at(day, 7) + history.jitter(30)
+    while day <= now.date():
+        wake = history.day(day, wake)
+        day += timedelta(days=1)
+    # Будущего не бывает: день и ночь обрезаются текущим моментом
+    return {
+        # У сессий сравнивается конец (row[2]), у точечных активностей - время (row[1])
+        table: [row for row in table_rows if row[2 if table in SESSION_TABLES else 1] <= now]
+        for table, table_rows in history.rows.items()
+    }
+
+
+def months(first_day: date, last_day: date) -> list:
+    month = first_day.replace(day=1)
+    result = []
+    while month <= last_day:
+        result.append(month)
+        month = (month + timedelta(days=32)).replace(day=1)
+    return result
+
+
+async def seed(seed_value: int, users: int, children_per_user: int, years: float) -> dict:
+    rng = random.Random(seed_value)
+    now = datetime.now(get_zone(DEFAULT_TIMEZONE))
+    first_day = now.date() - timedelta(days=int(years * 365))
+    telegram_base = TELEGRAM_ID_BASE + seed_value * TELEGRAM_IDS_PER_SEED
+    started = time.perf_counter()
+
+    async with session_scope() as db:
+        existing = await db.scalar(text(
+            "SELECT count(*) FROM users WHERE telegram_id >= :first AND telegram_id < :last"
+        ), {"first": telegram_base, "last": telegram_base + TELEGRAM_IDS_PER_SEED})
+        if existing:
+            raise SystemExit(f"Seed {seed_value} is already loaded ({existing} users), use another --seed")
+        children = []
+        for index in range(users):
+            user_id = await db.scalar(text(
+                "INSERT INTO users (telegram_id, username, first_name) VALUES (:telegram_id, :username, :name) "
+                "RETURNING id"
+            ), {"telegram_id": telegram_base + index, "username": f"bench_{seed_value}_{index}", "name": "Bench"})
+            for _ in range(children_per_user):
+                gender = rng.choice(("male", "female"))
+                # Часть детей родилась до начала истории, часть - в ее первые месяцы
+                birth_date = first_day + timedelta(days=rng.randint(-365, 120))
+                child_id = await db.scalar(text(
+                    "INSERT INTO children (user_id, name, birth_date, gender) "
+                    "VALUES (:user_id, :name, :birth_date, :gender) RETURNING id"
+                ), {"user_id": user_id, "name": rng.choice(NAMES[gender]), "birth_date": birth_date,
+                    "gender": gender})
+                children.append((child_id, birth_date))
+        for table_name in PARTITIONED_TABLES:
+            for month in months(first_day - timedelta(days=1), now.date()):
+                await db.execute(text("SELECT create_activity_partition(:parent, :month)"),
+                                 {"parent": table_name, "month": month})
+        await db.commit()
+
+    counts = dict.fromkeys(COLUMNS, 0)
+    for child_id, birth_date in children:
+        rows = await asyncio.to_thread(generate, random.Random(rng.random()), child_id, birth_date, first_day, now)
+        async with session_scope() as db:
+            for table_name, table_rows in rows.items():
+                await copy_records(db, table_name, list(COLUMNS[table_name]), table_rows)
+                counts[table_name] += len(table_rows)
+            for statement, params in rebuild_statements(child_id):
+                await db.execute(statement, params)
+            await db.commit()
+
+    elapsed = time.perf_counter() - started
+    total = sum(counts.values())
+    return {
+        "seed": seed_value,
+        "users": users,
+        "children_per_user": children_per_user,
+        "years": years,
+        "first_day": first_day.isoformat(),
+        "child_ids": [child_id for child_id, _ in children],
+        "rows": counts,
+        "total_rows": total,
+        "elapsed_s": round(elapsed, 3),
+        "rows_per_s": round(total / elapsed, 1) if elapsed else 0.0,
+    }
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--users", type=int, default=10)
+    parser.add_argument("--children-per-user", type=int, default=1)
+    parser.add_argument("--years", type=float, default=1)
+    parser.add_argument("--output")
+    args = parser.parse_args()
+
+    write_report(await seed(args.seed, args.users, args.children_per_user, args.years), args.output)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
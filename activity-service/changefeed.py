@@ -0,0 +1,151 @@
+"""
+Лента изменений активностей детей: server-sent events на GET /changes.
+
+Триггеры таблиц активностей (миграция 010) после вставки и изменения шлют NOTIFY
+activity_changes: по уведомлению на ребенка за оператор, с типом, операцией, числом строк
+и первыми строками (id и время). Уведомления приходят после коммита.
+
+Процесс держит одно соединение asyncpg с LISTEN, сколько бы ни было подписчиков: оно
+открывается с первой подпиской и раздает уведомления очередям подписчиков по child_id.
+Полезная нагрузка пересылается как есть, без повторной сериализации.
+
+Подписчик, который не успевает читать и переполнил очередь, получает событие reset вместо
+пропущенных: ему нужно перечитать данные сам. При разрыве соединения с базой все потоки
+получают reset и закрываются; клиент переподключается, и соединение открывается заново.
+
+Поток живет не дольше CHANGE_FEED_MAX_SECONDS и закрывается событием reconnect: uvicorn при
+остановке и перезагрузке ждет открытые ответы, и бесконечный поток не дал бы ему завершиться.
+Изменения, закоммиченные между потоками, клиент не получит - лента только для уведомлений,
+полные данные читаются обычными эндпоинтами.
+"""
+import asyncio
+import logging
+import time
+from typing import Dict, Iterable, Optional, Set
+
+import asyncpg
+import orjson
+
+from config import CHANGE_FEED_HEARTBEAT, CHANGE_FEED_MAX_SECONDS, CHANGE_FEED_QUEUE_SIZE, DATABASE_URL
+from metrics import CHANGE_FEED_EVENTS, CHANGE_FEED_SUBSCRIBERS
+
+logger = logging.getLogger(__name__)
+
+CHANNEL = "activity_changes"
+
+# Маркеры в очереди подписчика вместо уведомления
+RESET = object()
+CLOSED = object()
+
+
+class Subscription:
+    """Подписка на изменения детей; уведомления - строки JSON из NOTIFY"""
+
+    def __init__(self, child_ids: Iterable[int], queue_size: int):
+        self.child_ids = frozenset(child_ids)
+        self.queue = asyncio.Queue(maxsize=queue_size)
+
+    def push(self, item):
+        if self.queue.full():
+            # Пропущенные изменения все равно придется перечитать: очередь заменяется одним reset
+            while not self.queue.empty():
+                self.queue.get_nowait()
+            item = RESET if item is not CLOSED else CLOSED
+        self.queue.put_nowait(item)
+
+
+class ChangeFeed:
+    """Одно соединение LISTEN на процесс и подписчики по child_id"""
+
+    def __init__(self, queue_size: int):
+        self.queue_size = queue_size
+        self._subscribers: Dict[int, Set[Subscription]] = {}
+        self._connection: Optional[asyncpg.Connection] = None
+        self._lock = asyncio.Lock()
+
+    async def start(self):
+        """Открывает соединение с LISTEN, если его еще нет"""
+        async with self._lock:
+            if self._connection is not None and not self._connection.is_closed():
+                return
+            connection = await asyncpg.connect(DATABASE_URL)
+            connection.add_termination_listener(self._on_terminate)
+            await connection.add_listener(CHANNEL, self._on_notify)
+            self._connection = connection
+
+    async def subscribe(self, child_ids: Iterable[int]) -> Subscription:
+        """Подписка начинает получать изменения, закоммиченные после возврата"""
+        await self.start()
+        subscription = Subscription(child_ids, self.queue_size)
+        for child_id in subscription.child_ids:
+            self._subscribers.setdefault(child_id, set()).add(subscription)
+        CHANGE_FEED_SUBSCRIBERS.inc()
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription):
+        for child_id in subscription.child_ids:
+            subscribers = self._subscribers.get(child_id)
+            if subscribers is not None:
+                subscribers.discard(subscription)
+                if not subscribers:
+                    del self._subscribers[child_id]
+        CHANGE_FEED_SUBSCRIBERS.dec()
+
+    def _on_notify(self, connection, pid, channel, payload):
+        CHANGE_FEED_EVENTS.inc()
+        subscribers = self._subscribers.get(orjson.loads(payload)["child_id"])
+        for subscription in subscribers or ():
+            subscription.push(payload)
+
+    def _on_terminate(self, connection):
+        logger.warning("change feed connection lost, closing %d streams", len(self._all()))
+        self._connection = None
+        for subscription in self._all():
+            subscription.push(RESET)
+            subscription.push(CLOSED)
+
+    def _all(self) -> Set[Subscription]:
+        return set().union(*self._subscribers.values())
+
+    async def stop(self):
+        for subscription in self._all():
+            subscription.push(CLOSED)
+        if self._connection is not None:
+            connection, self._connection = self._connection, None
+            connection.remove_termination_listener(self._on_terminate)
+            await connection.close()
+
+
+def _event(name: str, data: bytes) -> bytes:
+    return b"event: " + name.encode() + b"\ndata: " + data + b"\n\n"
+
+
+async def stream_changes(child_ids: Iterable[int]):
+    """Тело text/event-stream: ready, затем change и reset, в конце reconnect; комментарий раз
+    в CHANGE_FEED_HEARTBEAT секунд держит соединение и замечает отключившихся клиентов.
+    Подписка живет, пока идет поток"""
+    subscription = await feed.subscribe(child_ids)
+    deadline = time.monotonic() + CHANGE_FEED_MAX_SECONDS
+    try:
+        yield _event("ready", orjson.dumps({"child_ids": sorted(subscription.child_ids)}))
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                yield _event("reconnect", b"{}")
+                return
+            try:
+                item = await asyncio.wait_for(subscription.queue.get(), min(CHANGE_FEED_HEARTBEAT, remaining))
+            except asyncio.TimeoutError:
+                yield b": keepalive\n\n"
+                continue
+            if item is CLOSED:
+                return
+            if item is RESET:
+                yield _event("reset", b"{}")
+            else:
+                yield _event("change", item.encode())
+    finally:
+        feed.unsubscribe(subscription)
+
+
+feed = ChangeFeed(CHANGE_FEED_QUEUE_SIZE)
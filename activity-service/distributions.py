@@ -0,0 +1,79 @@
+"""
+Распределения интервалов ребенка: длительность сна, окна бодрствования, промежутки между кормлениями.
+
+Все считается одним запросом в БД: интервалы - оконной функцией LAG по индексу
+(child_id, время), перцентили - percentile_cont, гистограмма - группировкой по корзинам
+фиксированной ширины. Клиенту уходят только сводки, а не сырая история.
+"""
+from datetime import datetime
+
+from sqlalchemy import text
+from sqlalchemy.dialects.postgresql import JSONB
+
+DISTRIBUTION_METRICS = ("sleep_duration", "wake_window", "feeding_interval")
+PERCENTILES = (0.1, 0.5, 0.9)
+
+# Нулевые и отрицательные интервалы (дубли записей, пересекающийся сон) в выборку не попадают
+DISTRIBUTIONS_SQL = text("""
+WITH sleeps AS (
+    SELECT duration_minutes,
+           extract(epoch FROM start_time - lag(end_time) OVER (ORDER BY start_time)) / 60 AS wake_minutes
+    FROM sleep_activities
+    WHERE child_id = :child_id AND start_time >= :start_time AND start_time < :end_time
+), feedings AS (
+    SELECT extract(epoch FROM time - lag(time) OVER (ORDER BY time)) / 60 AS interval_minutes
+    FROM feeding_activities
+    WHERE child_id = :child_id AND time >= :start_time AND time < :end_time
+), samples AS (
+    SELECT 'sleep_duration' AS metric, duration_minutes::float8 AS minutes FROM sleeps WHERE duration_minutes > 0
+    UNION ALL
+    SELECT 'wake_window', wake_minutes::float8 FROM sleeps WHERE wake_minutes > 0
+    UNION ALL
+    SELECT 'feeding_interval', interval_minutes::float8 FROM feedings WHERE interval_minutes > 0
+), summary AS (
+    SELECT metric, count(*) AS count,
+           percentile_cont(CAST(:percentiles AS float8[])) WITHIN GROUP (ORDER BY minutes) AS percentiles,
+           min(minutes) AS min, max(minutes) AS max, avg(minutes) AS avg
+    FROM samples
+    GROUP BY metric
+), buckets AS (
+    SELECT metric, floor(minutes / CAST(:bin_minutes AS integer))::integer AS bucket, count(*) AS count
+    FROM samples
+    GROUP BY 1, 2
+), histograms AS (
+    SELECT metric, jsonb_agg(jsonb_build_object(
+               'from_minutes', bucket * CAST(:bin_minutes AS integer),
+               'to_minutes', (bucket + 1) * CAST(:bin_minutes AS integer),
+               'count', count
+           ) ORDER BY bucket) AS histogram
+    FROM buckets
+    GROUP BY metric
+)
+SELECT * FROM summary JOIN histograms USING (metric)
+""").columns(histogram=JSONB)
+
+
+def _minutes(value):
+    return round(float(value), 1) if value is not None else None
+
+
+async def distributions(db, child_id: int, start_time: datetime, end_time: datetime, bin_minutes: int) -> dict:
+    """{метрика: count, p10/p50/p90, min/max/avg в минутах и гистограмма}; пустые метрики с count 0"""
+    rows = {row.metric: row for row in await db.execute(DISTRIBUTIONS_SQL, {
+        "child_id": child_id, "start_time": start_time, "end_time": end_time,
+        "percentiles": list(PERCENTILES), "bin_minutes": bin_minutes
+    })}
+
+    result = {}
+    for metric in DISTRIBUTION_METRICS:
+        row = rows.get(metric)
+        percentiles = row.percentiles if row else [None] * len(PERCENTILES)
+        result[metric] = {
+            "count": row.count if row else 0,
+            **{f"p{round(p * 100)}": _minutes(value) for p, value in zip(PERCENTILES, percentiles)},
+            "min": _minutes(row.min) if row else None,
+            "max": _minutes(row.max) if row else None,
+            "avg": _minutes(row.avg) if row else None,
+            "histogram": row.histogram if row else [],
+        }
+    return result
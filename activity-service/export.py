@@ -0,0 +1,141 @@
+"""
+Выгрузка дневника ребенка в CSV и Parquet.
+
+Строки читаются из ленты (timeline.stream_timeline) серверным курсором пачками по
+EXPORT_CHUNK_ROWS и сразу отдаются клиенту: CSV - строками, Parquet - группой строк
+(row group) на пачку. В памяти одновременно только одна пачка, поэтому выгрузка
+многолетней истории не собирает ее целиком.
+
+Колонки - объединение колонок выбранных типов активностей; у строки другого типа
+чужие колонки пустые. pyarrow нужен только для Parquet и импортируется при первой выгрузке.
+"""
+import csv
+import io
+from datetime import date, datetime
+from typing import List, Optional
+
+from sqlalchemy import Date, DateTime, Integer, Numeric
+
+from activity_types import ActivityType
+from timeline import stream_timeline
+
+EXPORT_CHUNK_ROWS = 5000
+
+# Колонки ленты, которые идут первыми в любой выгрузке
+LEADING_COLUMNS = ("activity_type", "id", "time", "child_id")
+
+
+def export_columns(types: List[ActivityType]) -> list:
+    """(имя, колонка SQLAlchemy или None) в порядке выгрузки"""
+    columns = {"activity_type": None, "time": None}
+    for activity in types:
+        for column in activity.model.__table__.c:
+            columns.setdefault(column.name, column)
+    ordered = [name for name in LEADING_COLUMNS if name in columns]
+    ordered += [name for name in columns if name not in LEADING_COLUMNS]
+    return [(name, columns[name]) for name in ordered]
+
+
+def _export_rows(rows):
+    # time - в том же ISO 8601, что и остальные даты из JSON строки
+    for row in rows:
+        yield {**row.data, "activity_type": row.activity_type, "time": row.time.isoformat()}
+
+
+async def csv_chunks(db, child_id: int, start: Optional[datetime], end: Optional[datetime],
+                     types: List[ActivityType]):
+    """CSV с заголовком, по куску на пачку строк"""
+    names = [name for name, _ in export_columns(types)]
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=names, extrasaction="ignore")
+    writer.writeheader()
+    async for rows in stream_timeline(db, child_id, start, end, types, batch_size=EXPORT_CHUNK_ROWS):
+        writer.writerows(_export_rows(rows))
+        yield buffer.getvalue().encode()
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue().encode()
+
+
+def parquet_available() -> bool:
+    try:
+        import pyarrow  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+class _ChunkSink(io.RawIOBase):
+    """Файл для ParquetWriter: копит записанное до drain, позиция - от начала файла"""
+
+    def __init__(self):
+        self._chunks = []
+        self._position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        self._position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._position
+
+    def drain(self) -> bytes:
+        data = b"".join(self._chunks)
+        self._chunks.clear()
+        return data
+
+
+def _arrow_type(pa, column):
+    # column None - общее время ленты time
+    if column is None or isinstance(column.type, DateTime):
+        return pa.timestamp("us", tz="UTC")
+    if isinstance(column.type, Date):
+        return pa.date32()
+    if isinstance(column.type, Numeric):
+        return pa.float64()
+    if isinstance(column.type, Integer):
+        return pa.int64()
+    return pa.string()
+
+
+def _converter(arrow_type, pa):
+    # В JSON строки ленты даты и время приходят строками ISO 8601
+    if pa.types.is_timestamp(arrow_type):
+        return lambda value: value if value is None or isinstance(value, datetime) else datetime.fromisoformat(value)
+    if pa.types.is_date32(arrow_type):
+        return lambda value: value if value is None or isinstance(value, date) else date.fromisoformat(value)
+    if pa.types.is_floating(arrow_type):
+        return lambda value: None if value is None else float(value)
+    return lambda value: value
+
+
+async def parquet_chunks(db, child_id: int, start: Optional[datetime], end: Optional[datetime],
+                         types: List[ActivityType]):
+    """Parquet по группе строк на пачку; метаданные файла - в последнем куске"""
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    columns = export_columns(types)
+    schema = pa.schema([
+        (name, pa.string() if name == "activity_type" else _arrow_type(pa, column)) for name, column in columns
+    ])
+    converters = [_converter(field.type, pa) for field in schema]
+
+    sink = _ChunkSink()
+    writer = pq.ParquetWriter(sink, schema, compression="zstd")
+    try:
+        async for rows in stream_timeline(db, child_id, start, end, types, batch_size=EXPORT_CHUNK_ROWS):
+            entries = list(_export_rows(rows))
+            writer.write_table(pa.table([
+                pa.array([convert(entry.get(field.name)) for entry in entries], type=field.type)
+                for field, convert in zip(schema, converters)
+            ], schema=schema))
+            yield sink.drain()
+    finally:
+        writer.close()
+    yield sink.drain()
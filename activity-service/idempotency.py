@@ -0,0 +1,107 @@
+"""
+Ключи идемпотентности (Idempotency-Key) для создающих эндпоинтов.
+
+Ключ занимается в той же транзакции, что и сама запись, и там же сохраняется ответ.
+Повтор с тем же ключом получает сохраненный ответ с тем же кодом статуса; параллельный повтор (hedged request)
+ждет на вставке ключа, пока первая транзакция не зафиксируется или не откатится.
+Ошибки не сохраняются: откат снимает и ключ, повтор выполнит запрос заново.
+
+Просроченные ключи удаляются по cron:
+
+    python idempotency.py purge
+"""
+import argparse
+import hashlib
+from datetime import timedelta
+
+from sqlalchemy import delete, func, select, update
+from sqlalchemy.dialects.postgresql import insert
+
+from config import IDEMPOTENCY_TTL_HOURS
+from models import IdempotencyKey
+
+IDEMPOTENCY_TTL = timedelta(hours=IDEMPOTENCY_TTL_HOURS)
+
+
+class IdempotentReplay(Exception):
+    """Запрос с этим ключом уже выполнен: вернуть сохраненный ответ с его кодом статуса"""
+
+    def __init__(self, response, status_code: int = 200):
+        self.response = response
+        self.status_code = status_code
+
+
+class IdempotencyConflict(Exception):
+    """Ключ занят другим запросом (другой эндпоинт или тело) или его ответ недоступен"""
+
+    def __init__(self, status_code: int, detail: str):
+        self.status_code = status_code
+        self.detail = detail
+
+
+def request_hash(query: str, body: bytes) -> str:
+    return hashlib.sha256(query.encode() + b"|" + body).hexdigest()
+
+
+async def claim_key(db, key: str, endpoint: str, digest: str):
+    """
+    Занимает ключ для запроса. Если запрос с этим ключом уже выполнен,
+    бросает IdempotentReplay с его ответом; при несовпадении запроса - IdempotencyConflict.
+    """
+    table = IdempotencyKey.__table__
+    stmt = insert(table).values(key=key, endpoint=endpoint, request_hash=digest)
+    # Просроченный ключ занимается заново, как новый
+    claimed = (await db.execute(stmt.on_conflict_do_update(
+        index_elements=[table.c.key],
+        set_={"endpoint": endpoint, "request_hash": digest, "response": None, "status_code": None,
+              "created_at": func.now()},
+        where=table.c.created_at < func.now() - IDEMPOTENCY_TTL
+    ).returning(table.c.key))).first()
+    if claimed is not None:
+        return
+
+    stored = (await db.execute(
+        select(table.c.endpoint, table.c.request_hash, table.c.response, table.c.status_code)
+        .where(table.c.key == key)
+    )).first()
+    if stored is None or stored.response is None:
+        # Строку успели удалить purge между вставкой и чтением - клиенту стоит повторить
+        raise IdempotencyConflict(409, "Request with this Idempotency-Key is being processed, retry later")
+    if stored.endpoint != endpoint or stored.request_hash != digest:
+        raise IdempotencyConflict(422, "Idempotency-Key was already used for a different request")
+    # Ответы, сохраненные до колонки status_code, были 200
+    raise IdempotentReplay(stored.response, stored.status_code or 200)
+
+
+async def remember_response(db, key, response, status_code: int = 200):
+    """
+    Сохраняет ответ и его код статуса под занятым ключом; коммит за вызывающим. Без ключа ничего не делает.
+    status_code - код, с которым отвечает эндпоинт (202 у импорта), его же получит повтор.
+    """
+    if key is None:
+        return
+    table = IdempotencyKey.__table__
+    await db.execute(update(table).where(table.c.key == key).values(response=response, status_code=status_code))
+
+
+def purge() -> int:
+    """Удаляет просроченные ключи; возвращает их число"""
+    from models import engine
+
+    table = IdempotencyKey.__table__
+    with engine.begin() as connection:
+        return connection.execute(delete(table).where(table.c.created_at < func.now() - IDEMPOTENCY_TTL)).rowcount
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Обслуживание idempotency_keys")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    subparsers.add_parser("purge", help=f"удалить ключи старше {IDEMPOTENCY_TTL_HOURS} ч")
+    args = parser.parse_args()
+
+    if args.command == "purge":
+        print(f"purged {purge()} idempotency keys")
+
+
+if __name__ == "__main__":
+    main()
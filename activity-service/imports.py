@@ -0,0 +1,307 @@
+"""
+Импорт истории ребенка из CSV/JSON: выгрузки других дневников или своя выгрузка /export.
+
+Файл принимается целиком, задание выполняется в фоне, прогресс пишется в import_jobs:
+  validating - строки проверяются пачками по IMPORT_BATCH_ROWS; каждая колонка пачки
+               разбирается целиком по типу колонки модели, ошибки копятся по строкам;
+  loading    - верные строки грузятся COPY одной транзакцией; в ней же один раз
+               обновляются производные данные: дневные агрегаты, версия ребенка
+               (ETag и кэш аналитики) и модель прогноза;
+  done или failed.
+Строки с ошибками пропускаются и попадают в файл ошибок IMPORT_DIR/import-<id>-errors.csv:
+номер строки, тип, колонка, сообщение и исходная строка.
+
+Формат строк - как у /export: колонка activity_type и колонки таблиц активностей
+(JSON - массив объектов или NDJSON). Колонки и названия типов другого приложения
+переименовываются параметрами columns и types ("Start:time,End:end_time"); время
+активности на оси ленты можно передать как time, так и start_time. Время без часового
+пояса считается временем tz.
+"""
+import csv
+import io
+import json
+import os
+from datetime import datetime
+from decimal import Decimal
+from typing import Dict, NamedTuple, Optional
+
+import pytz
+from sqlalchemy import DateTime, Integer, Numeric, String, func, text, update
+from starlette.concurrency import run_in_threadpool
+
+from activity_types import ACTIVITY_TYPES, duration_minutes
+from config import IMPORT_DIR
+from models import ImportJob, copy_records, session_scope
+from partitions import PARTITIONED_TABLES, PARTITION_TZ
+from predictions import forget
+from rollups import activity_contribution, apply_rollups
+from sessions import SESSION_KINDS
+from versions import bump_versions
+
+IMPORT_BATCH_ROWS = 10000
+
+# Колонки, которые не берутся из файла: id и время создания новые, ребенок - из запроса
+SKIPPED_COLUMNS = ("id", "child_id", "conversation_id", "created_at")
+
+INT4_MAX = 2 ** 31 - 1
+
+
+class ImportOptions(NamedTuple):
+    format: str  # csv или json
+    activity_type: Optional[str]  # тип строк без колонки activity_type
+    columns: Dict[str, str]  # переименование колонок файла
+    types: Dict[str, str]  # переименование значений activity_type
+    tz: str  # часовой пояс времени без смещения
+
+
+def parse_mapping(value: Optional[str]) -> Dict[str, str]:
+    """Разбирает переименования вида "Start:start_time,End:end_time" """
+    mapping = {}
+    for pair in (value or "").split(","):
+        if not pair.strip():
+            continue
+        source, separator, target = pair.partition(":")
+        if not separator or not source.strip() or not target.strip():
+            raise ValueError(f"Invalid mapping: {pair}")
+        mapping[source.strip()] = target.strip()
+    return mapping
+
+
+def import_columns(activity) -> list:
+    return [column for column in activity.model.__table__.c if column.name not in SKIPPED_COLUMNS]
+
+
+def parse_records(body: bytes, export_format: str) -> list:
+    content = body.decode("utf-8-sig")
+    if export_format == "csv":
+        return list(csv.DictReader(io.StringIO(content)))
+    content = content.lstrip()
+    if content.startswith("["):
+        records = json.loads(content)
+    else:
+        records = [json.loads(line) for line in content.splitlines() if line.strip()]
+    if not all(isinstance(record, dict) for record in records):
+        raise ValueError("JSON import must be an array of objects or NDJSON")
+    return records
+
+
+def _column_parser(column, tz):
+    """Разбор значения колонки; ValueError с сообщением для файла ошибок"""
+    column_type = column.type
+    if isinstance(column_type, DateTime):
+        def parse(value):
+            if not isinstance(value, str):
+                raise ValueError("expected ISO 8601 date and time")
+            moment = datetime.fromisoformat(value.strip().replace("Z", "+00:00"))
+            return tz.localize(moment) if moment.tzinfo is None else moment
+    elif isinstance(column_type, Numeric):
+        limit = Decimal(10) ** (column_type.precision - column_type.scale)
+        quantum = Decimal(1).scaleb(-column_type.scale)
+
+        def parse(value):
+            if isinstance(value, bool):
+                raise ValueError("expected a number")
+            number = Decimal(str(value).strip()).quantize(quantum)
+            if not abs(number) < limit:
+                raise ValueError(f"must be less than {limit} in absolute value")
+            return number
+    elif isinstance(column_type, Integer):
+        def parse(value):
+            if isinstance(value, bool) or (isinstance(value, float) and not value.is_integer()):
+                raise ValueError("expected an integer")
+            number = int(value.strip()) if isinstance(value, str) else int(value)
+            if abs(number) > INT4_MAX:
+                raise ValueError("integer out of range")
+            return number
+    else:
+        length = column_type.length if isinstance(column_type, String) else None
+
+        def parse(value):
+            value = value if isinstance(value, str) else json.dumps(value, ensure_ascii=False)
+            if length is not None and len(value) > length:
+                raise ValueError(f"longer than {length} characters")
+            return value
+    return parse
+
+
+def _column_values(parse, values: list, required: bool, errors: dict):
+    """Разбирает колонку пачки целиком; ошибки - в errors[позиция]"""
+    parsed = []
+    for position, value in enumerate(values):
+        if value is None or value == "":
+            if required:
+                errors.setdefault(position, "required")
+            parsed.append(None)
+            continue
+        try:
+            parsed.append(parse(value))
+        except (ValueError, ArithmeticError, TypeError) as e:
+            errors.setdefault(position, str(e) or "invalid value")
+            parsed.append(None)
+    return parsed
+
+
+def _source_value(record: dict, activity, name: str):
+    value = record.get(name)
+    if (value is None or value == "") and name == activity.time_column:
+        # Время на оси ленты можно передать общей колонкой: time у сна - это start_time, и наоборот
+        value = record.get("start_time" if name == "time" else "time")
+    return value
+
+
+def validate_batch(records: list, first_row: int, child_id: int, options: ImportOptions, archived_before) -> tuple:
+    """
+    Проверяет пачку строк. Возвращает ({тип: [строки таблицы]}, [ошибки]); ошибка -
+    (номер строки в файле, тип, колонка, сообщение, исходная строка).
+    """
+    tz = pytz.timezone(options.tz)
+    errors = []
+    positions_by_type = {}
+    renamed = [{options.columns.get(key, key): value for key, value in record.items()} for record in records]
+    for position, record in enumerate(renamed):
+        name = record.get("activity_type") or options.activity_type
+        name = options.types.get(name, name)
+        if name not in ACTIVITY_TYPES:
+            errors.append((first_row + position, name, "activity_type", "unknown activity type", records[position]))
+            continue
+        positions_by_type.setdefault(name, []).append(position)
+
+    rows_by_type = {}
+    for name, positions in positions_by_type.items():
+        activity = ACTIVITY_TYPES[name]
+        columns = import_columns(activity)
+        row_errors = {}
+        parsed = {}
+        for column in columns:
+            column_errors = {}
+            parsed[column.name] = _column_values(
+                _column_parser(column, tz), [_source_value(renamed[position], activity, column.name)
+                                             for position in positions],
+                required=not column.nullable, errors=column_errors
+            )
+            for index, message in column_errors.items():
+                row_errors.setdefault(index, (column.name, message))
+
+        rows = []
+        for index, position in enumerate(positions):
+            row = {"child_id": child_id, **{column.name: parsed[column.name][index] for column in columns}}
+            error = row_errors.get(index)
+            if error is None:
+                error = _check_row(activity, row, archived_before)
+            if error is not None:
+                errors.append((first_row + position, name, error[0], error[1], records[position]))
+                continue
+            rows.append(row)
+        if rows:
+            rows_by_type[name] = rows
+    return rows_by_type, errors
+
+
+def _check_row(activity, row: dict, archived_before) -> Optional[tuple]:
+    """Проверки строки целиком: (колонка, сообщение) или None"""
+    if activity.name in SESSION_KINDS:
+        # Открытую сессию импорт не создает: у ребенка может быть своя открытая
+        if row["end_time"] is None:
+            return "end_time", "required for imported sessions"
+        if row["end_time"] < row["start_time"]:
+            return "end_time", "earlier than start_time"
+        row["duration_minutes"] = duration_minutes(row["start_time"], row["end_time"])
+    if archived_before is not None and activity.model.__tablename__ in PARTITIONED_TABLES \
+            and row[activity.time_column] < archived_before:
+        return activity.time_column, "month is archived"
+    return None
+
+
+def write_error_file(job_id: int, errors: list) -> str:
+    os.makedirs(IMPORT_DIR, exist_ok=True)
+    path = os.path.join(IMPORT_DIR, f"import-{job_id}-errors.csv")
+    with open(path, "w", newline="", encoding="utf-8") as file:
+        writer = csv.writer(file)
+        writer.writerow(("row", "activity_type", "column", "error", "source"))
+        for row, activity_type, column, message, source in errors:
+            writer.writerow((row, activity_type, column, message, json.dumps(source, ensure_ascii=False, default=str)))
+    return path
+
+
+async def _update_job(job_id: int, **values):
+    # Прогресс фиксируется отдельной транзакцией, чтобы был виден во время импорта
+    async with session_scope() as db:
+        await db.execute(update(ImportJob).where(ImportJob.id == job_id).values(**values))
+        await db.commit()
+
+
+async def _archived_before():
+    async with session_scope() as db:
+        return await db.scalar(text("SELECT max(range_end) FROM activity_archives"))
+
+
+async def _ensure_partitions(rows_by_type: dict):
+    """Секции месяцев импортируемых строк создаются до загрузки, отдельной короткой транзакцией"""
+    months = {
+        (ACTIVITY_TYPES[name].model.__tablename__, row[ACTIVITY_TYPES[name].time_column].astimezone(PARTITION_TZ).date()
+         .replace(day=1))
+        for name, rows in rows_by_type.items() if ACTIVITY_TYPES[name].model.__tablename__ in PARTITIONED_TABLES
+        for row in rows
+    }
+    if not months:
+        return
+    async with session_scope() as db:
+        for table_name, month in sorted(months):
+            await db.execute(text("SELECT create_activity_partition(:parent, :month)"),
+                             {"parent": table_name, "month": month})
+        await db.commit()
+
+
+async def _load(child_id: int, rows_by_type: dict, job_id: int):
+    async with session_scope() as db:
+        # Версия ребенка первой: блокирует его строку версии, как любая запись, и начинает транзакцию до COPY
+        timezones = await bump_versions(db, [child_id])
+        inserted = 0
+        for name, rows in rows_by_type.items():
+            activity = ACTIVITY_TYPES[name]
+            columns = ["child_id"] + [column.name for column in import_columns(activity)]
+            for start in range(0, len(rows), IMPORT_BATCH_ROWS):
+                chunk = rows[start:start + IMPORT_BATCH_ROWS]
+                await copy_records(db, activity.model.__tablename__, columns,
+                                   [tuple(row[column] for column in columns) for row in chunk])
+                inserted += len(chunk)
+                await _update_job(job_id, inserted_rows=inserted)
+        await apply_rollups(db, [
+            activity_contribution(name, row) for name, rows in rows_by_type.items() for row in rows
+        ], timezones)
+        await forget(db, [child_id])
+        await db.commit()
+
+
+async def run_import(job_id: int, child_id: int, body: bytes, options: ImportOptions):
+    """Фоновое задание импорта; ошибки задания целиком пишутся в import_jobs.error"""
+    try:
+        await _update_job(job_id, status="validating")
+        records = await run_in_threadpool(parse_records, body, options.format)
+        await _update_job(job_id, total_rows=len(records))
+        archived_before = await _archived_before()
+
+        rows_by_type, errors = {}, []
+        for start in range(0, len(records), IMPORT_BATCH_ROWS):
+            batch_rows, batch_errors = await run_in_threadpool(
+                validate_batch, records[start:start + IMPORT_BATCH_ROWS], start + 1, child_id, options, archived_before
+            )
+            for name, rows in batch_rows.items():
+                rows_by_type.setdefault(name, []).extend(rows)
+            errors.extend(batch_errors)
+            await _update_job(job_id, validated_rows=min(start + IMPORT_BATCH_ROWS, len(records)),
+                              failed_rows=len(errors))
+        del records
+
+        error_file = await run_in_threadpool(write_error_file, job_id, errors) if errors else None
+        await _update_job(job_id, status="loading", error_file=error_file)
+        await _ensure_partitions(rows_by_type)
+        await _load(child_id, rows_by_type, job_id)
+        await _update_job(job_id, status="done", finished_at=func.now())
+    except ValueError as e:
+        # Файл не разобрать целиком (не CSV/JSON, не UTF-8)
+        await _update_job(job_id, status="failed", error=str(e), finished_at=func.now())
+    except Exception as e:
+        await _update_job(job_id, status="failed", error=f"{type(e).__name__}: {e}", inserted_rows=0,
+                          finished_at=func.now())
+        raise
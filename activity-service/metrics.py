@@ -0,0 +1,150 @@
+"""
+Метрики Prometheus activity-service, отдаются на GET /metrics.
+
+  http_request_duration_seconds{method, route, status} - время запроса до последнего байта ответа
+  http_requests_in_progress{method, route}             - запросы в работе
+  db_queries_per_request{route}                        - запросов к БД на HTTP-запрос
+  db_queries_total{pool}                               - запросов к БД всего (и вне HTTP, например импорт)
+  db_pool_checkout_wait_seconds{pool}                  - ожидание соединения из пула (с открытием нового)
+  db_pool_size, db_pool_checked_out, db_pool_overflow  - состояние пулов на момент сбора
+  change_feed_subscribers, change_feed_events_total    - потоки GET /changes и полученные NOTIFY
+
+route - шаблон пути FastAPI (/activities/child/{child_id}/today): число рядов не растет
+с числом детей. Метрики живут в памяти процесса: каждый процесс uvicorn отдает свои.
+"""
+import time
+from contextvars import ContextVar
+
+from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, Counter, Gauge, Histogram, generate_latest
+from prometheus_client.core import GaugeMetricFamily
+from sqlalchemy import event
+from starlette.routing import Match
+
+REQUEST_DURATION = Histogram(
+    "http_request_duration_seconds", "HTTP request latency", ["method", "route", "status"]
+)
+REQUESTS_IN_PROGRESS = Gauge("http_requests_in_progress", "HTTP requests being served", ["method", "route"])
+QUERIES_PER_REQUEST = Histogram(
+    "db_queries_per_request", "SQL statements executed per HTTP request", ["route"],
+    buckets=(0, 1, 2, 3, 5, 8, 13, 21, 34, 55, 89)
+)
+QUERIES = Counter("db_queries_total", "SQL statements executed", ["pool"])
+POOL_CHECKOUT_WAIT = Histogram(
+    "db_pool_checkout_wait_seconds", "Time to get a connection from the pool", ["pool"],
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+)
+CHANGE_FEED_SUBSCRIBERS = Gauge("change_feed_subscribers", "Open change feed streams")
+CHANGE_FEED_EVENTS = Counter("change_feed_events_total", "Activity change notifications received")
+
+# Маршрут без совпадения (404) - один ряд на все пути
+UNMATCHED_ROUTE = "<unmatched>"
+
+# Счетчик запросов к БД текущего HTTP-запроса; список, чтобы его видели и потоки sync-режима
+_request_queries: ContextVar = ContextVar("request_queries", default=None)
+
+# Имя пула -> пул SQLAlchemy, для db_pool_* при сборе
+_pools = {}
+
+
+def timed_pool(pool_class, name: str):
+    """Класс пула, который замеряет ожидание соединения в db_pool_checkout_wait_seconds{pool=name}"""
+    wait = POOL_CHECKOUT_WAIT.labels(name)
+
+    class TimedPool(pool_class):
+        def connect(self):
+            started = time.perf_counter()
+            try:
+                return super().connect()
+            finally:
+                wait.observe(time.perf_counter() - started)
+
+    return TimedPool
+
+
+def instrument_engine(engine, name: str):
+    """Считает запросы движка и показывает его пул в db_pool_*; для async - его sync_engine"""
+    queries = QUERIES.labels(name)
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def count_query(conn, cursor, statement, parameters, context, executemany):
+        queries.inc()
+        counter = _request_queries.get()
+        if counter is not None:
+            counter[0] += 1
+
+    _pools[name] = engine.pool
+
+
+class PoolCollector:
+    """Состояние пулов читается при каждом сборе"""
+
+    def collect(self):
+        size = GaugeMetricFamily("db_pool_size", "Configured pool size", labels=["pool"])
+        checked_out = GaugeMetricFamily("db_pool_checked_out", "Connections in use", labels=["pool"])
+        overflow = GaugeMetricFamily("db_pool_overflow", "Connections over pool size", labels=["pool"])
+        for name, pool in _pools.items():
+            size.add_metric([name], pool.size())
+            checked_out.add_metric([name], pool.checkedout())
+            overflow.add_metric([name], max(0, pool.overflow()))
+        yield from (size, checked_out, overflow)
+
+
+REGISTRY.register(PoolCollector())
+
+
+def route_template(app, scope) -> str:
+    for route in app.router.routes:
+        match, _ = route.matches(scope)
+        if match == Match.FULL:
+            return route.path
+    return UNMATCHED_ROUTE
+
+
+class MetricsMiddleware:
+    """ASGI-middleware: время и число запросов к БД считаются до конца тела ответа, в том числе потокового"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        method = scope["method"]
+        route = route_template(scope["app"], scope)
+        in_progress = REQUESTS_IN_PROGRESS.labels(method, route)
+        counter = [0]
+        token = _request_queries.set(counter)
+        started = time.perf_counter()
+        status = 500
+        observed = False
+
+        def observe():
+            nonlocal observed
+            if not observed:
+                observed = True
+                REQUEST_DURATION.labels(method, route, str(status)).observe(time.perf_counter() - started)
+                QUERIES_PER_REQUEST.labels(route).observe(counter[0])
+
+        async def send_wrapper(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+            # Фоновые задачи (BackgroundTasks) выполняются после ответа и в замер не входят
+            if message["type"] == "http.response.body" and not message.get("more_body", False):
+                observe()
+
+        in_progress.inc()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            observe()
+            in_progress.dec()
+            _request_queries.reset(token)
+
+
+def metrics_response() -> tuple:
+    """(тело, content-type) для GET /metrics"""
+    return generate_latest(), CONTENT_TYPE_LATEST
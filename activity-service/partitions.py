@@ -0,0 +1,173 @@
+"""
+Помесячные секции точечных активностей и архив холодных месяцев.
+
+Кормления, подгузники, температура, лекарства и настроение секционированы по месяцам
+поля time (границы месяца по Москве). Секции создаются наперед; строки вне созданных
+месяцев попадают в секцию DEFAULT и переносятся из нее при следующем ensure.
+
+    python partitions.py ensure [--months-ahead 3]     # раз в сутки по cron
+    python partitions.py list
+    python partitions.py archive --before 2025-01 [--dir /archive]
+    python partitions.py restore --partition feeding_activities_2024_03
+
+archive отсоединяет секции месяцев раньше --before, выгружает их в gzip CSV и удаляет
+одной транзакцией на секцию; запись о секции остается в activity_archives. Дневные
+агрегаты архивных месяцев остаются в child_daily_rollups, rollups.py rebuild их не трогает.
+"""
+import argparse
+import gzip
+import os
+import re
+from datetime import date, datetime, time
+
+import pytz
+from sqlalchemy import text
+
+from activity_types import ACTIVITY_TYPES
+from config import ARCHIVE_DIR
+
+# Границы месячных секций - по Москве для всех пользователей, как в create_activity_partition
+PARTITION_TZ = pytz.timezone('Europe/Moscow')
+
+PARTITIONED_TABLES = tuple(
+    ACTIVITY_TYPES[name].model.__tablename__ for name in ("feeding", "diaper", "temperature", "medication", "mood")
+)
+
+PARTITIONS_SQL = text("""
+SELECT parent.relname AS table_name, child.relname AS partition_name,
+       pg_get_expr(child.relpartbound, child.oid) AS bounds,
+       greatest(child.reltuples, 0)::bigint AS approx_rows,
+       pg_total_relation_size(child.oid) AS size_bytes
+FROM pg_inherits
+JOIN pg_class parent ON parent.oid = pg_inherits.inhparent
+JOIN pg_class child ON child.oid = pg_inherits.inhrelid
+WHERE parent.relname = ANY(:tables)
+ORDER BY parent.relname, child.relname
+""")
+
+MONTH_SUFFIX = re.compile(r"_(\d{4})_(\d{2})$")
+
+
+def partition_month(partition_name: str):
+    """Месяц секции по ее имени <таблица>_YYYY_MM; None для DEFAULT"""
+    match = MONTH_SUFFIX.search(partition_name)
+    return date(int(match.group(1)), int(match.group(2)), 1) if match else None
+
+
+def month_range(month: date):
+    """Границы секции месяца: полночь первого числа по Москве, как в create_activity_partition"""
+    next_month = date(month.year + month.month // 12, month.month % 12 + 1, 1)
+    return (PARTITION_TZ.localize(datetime.combine(month, time.min)),
+            PARTITION_TZ.localize(datetime.combine(next_month, time.min)))
+
+
+def ensure(months_ahead: int = 3) -> list:
+    """Создает недостающие секции; возвращает имена созданных"""
+    from models import engine
+
+    with engine.begin() as connection:
+        return connection.execute(
+            text("SELECT * FROM ensure_activity_partitions(:months_ahead)"), {"months_ahead": months_ahead}
+        ).scalars().all()
+
+
+def list_partitions() -> list:
+    from models import engine
+
+    with engine.connect() as connection:
+        return connection.execute(PARTITIONS_SQL, {"tables": list(PARTITIONED_TABLES)}).all()
+
+
+def archive(before: date, archive_dir: str = ARCHIVE_DIR) -> list:
+    """Архивирует секции месяцев раньше before; возвращает [(секция, строк, файл)]"""
+    from models import engine
+
+    os.makedirs(archive_dir, exist_ok=True)
+    archived = []
+    for partition in list_partitions():
+        month = partition_month(partition.partition_name)
+        if month is None or month >= before:
+            continue
+
+        path = os.path.join(archive_dir, f"{partition.partition_name}.csv.gz")
+        # Файл пишется рядом и переименовывается только после коммита
+        tmp_path = path + ".tmp"
+        try:
+            with engine.begin() as connection:
+                connection.execute(text(
+                    f'ALTER TABLE "{partition.table_name}" DETACH PARTITION "{partition.partition_name}"'
+                ))
+                with gzip.open(tmp_path, "wb") as archive_file:
+                    cursor = connection.connection.cursor()
+                    cursor.copy_expert(
+                        f'COPY "{partition.partition_name}" TO STDOUT WITH (FORMAT csv, HEADER)', archive_file
+                    )
+                    row_count = cursor.rowcount
+                range_start, range_end = month_range(month)
+                connection.execute(text("""
+                    INSERT INTO activity_archives (partition_name, table_name, range_start, range_end, row_count, path)
+                    VALUES (:partition_name, :table_name, :range_start, :range_end, :row_count, :path)
+                """), {
+                    "partition_name": partition.partition_name, "table_name": partition.table_name,
+                    "range_start": range_start, "range_end": range_end, "row_count": row_count, "path": path
+                })
+                connection.execute(text(f'DROP TABLE "{partition.partition_name}"'))
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        os.replace(tmp_path, path)
+        archived.append((partition.partition_name, row_count, path))
+    return archived
+
+
+def restore(partition_name: str) -> int:
+    """Возвращает архивную секцию обратно в таблицу; возвращает число строк"""
+    from models import engine
+
+    with engine.begin() as connection:
+        record = connection.execute(
+            text("DELETE FROM activity_archives WHERE partition_name = :name RETURNING table_name, path"),
+            {"name": partition_name}
+        ).first()
+        if record is None:
+            raise ValueError(f"Partition {partition_name} is not archived")
+
+        connection.execute(text("SELECT create_activity_partition(:parent, :month)"), {
+            "parent": record.table_name, "month": partition_month(partition_name)
+        })
+        with gzip.open(record.path, "rb") as archive_file:
+            cursor = connection.connection.cursor()
+            cursor.copy_expert(f'COPY "{partition_name}" FROM STDIN WITH (FORMAT csv, HEADER)', archive_file)
+            return cursor.rowcount
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Секции и архив точечных активностей")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    ensure_parser = subparsers.add_parser("ensure", help="создать секции текущего и следующих месяцев")
+    ensure_parser.add_argument("--months-ahead", type=int, default=3)
+    subparsers.add_parser("list", help="секции и их размеры")
+    archive_parser = subparsers.add_parser("archive", help="выгрузить в архив месяцы раньше --before")
+    archive_parser.add_argument("--before", required=True, help="первый месяц, который остается в базе, YYYY-MM")
+    archive_parser.add_argument("--dir", default=ARCHIVE_DIR)
+    restore_parser = subparsers.add_parser("restore", help="вернуть архивную секцию в базу")
+    restore_parser.add_argument("--partition", required=True)
+    args = parser.parse_args()
+
+    if args.command == "ensure":
+        created = ensure(args.months_ahead)
+        print(f"created {len(created)} partitions" + "".join(f"\n  {name}" for name in created))
+    elif args.command == "list":
+        for row in list_partitions():
+            print(f"{row.partition_name:40} {row.approx_rows:>10} rows {row.size_bytes // 1024:>10} KiB  {row.bounds}")
+    elif args.command == "archive":
+        year, month = map(int, args.before.split("-"))
+        for name, row_count, path in archive(date(year, month, 1), args.dir):
+            print(f"{name}: {row_count} rows -> {path}")
+    elif args.command == "restore":
+        print(f"{args.partition}: {restore(args.partition)} rows restored")
+
+
+if __name__ == "__main__":
+    main()
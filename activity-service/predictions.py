@@ -0,0 +1,218 @@
+"""
+Прогноз следующего сна и кормления (child_prediction_models).
+
+Модель ребенка - экспоненциально сглаженные интервалы (EMA) по четвертям суток
+по Москве: промежуток между кормлениями, окно бодрствования между снами и
+длительность сна. Параметры хранятся в child_prediction_models и обновляются
+каждой записью в той же транзакции; прогноз читает одну строку.
+
+Запись, которая не продолжает историю (задним числом, повторное завершение сна),
+сбрасывает строку, и при следующем чтении модель подбирается заново проигрыванием
+истории за последние FIT_HISTORY_DAYS дней через те же правила обновления.
+"""
+from datetime import datetime, timedelta, timezone
+from typing import Iterable, Optional, Tuple
+
+from sqlalchemy import delete, func, select, update
+from sqlalchemy.dialects.postgresql import insert
+
+from models import ChildDataVersion, ChildPredictionModel, FeedingActivity, SleepActivity
+from timezones import DEFAULT_TIMEZONE, get_zone
+
+# Вес нового интервала в EMA
+ALPHA = 0.3
+# Четверть суток, за которую ведется отдельная EMA: ночью интервалы длиннее
+BUCKET_HOURS = 6
+# Своя EMA четверти используется, когда в ней набралось столько интервалов; иначе общая
+MIN_BUCKET_SAMPLES = 3
+# Более длинные промежутки - пропуски в записях, а не интервалы
+MAX_INTERVAL_MINUTES = 12 * 60
+FIT_HISTORY_DAYS = 14
+
+METRICS = ("feeding_interval", "wake_window", "sleep_duration")
+
+# Четверти суток - по Москве: модель хранится без привязки к поясу владельца
+BUCKET_TZ = get_zone(DEFAULT_TIMEZONE)
+
+
+def _utc(value: datetime) -> datetime:
+    # Время без пояса считается UTC, как в БД
+    return value.replace(tzinfo=timezone.utc) if value.tzinfo is None else value
+
+
+def _bucket(moment: datetime) -> str:
+    return str(moment.astimezone(BUCKET_TZ).hour // BUCKET_HOURS)
+
+
+def _moment(state: dict, key: str) -> Optional[datetime]:
+    value = state.get(key)
+    return datetime.fromisoformat(value) if value else None
+
+
+def empty_state() -> dict:
+    return {metric: {} for metric in METRICS}
+
+
+def _add_sample(state: dict, metric: str, at: datetime, minutes: float):
+    if not 0 < minutes <= MAX_INTERVAL_MINUTES:
+        return
+    for key in ("all", _bucket(at)):
+        ema, count = state[metric].get(key, (None, 0))
+        ema = minutes if ema is None else ema + ALPHA * (minutes - ema)
+        state[metric][key] = [round(ema, 2), count + 1]
+
+
+def observe(state: dict, event: str, row: dict) -> bool:
+    """
+    Обновляет модель одним событием:
+      feeding   - новое кормление (time),
+      sleep     - новый сон (start_time и, если сон завершен, end_time),
+      sleep_end - завершение уже записанного сна.
+    False - событие не продолжает историю, модель надо подобрать заново.
+    """
+    if event == "feeding":
+        moment, last = _utc(row["time"]), _moment(state, "last_feeding")
+        if last is not None:
+            if moment < last:
+                return False
+            _add_sample(state, "feeding_interval", last, (moment - last).total_seconds() / 60)
+        state["last_feeding"] = moment.isoformat()
+        return True
+
+    start = _utc(row["start_time"])
+    last_start, last_end = _moment(state, "last_sleep_start"), _moment(state, "last_sleep_end")
+    if event == "sleep":
+        if last_start is not None and start < last_start:
+            return False
+        if last_end is not None and start > last_end:
+            _add_sample(state, "wake_window", last_end, (start - last_end).total_seconds() / 60)
+        state["last_sleep_start"], state["last_sleep_end"] = start.isoformat(), None
+        if not row.get("end_time"):
+            return True
+    elif start != last_start or last_end is not None:
+        # Завершен не последний сон или сон завершен повторно
+        return False
+
+    end = _utc(row["end_time"])
+    _add_sample(state, "sleep_duration", start, (end - start).total_seconds() / 60)
+    state["last_sleep_end"] = end.isoformat()
+    return True
+
+
+def _estimate(state: dict, metric: str, at: datetime) -> Tuple[Optional[float], int]:
+    """EMA интервала для момента at и число интервалов, на которых она построена"""
+    ema, count = state[metric].get(_bucket(at), (None, 0))
+    if count < MIN_BUCKET_SAMPLES:
+        ema, count = state[metric].get("all", (None, 0))
+    return ema, count
+
+
+def _after(moment: Optional[datetime], minutes: Optional[float]) -> Optional[str]:
+    if moment is None or minutes is None:
+        return None
+    return (moment + timedelta(minutes=minutes)).isoformat()
+
+
+def predict(state: dict) -> dict:
+    """Ожидаемое время следующего сна (и пробуждения, если ребенок спит) и следующего кормления"""
+    last_feeding = _moment(state, "last_feeding")
+    feeding_minutes, feeding_samples = _estimate(state, "feeding_interval", last_feeding) \
+        if last_feeding else (None, 0)
+
+    last_start, last_end = _moment(state, "last_sleep_start"), _moment(state, "last_sleep_end")
+    asleep = last_start is not None and last_end is None
+    duration_minutes = wake_minutes = expected_wake = None
+    wake_samples = 0
+    if asleep:
+        duration_minutes, _ = _estimate(state, "sleep_duration", last_start)
+        expected_wake = _after(last_start, duration_minutes)
+        last_end = datetime.fromisoformat(expected_wake) if expected_wake else None
+    if last_end is not None:
+        wake_minutes, wake_samples = _estimate(state, "wake_window", last_end)
+
+    return {
+        "sleep": {
+            "asleep": asleep,
+            "last_start": last_start.isoformat() if last_start else None,
+            "expected_wake": expected_wake,
+            "next_sleep": _after(last_end, wake_minutes),
+            "wake_window_minutes": wake_minutes,
+            "sleep_duration_minutes": duration_minutes,
+            "samples": wake_samples,
+        },
+        "feeding": {
+            "last": last_feeding.isoformat() if last_feeding else None,
+            "next": _after(last_feeding, feeding_minutes),
+            "interval_minutes": feeding_minutes,
+            "samples": feeding_samples,
+        },
+    }
+
+
+async def fit(db, child_id: int) -> dict:
+    """Подбирает модель по истории за FIT_HISTORY_DAYS дней и сохраняет ее; коммит за вызывающим"""
+    # Ждем коммита идущих записей ребенка (они держат строку версии), чтобы история
+    # ниже их уже видела; запись, начатая позже, обновит уже сохраненную модель
+    await db.execute(
+        select(ChildDataVersion.child_id).where(ChildDataVersion.child_id == child_id).with_for_update(read=True)
+    )
+    since = datetime.now(timezone.utc) - timedelta(days=FIT_HISTORY_DAYS)
+    state = empty_state()
+    feedings = await db.execute(
+        select(FeedingActivity.time)
+        .where(FeedingActivity.child_id == child_id, FeedingActivity.time >= since)
+        .order_by(FeedingActivity.time)
+    )
+    for feeding in feedings:
+        observe(state, "feeding", feeding._mapping)
+    sleeps = await db.execute(
+        select(SleepActivity.start_time, SleepActivity.end_time)
+        .where(SleepActivity.child_id == child_id, SleepActivity.start_time >= since)
+        .order_by(SleepActivity.start_time)
+    )
+    for sleep in sleeps:
+        observe(state, "sleep", sleep._mapping)
+
+    table = ChildPredictionModel.__table__
+    stmt = insert(table).values(child_id=child_id, state=state)
+    await db.execute(stmt.on_conflict_do_update(
+        index_elements=[table.c.child_id], set_={"state": stmt.excluded.state, "updated_at": func.now()}
+    ))
+    return state
+
+
+async def load_state(db, child_id: int) -> Tuple[dict, bool]:
+    """Сохраненная модель ребенка; второй элемент - True, если модель пришлось подобрать"""
+    state = await db.scalar(select(ChildPredictionModel.state).where(ChildPredictionModel.child_id == child_id))
+    if state is not None:
+        return state, False
+    return await fit(db, child_id), True
+
+
+async def observe_activities(db, events: Iterable[Tuple[str, Optional[dict]]]):
+    """
+    Применяет записанные события к сохраненным моделям детей; коммит за вызывающим.
+    Вызывается после bump_versions: строка версии уже заблокирована, и fit ждет этой транзакции.
+    """
+    by_child = {}
+    for event, row in events:
+        if row is not None and event in ("feeding", "sleep", "sleep_end"):
+            by_child.setdefault(row["child_id"], []).append((event, row))
+
+    table = ChildPredictionModel.__table__
+    for child_id in sorted(by_child):
+        state = await db.scalar(select(table.c.state).where(table.c.child_id == child_id).with_for_update())
+        # Модели еще нет - ее подберет первое чтение, уже с этой записью
+        if state is None:
+            continue
+        items = sorted(by_child[child_id], key=lambda item: _utc(item[1].get("time") or item[1]["start_time"]))
+        if all(observe(state, event, row) for event, row in items):
+            await db.execute(update(table).where(table.c.child_id == child_id).values(state=state, updated_at=func.now()))
+        else:
+            await db.execute(delete(table).where(table.c.child_id == child_id))
+
+
+async def forget(db, child_ids: Iterable[int]):
+    """Сбрасывает модели детей после массовой записи истории; подберутся при следующем чтении"""
+    table = ChildPredictionModel.__table__
+    await db.execute(delete(table).where(table.c.child_id.in_(list(child_ids))))
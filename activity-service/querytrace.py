@@ -0,0 +1,258 @@
+"""
+Трассировка SQL по HTTP-запросам (SQL_TRACE=1, по умолчанию выключена).
+
+Каждый запрос к БД приписывается текущему HTTP-запросу (маршрут - шаблон пути, как в
+metrics.py) вместе со временем и отпечатком: SQL без значений, где литералы и параметры
+заменены на ?, а списки IN (...) и VALUES свернуты, поэтому запросы одной формы с разными
+id и длиной списков попадают в один отпечаток.
+
+По окончании ответа запрос проверяется на бюджеты и попадает в лог sqltrace, если:
+  - запросов к БД больше бюджета маршрута (SQL_QUERY_BUDGETS, иначе SQL_TRACE_MAX_QUERIES);
+  - он шел дольше SQL_TRACE_REQUEST_MS;
+  - один отпечаток выполнен SQL_TRACE_REPEAT раз и больше - похоже на N+1.
+Отдельный запрос к БД дольше SQL_TRACE_SLOW_MS пишется в лог сразу.
+
+Сводка - GET /debug/sql?top=N: самые дорогие отпечатки по суммарному времени и число
+запросов по маршрутам; GET /debug/sql/budgets - наблюдаемый максимум по маршрутам в формате
+файла бюджетов. Строгий режим (SQL_TRACE_STRICT=1, для проверок) обрывает запрос ошибкой
+QueryBudgetExceeded, как только маршрут превысил бюджет; см. bench/query_budgets.py.
+
+Бюджет в файле - собственные запросы маршрута. Накладные запросы записи добавляются к нему
+на каждый запрос и вычитаются из наблюдаемого максимума, поэтому файл один для всех режимов:
+  - рассылка инвалидации кэша аналитики (ANALYTICS_CACHE_BACKEND=postgres - pg_notify);
+  - ключ идемпотентности (заголовок Idempotency-Key): захват ключа и сохранение ответа.
+"""
+import json
+import logging
+import os
+import re
+import threading
+import time
+from collections import Counter
+from contextvars import ContextVar
+from typing import Optional
+
+from sqlalchemy import event
+
+from analytics_cache import invalidation
+from config import (SQL_QUERY_BUDGETS, SQL_TRACE_MAX_QUERIES, SQL_TRACE_REPEAT, SQL_TRACE_REQUEST_MS,
+                    SQL_TRACE_SLOW_MS, SQL_TRACE_STRICT)
+from metrics import route_template
+
+logger = logging.getLogger("sqltrace")
+
+# Отпечатков в сводке не больше; остальные считаются вместе
+MAX_FINGERPRINTS = 2000
+OTHER_FINGERPRINT = "<other>"
+
+_STRING = re.compile(r"'(?:[^']|'')*'")
+_NUMBER = re.compile(r"(?<![\w.])-?\d+(?:\.\d+)?\b")
+# Параметры в стиле драйвера: %(name)s у psycopg2, $1 у asyncpg
+_PARAMETER = re.compile(r"%\(\w+\)s|%s|\$\d+")
+_LIST = re.compile(r"\((?:\s*\?\s*,)+\s*\?\s*\)")
+_ROWS = re.compile(r"(\(\.\.\.\))(?:\s*,\s*\((?:[^()]|\(\.\.\.\))*\))+")
+_SPACE = re.compile(r"\s+")
+
+
+def fingerprint(statement: str) -> str:
+    """SQL без значений: литералы и параметры - ?, списки (?, ?, ...) - (...)"""
+    text = _STRING.sub("?", statement)
+    text = _PARAMETER.sub("?", text)
+    text = _NUMBER.sub("?", text)
+    text = _LIST.sub("(...)", text)
+    text = _ROWS.sub(r"\1", text)
+    return _SPACE.sub(" ", text).strip()
+
+
+# Маршруты с этими методами пишут данные ребенка и рассылают инвалидацию кэша аналитики
+WRITE_METHODS = ("POST", "PUT", "PATCH", "DELETE")
+# claim_key и remember_response (idempotency.py); повтор вместо записи читает сохраненный ответ
+IDEMPOTENCY_STATEMENTS = 2
+
+
+def write_overhead(method: str, headers) -> int:
+    """Накладные запросы записи сверх бюджета маршрута: рассылка инвалидации и ключ идемпотентности"""
+    if method not in WRITE_METHODS:
+        return 0
+    overhead = invalidation.statements_per_write
+    if any(name == b"idempotency-key" for name, _ in headers):
+        overhead += IDEMPOTENCY_STATEMENTS
+    return overhead
+
+
+def load_budgets(path: str) -> dict:
+    """Бюджеты маршрутов {"GET /activities/child/{child_id}/today": 3}; нет файла - пусто"""
+    if not path or not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+class QueryBudgetExceeded(Exception):
+    """Строгий режим: маршрут сделал больше запросов к БД, чем его бюджет"""
+
+    def __init__(self, route: str, count: int, budget: int, statement: str):
+        self.route = route
+        self.count = count
+        self.budget = budget
+        self.statement = statement
+        super().__init__(f"{route}: {count} SQL statements, budget {budget}; last: {statement}")
+
+
+class RequestTrace:
+    """Запросы к БД одного HTTP-запроса"""
+
+    def __init__(self, route: str, budget: int, overhead: int = 0):
+        self.route = route
+        self.budget = budget + overhead
+        self.overhead = overhead
+        self.count = 0
+        self.db_seconds = 0.0
+        self.fingerprints = Counter()
+        self.finished = False
+
+
+class QueryStats:
+    """Сводка процесса: отпечатки и маршруты; пишется из потоков sync-режима, поэтому под замком"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.fingerprints = {}
+        self.routes = {}
+
+    def add_statement(self, key: str, seconds: float):
+        with self._lock:
+            if key not in self.fingerprints and len(self.fingerprints) >= MAX_FINGERPRINTS:
+                key = OTHER_FINGERPRINT
+            stats = self.fingerprints.setdefault(key, {"calls": 0, "total_ms": 0.0, "max_ms": 0.0})
+            stats["calls"] += 1
+            stats["total_ms"] += seconds * 1000
+            stats["max_ms"] = max(stats["max_ms"], seconds * 1000)
+
+    def add_request(self, trace: RequestTrace, flagged: bool):
+        with self._lock:
+            stats = self.routes.setdefault(trace.route, {
+                "requests": 0, "queries": 0, "max_queries": 0, "max_route_queries": 0,
+                "budget": trace.budget - trace.overhead, "over_budget": 0, "flagged": 0
+            })
+            stats["requests"] += 1
+            stats["queries"] += trace.count
+            stats["max_queries"] = max(stats["max_queries"], trace.count)
+            stats["max_route_queries"] = max(stats["max_route_queries"], trace.count - trace.overhead)
+            stats["over_budget"] += trace.count > trace.budget
+            stats["flagged"] += flagged
+
+    def report(self, top: int) -> dict:
+        with self._lock:
+            slowest = sorted(self.fingerprints.items(), key=lambda item: item[1]["total_ms"], reverse=True)[:top]
+            return {
+                "fingerprints": [
+                    {"sql": key, "calls": stats["calls"], "total_ms": round(stats["total_ms"], 2),
+                     "mean_ms": round(stats["total_ms"] / stats["calls"], 3), "max_ms": round(stats["max_ms"], 2)}
+                    for key, stats in slowest
+                ],
+                "routes": {
+                    route: {**stats, "mean_queries": round(stats["queries"] / stats["requests"], 2)}
+                    for route, stats in sorted(self.routes.items())
+                },
+            }
+
+    def observed_budgets(self) -> dict:
+        """Наблюдаемый максимум в формате файла бюджетов: без накладных запросов записи"""
+        with self._lock:
+            return {route: stats["max_route_queries"] for route, stats in sorted(self.routes.items())}
+
+    def reset(self):
+        with self._lock:
+            self.fingerprints.clear()
+            self.routes.clear()
+
+
+stats = QueryStats()
+budgets = load_budgets(SQL_QUERY_BUDGETS)
+
+_current: ContextVar[Optional[RequestTrace]] = ContextVar("sql_trace", default=None)
+
+
+def trace_engine(engine):
+    """Подключает трассировку к движку (для async - к его sync_engine)"""
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def before(conn, cursor, statement, parameters, context, executemany):
+        trace = _current.get()
+        if trace is not None and not trace.finished:
+            trace.count += 1
+            if SQL_TRACE_STRICT and trace.count > trace.budget:
+                raise QueryBudgetExceeded(trace.route, trace.count, trace.budget, fingerprint(statement))
+        conn.info.setdefault("sql_trace_started", []).append(time.perf_counter())
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def after(conn, cursor, statement, parameters, context, executemany):
+        seconds = time.perf_counter() - conn.info["sql_trace_started"].pop()
+        key = fingerprint(statement)
+        stats.add_statement(key, seconds)
+        trace = _current.get()
+        if trace is not None and not trace.finished:
+            trace.db_seconds += seconds
+            trace.fingerprints[key] += 1
+        if seconds * 1000 >= SQL_TRACE_SLOW_MS:
+            logger.warning("slow SQL %.1f ms%s: %s", seconds * 1000,
+                           f" in {trace.route}" if trace is not None else "", key)
+
+    @event.listens_for(engine, "handle_error")
+    def on_error(exception_context):
+        # Запрос с ошибкой не дошел до after_cursor_execute: снимаем его отметку времени
+        started = exception_context.connection.info.get("sql_trace_started") \
+            if exception_context.connection is not None else None
+        if started:
+            started.pop()
+
+
+def _finish(trace: RequestTrace, seconds: float):
+    trace.finished = True
+    reasons = []
+    if trace.count > trace.budget:
+        reasons.append(f"{trace.count} queries > budget {trace.budget}")
+    if seconds * 1000 > SQL_TRACE_REQUEST_MS:
+        reasons.append(f"{seconds * 1000:.0f} ms > {SQL_TRACE_REQUEST_MS:.0f} ms")
+    repeated = [(key, calls) for key, calls in trace.fingerprints.most_common(3) if calls >= SQL_TRACE_REPEAT]
+    if repeated:
+        reasons.append("possible N+1")
+    stats.add_request(trace, bool(reasons))
+    if reasons:
+        logger.warning(
+            "%s: %s (%d queries, %.1f ms in DB)%s", trace.route, "; ".join(reasons), trace.count,
+            trace.db_seconds * 1000, "".join(f"\n  {calls}x {key}" for key, calls in repeated)
+        )
+
+
+class QueryTraceMiddleware:
+    """ASGI-middleware: открывает трассу запроса и проверяет бюджеты после последнего байта ответа"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        route = f"{scope['method']} {route_template(scope['app'], scope)}"
+        trace = RequestTrace(route, budgets.get(route, SQL_TRACE_MAX_QUERIES),
+                             write_overhead(scope["method"], scope["headers"]))
+        token = _current.set(trace)
+        started = time.perf_counter()
+
+        async def send_wrapper(message):
+            await send(message)
+            # Фоновые задачи (BackgroundTasks) идут после ответа и запросу не приписываются
+            if message["type"] == "http.response.body" and not message.get("more_body", False) \
+                    and not trace.finished:
+                _finish(trace, time.perf_counter() - started)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            if not trace.finished:
+                _finish(trace, time.perf_counter() - started)
+            _current.reset(token)
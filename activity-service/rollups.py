@@ -0,0 +1,337 @@
+"""
+Дневные агрегаты по ребенку (child_daily_rollups).
+
+Каждая запись активности добавляет свой вклад в агрегат дня в той же транзакции,
+поэтому аналитика читает O(дней) строк вместо сырой истории. День - в часовом поясе
+владельца ребенка (users.timezone, см. timezones.py); после смены пояса агрегаты
+детей пользователя пересчитываются.
+Пересчет с нуля по сырым данным (дни архивных месяцев, см. partitions.py, сохраняются):
+
+    python rollups.py rebuild [--child-id N]
+"""
+import argparse
+from datetime import date
+from typing import Dict, Iterable, Optional
+
+from sqlalchemy import func, text
+from sqlalchemy.dialects.postgresql import insert, JSONB
+
+from activity_types import ACTIVITY_TYPES
+from models import ChildDailyRollup
+from timezones import DEFAULT_TIMEZONE, child_timezones, local_day
+
+COUNTER_COLUMNS = (
+    "sleep_count", "sleep_minutes",
+    "feeding_count", "feeding_ml", "feeding_ml_count",
+    "diaper_count",
+    "walk_count", "walk_minutes",
+    "temperature_count", "temperature_sum",
+)
+TYPE_COLUMNS = ("feeding_by_type", "diaper_by_type")
+
+
+def activity_contribution(activity_type: str, row: dict, sign: int = 1) -> Optional[dict]:
+    """
+    Вклад одной активности в агрегат ее дня (приращения - ActivityType.rollup из реестра типов);
+    день определяется по moment в поясе владельца.
+    sign=-1 дает обратный вклад, чтобы снять старые значения перед обновлением записи.
+    None - активность в агрегаты не попадает.
+    """
+    activity = ACTIVITY_TYPES.get(activity_type)
+    deltas = activity.rollup(row) if activity is not None and activity.rollup is not None else None
+    if deltas is None:
+        return None
+    moment = row[activity.time_column]
+
+    if sign != 1:
+        deltas = {
+            key: ({name: count * sign for name, count in value.items()} if key in TYPE_COLUMNS else value * sign)
+            for key, value in deltas.items()
+            # Минимум и максимум не вычитаются; для сна и прогулок их нет
+            if key not in ("temperature_min", "temperature_max")
+        }
+    return {"child_id": row["child_id"], "moment": moment, **deltas}
+
+
+def merge_contributions(contributions: Iterable[dict], timezones: Dict[int, str]) -> list:
+    """Сводит вклады в одну строку на (child_id, day); timezones - пояса владельцев детей"""
+    merged = {}
+    for item in contributions:
+        day = local_day(item["moment"], timezones.get(item["child_id"]))
+        row = merged.setdefault((item["child_id"], day), {
+            "child_id": item["child_id"],
+            "day": day,
+            **{column: 0 for column in COUNTER_COLUMNS},
+            **{column: {} for column in TYPE_COLUMNS},
+            "temperature_min": None,
+            "temperature_max": None,
+        })
+        for column in COUNTER_COLUMNS:
+            row[column] += item.get(column, 0)
+        for column in TYPE_COLUMNS:
+            for name, count in item.get(column, {}).items():
+                row[column][name] = row[column].get(name, 0) + count
+        if item.get("temperature_min") is not None:
+            row["temperature_min"] = min(v for v in (row["temperature_min"], item["temperature_min"]) if v is not None)
+            row["temperature_max"] = max(v for v in (row["temperature_max"], item["temperature_max"]) if v is not None)
+    return list(merged.values())
+
+
+async def apply_rollups(db, contributions: Iterable[Optional[dict]], timezones: Optional[Dict[int, str]] = None):
+    """
+    Добавляет вклады в child_daily_rollups; коммит остается за вызывающим.
+    timezones - пояса владельцев детей (их возвращает bump_versions той же записи); без них читаются запросом.
+    """
+    contributions = [item for item in contributions if item is not None]
+    if not contributions:
+        return
+    if timezones is None:
+        timezones = await child_timezones(db, [item["child_id"] for item in contributions])
+    rows = merge_contributions(contributions, timezones)
+
+    table = ChildDailyRollup.__table__
+    stmt = insert(table)
+    updates = {column: table.c[column] + stmt.excluded[column] for column in COUNTER_COLUMNS}
+    updates.update({column: func.jsonb_add_counts(table.c[column], stmt.excluded[column]) for column in TYPE_COLUMNS})
+    # LEAST/GREATEST в Postgres игнорируют NULL
+    updates["temperature_min"] = func.least(table.c.temperature_min, stmt.excluded.temperature_min)
+    updates["temperature_max"] = func.greatest(table.c.temperature_max, stmt.excluded.temperature_max)
+
+    await db.execute(stmt.on_conflict_do_update(index_elements=[table.c.child_id, table.c.day], set_=updates), rows)
+
+
+# Один запрос на окна сразу нескольких детей: у каждого ребенка свое окно (дни в его поясе),
+# ось дней из generate_series, к каждому дню - его агрегат
+DAILY_SERIES_SQL = text("""
+SELECT c.child_id, axis.day::date AS day,
+       coalesce(r.sleep_count, 0) AS sleep_count,
+       coalesce(r.sleep_minutes, 0) AS sleep_minutes,
+       coalesce(r.feeding_count, 0) AS feeding_count,
+       coalesce(r.feeding_ml, 0) AS feeding_ml,
+       coalesce(r.diaper_count, 0) AS diaper_count,
+       coalesce(r.walk_count, 0) AS walk_count,
+       coalesce(r.walk_minutes, 0) AS walk_minutes
+FROM unnest(CAST(:child_ids AS integer[]), CAST(:start_days AS date[]), CAST(:end_days AS date[]))
+     AS c(child_id, start_day, end_day)
+CROSS JOIN LATERAL generate_series(c.start_day, c.end_day, INTERVAL '1 day') AS axis(day)
+LEFT JOIN child_daily_rollups r ON r.child_id = c.child_id AND r.day = axis.day::date
+ORDER BY c.child_id, axis.day
+""")
+
+# Все метрики окна каждого ребенка, включая разбивку по типам: строка на ребенка, GROUP BY child_id
+WINDOW_TOTALS_SQL = text("""
+WITH children AS (
+    SELECT * FROM unnest(CAST(:child_ids AS integer[]), CAST(:start_days AS date[]), CAST(:end_days AS date[]))
+        AS c(child_id, start_day, end_day)
+), days AS (
+    SELECT r.* FROM children c
+    JOIN child_daily_rollups r ON r.child_id = c.child_id AND r.day BETWEEN c.start_day AND c.end_day
+), totals AS (
+    SELECT c.child_id,
+           coalesce(sum(sleep_count), 0) AS sleep_count,
+           coalesce(sum(sleep_minutes), 0) AS sleep_minutes,
+           coalesce(sum(feeding_count), 0) AS feeding_count,
+           coalesce(sum(feeding_ml), 0) AS feeding_ml,
+           coalesce(sum(feeding_ml_count), 0) AS feeding_ml_count,
+           coalesce(sum(diaper_count), 0) AS diaper_count,
+           coalesce(sum(walk_count), 0) AS walk_count,
+           coalesce(sum(walk_minutes), 0) AS walk_minutes,
+           coalesce(sum(temperature_count), 0) AS temperature_count,
+           coalesce(sum(temperature_sum), 0) AS temperature_sum,
+           min(temperature_min) AS temperature_min,
+           max(temperature_max) AS temperature_max
+    FROM children c
+    LEFT JOIN days USING (child_id)
+    GROUP BY c.child_id
+), feeding_types AS (
+    SELECT child_id, jsonb_object_agg(key, total) AS feeding_by_type
+    FROM (
+        SELECT child_id, key, sum(value::integer) AS total
+        FROM days, jsonb_each_text(days.feeding_by_type)
+        GROUP BY child_id, key HAVING sum(value::integer) <> 0
+    ) counts
+    GROUP BY child_id
+), diaper_types AS (
+    SELECT child_id, jsonb_object_agg(key, total) AS diaper_by_type
+    FROM (
+        SELECT child_id, key, sum(value::integer) AS total
+        FROM days, jsonb_each_text(days.diaper_by_type)
+        GROUP BY child_id, key HAVING sum(value::integer) <> 0
+    ) counts
+    GROUP BY child_id
+)
+SELECT totals.*,
+       coalesce(feeding_by_type, '{}'::jsonb) AS feeding_by_type,
+       coalesce(diaper_by_type, '{}'::jsonb) AS diaper_by_type
+FROM totals
+LEFT JOIN feeding_types USING (child_id)
+LEFT JOIN diaper_types USING (child_id)
+ORDER BY totals.child_id
+""").columns(feeding_by_type=JSONB, diaper_by_type=JSONB)
+
+
+def _window_params(windows: Dict[int, tuple]) -> dict:
+    return {
+        "child_ids": list(windows),
+        "start_days": [start_day for start_day, _ in windows.values()],
+        "end_days": [end_day for _, end_day in windows.values()],
+    }
+
+
+async def children_daily_series(db, windows: Dict[int, tuple]) -> dict:
+    """{child_id: строки по дням окна} для всех детей одним запросом; windows - {child_id: (первый, последний день)}"""
+    series = {child_id: [] for child_id in windows}
+    if not windows:
+        return series
+    for row in await db.execute(DAILY_SERIES_SQL, _window_params(windows)):
+        series[row.child_id].append(row)
+    return series
+
+
+async def children_window_totals(db, windows: Dict[int, tuple]) -> dict:
+    """{child_id: суммарные метрики окна} для всех детей одним запросом; windows - как в children_daily_series"""
+    if not windows:
+        return {}
+    rows = (await db.execute(WINDOW_TOTALS_SQL, _window_params(windows))).all()
+    totals = {row.child_id: row for row in rows}
+    return {child_id: totals[child_id] for child_id in windows}
+
+
+async def daily_series(db, child_id: int, start_day: date, end_day: date) -> list:
+    """Строка на каждый день окна, дни без записей заполнены нулями"""
+    return (await children_daily_series(db, {child_id: (start_day, end_day)}))[child_id]
+
+
+async def window_totals(db, child_id: int, start_day: date, end_day: date):
+    """Суммарные метрики окна"""
+    return (await children_window_totals(db, {child_id: (start_day, end_day)}))[child_id]
+
+
+# Пояс владельца каждого ребенка и первый день, который можно пересчитать: в днях до конца
+# архива (см. partitions.py) сырых строк нет целиком или частично, эти дни остаются как есть
+ZONES_SQL = """
+WITH zones AS (
+    SELECT c.id AS child_id, coalesce(u.timezone, :tz) AS tz,
+           coalesce(((SELECT max(range_end) FROM activity_archives) AT TIME ZONE coalesce(u.timezone, :tz)
+                     + INTERVAL '1 day' - INTERVAL '1 microsecond')::date, '-infinity'::date) AS first_day
+    FROM children c
+    LEFT JOIN users u ON u.id = c.user_id
+    WHERE TRUE {zone_filter}
+)"""
+
+REBUILD_SQL = ZONES_SQL + """, sleep AS (
+    SELECT child_id, (start_time AT TIME ZONE zones.tz)::date AS day,
+           count(*) AS sleep_count, sum(duration_minutes) AS sleep_minutes
+    FROM sleep_activities JOIN zones USING (child_id)
+    WHERE duration_minutes IS NOT NULL {child_filter}
+    GROUP BY 1, 2
+), feeding_types AS (
+    SELECT child_id, (time AT TIME ZONE zones.tz)::date AS day, type,
+           count(*) AS n, sum(amount_ml) AS ml, count(amount_ml) AS ml_count
+    FROM feeding_activities JOIN zones USING (child_id)
+    WHERE TRUE {child_filter}
+    GROUP BY 1, 2, 3
+), feeding AS (
+    SELECT child_id, day, sum(n) AS feeding_count, coalesce(sum(ml), 0) AS feeding_ml,
+           sum(ml_count) AS feeding_ml_count, jsonb_object_agg(type, n) AS feeding_by_type
+    FROM feeding_types
+    GROUP BY 1, 2
+), diaper_types AS (
+    SELECT child_id, (time AT TIME ZONE zones.tz)::date AS day, type, count(*) AS n
+    FROM diaper_activities JOIN zones USING (child_id)
+    WHERE TRUE {child_filter}
+    GROUP BY 1, 2, 3
+), diaper AS (
+    SELECT child_id, day, sum(n) AS diaper_count, jsonb_object_agg(type, n) AS diaper_by_type
+    FROM diaper_types
+    GROUP BY 1, 2
+), walk AS (
+    SELECT child_id, (start_time AT TIME ZONE zones.tz)::date AS day,
+           count(*) AS walk_count, sum(duration_minutes) AS walk_minutes
+    FROM walk_activities JOIN zones USING (child_id)
+    WHERE duration_minutes IS NOT NULL {child_filter}
+    GROUP BY 1, 2
+), temperature AS (
+    SELECT child_id, (time AT TIME ZONE zones.tz)::date AS day, count(*) AS temperature_count,
+           sum(temperature) AS temperature_sum, min(temperature) AS temperature_min,
+           max(temperature) AS temperature_max
+    FROM temperature_activities JOIN zones USING (child_id)
+    WHERE TRUE {child_filter}
+    GROUP BY 1, 2
+), days AS (
+    SELECT child_id, day FROM sleep
+    UNION SELECT child_id, day FROM feeding
+    UNION SELECT child_id, day FROM diaper
+    UNION SELECT child_id, day FROM walk
+    UNION SELECT child_id, day FROM temperature
+)
+INSERT INTO child_daily_rollups (
+    child_id, day, sleep_count, sleep_minutes, feeding_count, feeding_ml, feeding_ml_count,
+    feeding_by_type, diaper_count, diaper_by_type, walk_count, walk_minutes,
+    temperature_count, temperature_sum, temperature_min, temperature_max
+)
+SELECT d.child_id, d.day,
+       coalesce(s.sleep_count, 0), coalesce(s.sleep_minutes, 0),
+       coalesce(f.feeding_count, 0), coalesce(f.feeding_ml, 0), coalesce(f.feeding_ml_count, 0),
+       coalesce(f.feeding_by_type, '{{}}'::jsonb),
+       coalesce(dp.diaper_count, 0), coalesce(dp.diaper_by_type, '{{}}'::jsonb),
+       coalesce(w.walk_count, 0), coalesce(w.walk_minutes, 0),
+       coalesce(t.temperature_count, 0), coalesce(t.temperature_sum, 0), t.temperature_min, t.temperature_max
+FROM days d
+JOIN zones z USING (child_id)
+LEFT JOIN sleep s USING (child_id, day)
+LEFT JOIN feeding f USING (child_id, day)
+LEFT JOIN diaper dp USING (child_id, day)
+LEFT JOIN walk w USING (child_id, day)
+LEFT JOIN temperature t USING (child_id, day)
+WHERE d.day >= z.first_day
+"""
+
+# Дни архивных месяцев пересчитать нельзя, удаляются только остальные
+REBUILD_DELETE_SQL = ZONES_SQL + """
+DELETE FROM child_daily_rollups r
+USING zones z
+WHERE r.child_id = z.child_id AND r.day >= z.first_day
+"""
+
+
+def rebuild_statements(child_id: Optional[int] = None):
+    """
+    Запросы пересчета агрегатов (всех детей или одного) в поясах владельцев и их параметры;
+    архивные месяцы не трогаются
+    """
+    params = {"tz": DEFAULT_TIMEZONE}
+    child_filter = zone_filter = ""
+    if child_id is not None:
+        params["child_id"] = child_id
+        child_filter = "AND child_id = :child_id"
+        zone_filter = "AND c.id = :child_id"
+    return [
+        (text(REBUILD_DELETE_SQL.format(zone_filter=zone_filter)), params),
+        (text(REBUILD_SQL.format(child_filter=child_filter, zone_filter=zone_filter)), params),
+    ]
+
+
+def rebuild(child_id: Optional[int] = None):
+    """Пересчитывает агрегаты по сырым данным одной транзакцией"""
+    from models import engine
+
+    with engine.begin() as connection:
+        for statement, params in rebuild_statements(child_id):
+            connection.execute(statement, params)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Обслуживание child_daily_rollups")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    rebuild_parser = subparsers.add_parser("rebuild", help="пересчитать агрегаты по сырым данным")
+    rebuild_parser.add_argument("--child-id", type=int)
+    args = parser.parse_args()
+
+    if args.command == "rebuild":
+        rebuild(args.child_id)
+        print("child_daily_rollups rebuilt" + (f" for child {args.child_id}" if args.child_id else ""))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,68 @@
+"""
+Сессии с началом и концом (сон, прогулка): старт и стоп одним атомарным запросом.
+
+Открытая сессия - строка с end_time IS NULL. Частичные уникальные индексы
+uq_sleep_open / uq_walk_open гарантируют не больше одной открытой сессии
+каждого вида на ребенка, поэтому одновременные нажатия не создают дублей.
+"""
+from datetime import datetime
+from typing import Optional
+
+from sqlalchemy import select, update, union_all, func, literal_column, cast, Integer
+from sqlalchemy.dialects.postgresql import insert, JSONB
+
+from activity_types import ACTIVITY_TYPES
+
+SESSION_KINDS = {name: activity for name, activity in ACTIVITY_TYPES.items() if activity.end_column is not None}
+
+
+async def start_session(db, kind: str, child_id: int, values: dict) -> Optional[dict]:
+    """Открывает сессию; None, если у ребенка уже есть открытая сессия этого вида"""
+    table = SESSION_KINDS[kind].model.__table__
+    stmt = insert(table).values(child_id=child_id, **values).on_conflict_do_nothing(
+        index_elements=[table.c.child_id], index_where=table.c.end_time.is_(None)
+    ).returning(*table.c)
+    row = (await db.execute(stmt)).first()
+    return dict(row._mapping) if row else None
+
+
+async def stop_session(db, kind: str, child_id: int, end_time: datetime) -> Optional[dict]:
+    """
+    Закрывает открытую сессию; None, если открытой сессии нет.
+    ValueError, если end_time раньше начала сессии: отрицательная длительность попала бы в агрегаты.
+    """
+    table = SESSION_KINDS[kind].model.__table__
+    stmt = update(table).where(
+        table.c.child_id == child_id,
+        table.c.end_time.is_(None),
+        table.c.start_time <= end_time
+    ).values(
+        end_time=end_time,
+        duration_minutes=cast(func.trunc(func.extract("epoch", end_time - table.c.start_time) / 60), Integer)
+    ).returning(*table.c)
+    row = (await db.execute(stmt)).first()
+    if row is None:
+        # Лишний запрос только на неудачном пути: открытая сессия есть, но начата позже end_time
+        start_time = await db.scalar(select(table.c.start_time).where(
+            table.c.child_id == child_id, table.c.end_time.is_(None)
+        ))
+        if start_time is not None:
+            raise ValueError(f"end_time is earlier than the {kind} start ({start_time.isoformat()})")
+        return None
+    return dict(row._mapping)
+
+
+async def open_sessions(db, child_id: int) -> dict:
+    """Все открытые сессии ребенка одним запросом: {вид: сессия или None}"""
+    branches = []
+    for kind, activity in SESSION_KINDS.items():
+        table = activity.model.__table__
+        branches.append(select(
+            literal_column(f"'{kind}'").label("kind"),
+            func.to_jsonb(literal_column(table.name), type_=JSONB).label("data")
+        ).where(table.c.child_id == child_id, table.c.end_time.is_(None)))
+
+    result = {kind: None for kind in SESSION_KINDS}
+    for row in await db.execute(union_all(*branches)):
+        result[row.kind] = row.data
+    return result
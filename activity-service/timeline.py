@@ -0,0 +1,132 @@
+"""
+Единая лента активностей ребенка: все таблицы активностей одним UNION ALL запросом
+"""
+from datetime import datetime
+from itertools import chain
+from typing import List, NamedTuple, Optional
+from sqlalchemy import select, union_all, func, literal_column, tuple_
+from sqlalchemy.dialects.postgresql import JSONB
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from activity_types import ACTIVITY_TYPES, ActivityType
+
+
+class TimelineCursor(NamedTuple):
+    """Позиция в ленте: ключ сортировки (time, activity_type, id) последней выданной записи"""
+    time: datetime
+    activity_type: str
+    id: int
+
+    @classmethod
+    def parse(cls, value: str) -> "TimelineCursor":
+        """Разбирает курсор вида "<time>,<activity_type>,<id>" """
+        try:
+            time, activity_type, id = value.rsplit(",", 2)
+            return cls(datetime.fromisoformat(time), activity_type, int(id))
+        except ValueError:
+            raise ValueError(f"Invalid cursor: {value}")
+
+    @classmethod
+    def from_row(cls, row) -> "TimelineCursor":
+        return cls(row.time, row.activity_type, row.id)
+
+    def __str__(self):
+        return f"{self.time.isoformat()},{self.activity_type},{self.id}"
+
+
+def _after_cursor(activity: ActivityType, time_column, id_column, after: TimelineCursor, descending: bool = False):
+    """
+    Условие "строго после курсора" для одной ветки. activity_type в ветке константа,
+    поэтому сравнение тройки сводится к сравнению по времени или по (время, id).
+    В обратном порядке "после курсора" значит раньше него.
+    """
+    if descending:
+        if activity.name > after.activity_type:
+            return time_column < after.time
+        if activity.name < after.activity_type:
+            return time_column <= after.time
+        return tuple_(time_column, id_column) < tuple_(after.time, after.id)
+    if activity.name > after.activity_type:
+        return time_column >= after.time
+    if activity.name < after.activity_type:
+        return time_column > after.time
+    return tuple_(time_column, id_column) > tuple_(after.time, after.id)
+
+
+def _data_column(table, fields: Optional[List[str]] = None):
+    """Строка активности как JSON: вся строка или только колонки fields, которые есть в таблице"""
+    if fields is None:
+        return func.to_jsonb(literal_column(table.name), type_=JSONB)
+    pairs = ((literal_column(f"'{name}'"), table.c[name]) for name in fields if name in table.c)
+    return func.jsonb_build_object(*chain.from_iterable(pairs), type_=JSONB)
+
+
+def timeline_query(child_id: int, start: Optional[datetime] = None, end: Optional[datetime] = None,
+                   types: Optional[List[ActivityType]] = None, after: Optional[TimelineCursor] = None,
+                   limit: Optional[int] = None, fields: Optional[List[str]] = None, descending: bool = False):
+    """
+    Строит один запрос по всем таблицам активностей.
+    Каждая ветка фильтруется по (child_id, время), результат упорядочен по времени
+    (descending - от новых к старым). С limit каждая ветка отдает не больше limit строк
+    по индексу, так что страница не требует сортировки всей истории. С fields читаются только эти колонки.
+    """
+    order = (lambda column: column.desc()) if descending else (lambda column: column)
+    branches = []
+    for activity in types or ACTIVITY_TYPES.values():
+        table = activity.model.__table__
+        time_column = table.c[activity.time_column]
+
+        branch = select(
+            literal_column(f"'{activity.name}'").label("activity_type"),
+            table.c.id,
+            time_column.label("time"),
+            _data_column(table, fields).label("data")
+        ).where(table.c.child_id == child_id)
+
+        if start is not None:
+            branch = branch.where(time_column >= start)
+        if end is not None:
+            branch = branch.where(time_column < end)
+        if after is not None:
+            branch = branch.where(_after_cursor(activity, time_column, table.c.id, after, descending))
+        if limit is not None:
+            branch = branch.order_by(order(time_column), order(table.c.id)).limit(limit)
+        branches.append(branch)
+
+    query = union_all(*branches)
+    return query.order_by(
+        order(query.selected_columns.time),
+        order(query.selected_columns.activity_type),
+        order(query.selected_columns.id)
+    ).limit(limit)
+
+
+async def fetch_timeline(db: AsyncSession, child_id: int, start: Optional[datetime] = None, end: Optional[datetime] = None,
+                   types: Optional[List[ActivityType]] = None, after: Optional[TimelineCursor] = None,
+                   limit: Optional[int] = None, fields: Optional[List[str]] = None, descending: bool = False) -> list:
+    """Строки ленты: (activity_type, id, time, data)"""
+    return (await db.execute(timeline_query(child_id, start, end, types, after, limit, fields, descending))).all()
+
+
+async def stream_timeline(db: AsyncSession, child_id: int, start: Optional[datetime] = None,
+                          end: Optional[datetime] = None, types: Optional[List[ActivityType]] = None,
+                          after: Optional[TimelineCursor] = None, fields: Optional[List[str]] = None,
+                          batch_size: int = 500, descending: bool = False):
+    """Строки ленты пачками по batch_size через серверный курсор"""
+    result = await db.stream(timeline_query(child_id, start, end, types, after, fields=fields, descending=descending))
+    async for rows in result.partitions(batch_size):
+        yield rows
+
+
+def timeline_entry(row) -> dict:
+    """Запись ленты: поля активности плюс дискриминатор activity_type и общее время time"""
+    return {**row.data, "activity_type": row.activity_type, "time": row.time}
+
+
+def group_timeline(rows: list, types: Optional[List[ActivityType]] = None) -> dict:
+    """Раскладывает ленту по коллекциям в формате /activities/child/{id}"""
+    types = types or ACTIVITY_TYPES.values()
+    result = {activity.collection: [] for activity in types}
+    for row in rows:
+        result[ACTIVITY_TYPES[row.activity_type].collection].append(row.data)
+    return result
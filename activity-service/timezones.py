@@ -0,0 +1,72 @@
+"""
+Часовые пояса пользователей (users.timezone).
+
+Дни ребенка считаются в поясе его владельца: агрегаты child_daily_rollups, "сегодня",
+окна статистики и ETag. Границы дня - полуинтервал [начало, конец) в UTC; они считаются
+каждым чтением "сегодня" и кэшируются на пояс и дату. Запрос по ним - диапазон по
+времени активности, который идет по индексам (child_id, time) без выражений над временем.
+"""
+from datetime import date, datetime, time, timedelta, timezone
+from functools import lru_cache
+from typing import Dict, Iterable, Optional, Tuple
+
+import pytz
+from sqlalchemy import select
+
+from models import Child, User
+
+# Пояс по умолчанию, как у users.timezone
+DEFAULT_TIMEZONE = "Europe/Moscow"
+
+
+def is_valid(name: Optional[str]) -> bool:
+    return name in pytz.all_timezones_set
+
+
+@lru_cache(maxsize=None)
+def get_zone(name: Optional[str]):
+    """Пояс по имени; пустой или неизвестный (старые записи) - пояс по умолчанию"""
+    return pytz.timezone(name if is_valid(name) else DEFAULT_TIMEZONE)
+
+
+def zone_name(name: Optional[str]) -> str:
+    return get_zone(name).zone
+
+
+def local_now(name: Optional[str]) -> datetime:
+    return datetime.now(get_zone(name))
+
+
+def local_today(name: Optional[str]) -> date:
+    return local_now(name).date()
+
+
+def local_day(value: datetime, name: Optional[str]) -> date:
+    """День момента в поясе; время без пояса считается UTC, как в БД"""
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    return value.astimezone(get_zone(name)).date()
+
+
+@lru_cache(maxsize=4096)
+def day_bounds(name: Optional[str], day: date) -> Tuple[datetime, datetime]:
+    """Начало и конец дня в поясе, в UTC; день перехода на летнее время короче или длиннее 24 часов"""
+    zone = get_zone(name)
+    start, end = (zone.normalize(zone.localize(datetime.combine(value, time.min)))
+                  for value in (day, day + timedelta(days=1)))
+    return start.astimezone(timezone.utc), end.astimezone(timezone.utc)
+
+
+def today_bounds(name: Optional[str]) -> Tuple[datetime, datetime]:
+    return day_bounds(zone_name(name), local_today(name))
+
+
+async def child_timezones(db, child_ids: Iterable[int]) -> Dict[int, str]:
+    """{child_id: пояс владельца} одним запросом; несуществующих детей в ответе нет"""
+    child_ids = list(set(child_ids))
+    if not child_ids:
+        return {}
+    rows = await db.execute(
+        select(Child.id, User.timezone).join(User, User.id == Child.user_id).where(Child.id.in_(child_ids))
+    )
+    return {child_id: zone_name(name) for child_id, name in rows}
@@ -0,0 +1,92 @@
+"""
+Версии данных ребенка (child_data_versions).
+
+Каждая запись активностей увеличивает версию ребенка в той же транзакции.
+Чтения строят из версии ETag и отвечают 304, если копия у клиента актуальна,
+не выполняя сами запросы. Тем же запросом читается пояс владельца ребенка:
+от него зависят дни аналитики и "сегодня".
+"""
+import hashlib
+from datetime import timedelta
+from typing import Dict, Iterable, NamedTuple, Tuple
+
+from sqlalchemy import func, literal_column, select
+from sqlalchemy.dialects.postgresql import insert
+
+from analytics_cache import publish_invalidation
+from models import Child, ChildDataVersion, User
+from timezones import DEFAULT_TIMEZONE, local_today, zone_name
+
+
+class VersionState(NamedTuple):
+    version: int
+    recent_write: bool
+    timezone: str
+
+
+async def bump_versions(db, child_ids: Iterable[int]) -> Dict[int, str]:
+    """
+    Увеличивает версии детей; коммит остается за вызывающим. Возвращает {child_id: пояс владельца}
+    для агрегатов той же записи (apply_rollups), поэтому версии увеличиваются первыми.
+    """
+    # Строки версий блокируются в одном порядке и раньше агрегатов, чтобы параллельные записи не ловили deadlock
+    rows = [{"child_id": child_id, "version": 1} for child_id in sorted(set(child_ids))]
+    if not rows:
+        return {}
+
+    table = ChildDataVersion.__table__
+    stmt = insert(table)
+    # SQLAlchemy не коррелирует подзапрос в RETURNING с таблицей INSERT: строка версии указывается явно
+    owner_timezone = select(User.timezone).join(Child, Child.user_id == User.id) \
+        .where(Child.id == literal_column(f"{table.name}.child_id")).scalar_subquery()
+    result = await db.execute(stmt.on_conflict_do_update(
+        index_elements=[table.c.child_id],
+        set_={"version": table.c.version + 1, "updated_at": func.now()}
+    ).returning(table.c.child_id, owner_timezone), rows)
+    timezones = {child_id: zone_name(name) for child_id, name in result}
+    await publish_invalidation(db, [row["child_id"] for row in rows])
+    return timezones
+
+
+def _children_state_query(recent_seconds: float):
+    return select(
+        Child.id,
+        func.coalesce(ChildDataVersion.version, 0),
+        ChildDataVersion.updated_at > func.now() - timedelta(seconds=recent_seconds),
+        User.timezone,
+    ).select_from(Child) \
+        .join(User, User.id == Child.user_id) \
+        .outerjoin(ChildDataVersion, ChildDataVersion.child_id == Child.id)
+
+
+async def version_state(db, child_id: int, recent_seconds: float) -> VersionState:
+    """
+    Текущая версия данных ребенка (0, если записей еще не было), была ли запись
+    за последние recent_seconds секунд (по часам БД) и пояс владельца
+    """
+    row = (await db.execute(_children_state_query(recent_seconds).where(Child.id == child_id))).first()
+    if row is None:
+        return VersionState(0, False, DEFAULT_TIMEZONE)
+    return VersionState(row[1], bool(row[2]), zone_name(row[3]))
+
+
+async def children_state(db, child_ids: Iterable[int], recent_seconds: float) -> Tuple[bool, Dict[int, str]]:
+    """Записывался ли кто-то из детей за последние recent_seconds секунд и {child_id: пояс владельца}"""
+    rows = (await db.execute(_children_state_query(recent_seconds).where(Child.id.in_(list(child_ids))))).all()
+    return any(bool(row[2]) for row in rows), {row[0]: zone_name(row[3]) for row in rows}
+
+
+def build_etag(child_id: int, version: int, resource: str, timezone: str) -> str:
+    """
+    ETag ответа: версия данных ребенка плюс отпечаток ресурса (путь и параметры)
+    и текущей даты в поясе владельца - окна "сегодня" и "последние N дней" сдвигаются в полночь.
+    """
+    today = local_today(timezone).isoformat()
+    digest = hashlib.sha1(f"{resource}|{today}".encode()).hexdigest()[:16]
+    return f'W/"{child_id}-{version}-{digest}"'
+
+
+def etag_matches(if_none_match: str, etag: str) -> bool:
+    """Проверка заголовка If-None-Match (список тегов или *)"""
+    tags = [tag.strip() for tag in if_none_match.split(",")]
+    return "*" in tags or etag in tags or etag[2:] in tags
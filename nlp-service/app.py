@@ -1,17 +1,19 @@
 """
 NLP Service с мультиагентной системой
 """
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Response
 from pydantic import BaseModel
 from typing import Optional
 import os
 from dotenv import load_dotenv
 
 from orchestrator import BabyFlowOrchestrator
+from metrics import MetricsMiddleware, metrics_response
 
 load_dotenv()
 
 app = FastAPI(title="BabyFlow NLP Service")
+app.add_middleware(MetricsMiddleware)
 
 # Инициализируем orchestrator
 orchestrator = BabyFlowOrchestrator()
@@ -21,6 +23,10 @@ class MessageRequest(BaseModel):
     child_id: int = 1
     user_id: Optional[int] = None
     telegram_chat_id: Optional[int] = None
+    # id сообщения в чате: вместе с telegram_chat_id дает ключи идемпотентности записей
+    telegram_message_id: Optional[int] = None
+    # Часовой пояс мамы (users.timezone); без него - Europe/Moscow
+    timezone: Optional[str] = None
 
 class MessageResponse(BaseModel):
     success: bool
@@ -38,9 +44,14 @@ def process_message(request: MessageRequest):
     Обрабатывает сообщение от пользователя через мультиагентную систему
     """
     try:
+        message_key = None
+        if request.telegram_chat_id is not None and request.telegram_message_id is not None:
+            message_key = f"tg:{request.telegram_chat_id}:{request.telegram_message_id}"
         result = orchestrator.process_message(
             message=request.message,
-            child_id=request.child_id
+            child_id=request.child_id,
+            message_key=message_key,
+            timezone=request.timezone
         )
         return MessageResponse(**result)
     except Exception as e:
@@ -55,6 +66,12 @@ def health_check():
         "activity_service_url": os.getenv("ACTIVITY_SERVICE_URL", "not set")
     }
 
+@app.get("/metrics", include_in_schema=False)
+def metrics():
+    """Метрики Prometheus (см. metrics.py)"""
+    body, content_type = metrics_response()
+    return Response(body, media_type=content_type)
+
 # Тестовые эндпоинты для отладки
 @app.post("/test/parse_time")
 def test_parse_time(expression: str):
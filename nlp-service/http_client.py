@@ -0,0 +1,70 @@
+"""
+HTTP-запросы к соседним сервисам с короткими таймаутами и повторами.
+
+GET повторяется всегда, запись - только с ключом Idempotency-Key (activity-service
+вернет на повтор сохраненный ответ, поэтому повтор после таймаута не создает дубль)
+или если вызывающий сам отметил ее idempotent=True.
+"""
+import os
+import threading
+import time
+import uuid
+from typing import Optional
+
+import requests
+
+CONNECT_TIMEOUT = float(os.getenv("HTTP_CONNECT_TIMEOUT", "1"))
+READ_TIMEOUT = float(os.getenv("HTTP_READ_TIMEOUT", "5"))
+RETRIES = int(os.getenv("HTTP_RETRIES", "2"))
+# Пауза перед повтором: BACKOFF, 2 * BACKOFF, ...
+BACKOFF = 0.2
+
+RETRY_STATUSES = {502, 503, 504}
+
+# Сессия на поток: соединения переиспользуются между запросами (keep-alive)
+_local = threading.local()
+
+
+def _session() -> requests.Session:
+    if not hasattr(_local, "session"):
+        _local.session = requests.Session()
+    return _local.session
+
+
+def new_key() -> str:
+    """Случайный ключ идемпотентности, когда вывести его из сообщения не из чего"""
+    return uuid.uuid4().hex
+
+
+def request(method: str, url: str, idempotency_key: Optional[str] = None, idempotent: bool = False,
+            retries: int = RETRIES, timeout=None, **kwargs) -> requests.Response:
+    headers = dict(kwargs.pop("headers", None) or {})
+    if idempotency_key:
+        headers["Idempotency-Key"] = idempotency_key
+    attempts = 1 + retries if idempotent or idempotency_key or method.upper() == "GET" else 1
+
+    for attempt in range(attempts):
+        last = attempt == attempts - 1
+        try:
+            response = _session().request(
+                method, url, headers=headers, timeout=timeout or (CONNECT_TIMEOUT, READ_TIMEOUT), **kwargs
+            )
+        except (requests.ConnectionError, requests.Timeout):
+            if last:
+                raise
+        else:
+            if last or response.status_code not in RETRY_STATUSES:
+                return response
+        time.sleep(BACKOFF * 2 ** attempt)
+
+
+def get(url: str, **kwargs) -> requests.Response:
+    return request("GET", url, **kwargs)
+
+
+def post(url: str, **kwargs) -> requests.Response:
+    return request("POST", url, **kwargs)
+
+
+def put(url: str, **kwargs) -> requests.Response:
+    return request("PUT", url, **kwargs)
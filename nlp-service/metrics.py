@@ -0,0 +1,150 @@
+"""
+Метрики Prometheus nlp-service, отдаются на GET /metrics.
+
+  http_request_duration_seconds{method, route, status} - время запроса
+  http_requests_in_progress{method, route}             - запросы в работе
+  llm_calls_total{provider, model, outcome}            - вызовы модели (ok/error)
+  llm_call_duration_seconds{provider, model}           - время одного вызова
+  llm_tokens_total{provider, model, kind}              - токены input/output
+  llm_calls_per_request, llm_tokens_per_request{kind}  - вызовов и токенов на сообщение (/process)
+
+Вызовы модели считает LLMMetricsCallback: агент делает их несколько на сообщение (рассуждение
+и вызовы инструментов), поэтому важны и время одного вызова, и их число на сообщение.
+"""
+import threading
+import time
+
+from langchain_core.callbacks import BaseCallbackHandler
+from prometheus_client import CONTENT_TYPE_LATEST, Counter, Gauge, Histogram, generate_latest
+from starlette.routing import Match
+
+REQUEST_DURATION = Histogram(
+    "http_request_duration_seconds", "HTTP request latency", ["method", "route", "status"],
+    buckets=(0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60)
+)
+REQUESTS_IN_PROGRESS = Gauge("http_requests_in_progress", "HTTP requests being served", ["method", "route"])
+
+LLM_CALLS = Counter("llm_calls_total", "LLM calls", ["provider", "model", "outcome"])
+LLM_CALL_DURATION = Histogram(
+    "llm_call_duration_seconds", "Latency of one LLM call", ["provider", "model"],
+    buckets=(0.25, 0.5, 1, 2, 4, 8, 16, 32, 64)
+)
+LLM_TOKENS = Counter("llm_tokens_total", "LLM tokens", ["provider", "model", "kind"])
+LLM_CALLS_PER_REQUEST = Histogram(
+    "llm_calls_per_request", "LLM calls per processed message", buckets=(0, 1, 2, 3, 4, 5, 6, 8, 10)
+)
+LLM_TOKENS_PER_REQUEST = Histogram(
+    "llm_tokens_per_request", "LLM tokens per processed message", ["kind"],
+    buckets=(250, 500, 1000, 2000, 4000, 8000, 16000, 32000, 64000)
+)
+
+# Маршрут без совпадения (404) - один ряд на все пути
+UNMATCHED_ROUTE = "<unmatched>"
+
+
+def _usage(response) -> tuple:
+    """(input, output) токенов ответа модели: usage_metadata сообщений или llm_output провайдера"""
+    input_tokens = output_tokens = 0
+    for generations in response.generations:
+        for generation in generations:
+            usage = getattr(getattr(generation, "message", None), "usage_metadata", None)
+            if usage:
+                input_tokens += usage.get("input_tokens", 0)
+                output_tokens += usage.get("output_tokens", 0)
+    if input_tokens or output_tokens:
+        return input_tokens, output_tokens
+    usage = (response.llm_output or {}).get("usage") or (response.llm_output or {}).get("token_usage") or {}
+    return (usage.get("input_tokens", usage.get("prompt_tokens", 0)),
+            usage.get("output_tokens", usage.get("completion_tokens", 0)))
+
+
+class LLMMetricsCallback(BaseCallbackHandler):
+    """Колбэк LangChain на одно сообщение: метрики вызовов и итог на сообщение в observe_request"""
+
+    def __init__(self, provider: str, model: str):
+        self.provider = provider
+        self.model = model
+        self.calls = 0
+        self.input_tokens = 0
+        self.output_tokens = 0
+        self._started = {}
+        self._lock = threading.Lock()
+
+    def _start(self, run_id):
+        with self._lock:
+            self._started[run_id] = time.perf_counter()
+
+    def _finish(self, run_id, outcome: str):
+        with self._lock:
+            started = self._started.pop(run_id, None)
+            self.calls += 1
+        LLM_CALLS.labels(self.provider, self.model, outcome).inc()
+        if started is not None:
+            LLM_CALL_DURATION.labels(self.provider, self.model).observe(time.perf_counter() - started)
+
+    def on_chat_model_start(self, serialized, messages, *, run_id, **kwargs):
+        self._start(run_id)
+
+    def on_llm_start(self, serialized, prompts, *, run_id, **kwargs):
+        self._start(run_id)
+
+    def on_llm_end(self, response, *, run_id, **kwargs):
+        self._finish(run_id, "ok")
+        input_tokens, output_tokens = _usage(response)
+        LLM_TOKENS.labels(self.provider, self.model, "input").inc(input_tokens)
+        LLM_TOKENS.labels(self.provider, self.model, "output").inc(output_tokens)
+        with self._lock:
+            self.input_tokens += input_tokens
+            self.output_tokens += output_tokens
+
+    def on_llm_error(self, error, *, run_id, **kwargs):
+        self._finish(run_id, "error")
+
+    def observe_request(self):
+        LLM_CALLS_PER_REQUEST.observe(self.calls)
+        LLM_TOKENS_PER_REQUEST.labels("input").observe(self.input_tokens)
+        LLM_TOKENS_PER_REQUEST.labels("output").observe(self.output_tokens)
+
+
+def route_template(app, scope) -> str:
+    for route in app.router.routes:
+        match, _ = route.matches(scope)
+        if match == Match.FULL:
+            return route.path
+    return UNMATCHED_ROUTE
+
+
+class MetricsMiddleware:
+    """ASGI-middleware: время запроса по шаблону маршрута и запросы в работе"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        method = scope["method"]
+        route = route_template(scope["app"], scope)
+        in_progress = REQUESTS_IN_PROGRESS.labels(method, route)
+        started = time.perf_counter()
+        status = 500
+
+        async def send_wrapper(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        in_progress.inc()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            REQUEST_DURATION.labels(method, route, str(status)).observe(time.perf_counter() - started)
+            in_progress.dec()
+
+
+def metrics_response() -> tuple:
+    """(тело, content-type) для GET /metrics"""
+    return generate_latest(), CONTENT_TYPE_LATEST
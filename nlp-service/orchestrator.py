@@ -2,25 +2,31 @@
 Orchestrator с динамическим reasoning для мультиагентной системы
 """
 import os
-from typing import Dict, Any
+from typing import Dict, Any, Optional
 from langchain.agents import AgentExecutor, create_tool_calling_agent
 from langchain.prompts import ChatPromptTemplate, MessagesPlaceholder
 from datetime import datetime
-import pytz
 
 from tools import (
     database_reader_tool,
     database_writer_tool,
     end_sleep_tool,
+    session_tool,
+    distribution_tool,
+    prediction_tool,
     time_calculator_tool,
     activity_validator_tool,
-    relative_time_tool
+    relative_time_tool,
+    begin_message,
+    user_timezone
 )
+from metrics import LLMMetricsCallback
 
 class BabyFlowOrchestrator:
     def __init__(self):
         # Выбор LLM провайдера через переменные окружения
         llm_provider = os.getenv("LLM_PROVIDER", "anthropic").lower()
+        self.provider = llm_provider
 
         if llm_provider == "mistral":
             from langchain_mistralai import ChatMistralAI
@@ -31,6 +37,7 @@ class BabyFlowOrchestrator:
                 max_retries=2,
                 safe_mode=False  # Отключаем safe mode для tool calling
             )
+            self.model_name = os.getenv("MISTRAL_MODEL", "mistral-large-latest")
             print(f"✅ Using Mistral AI: {os.getenv('MISTRAL_MODEL', 'mistral-large-latest')}")
         elif llm_provider == "anthropic":
             from langchain_anthropic import ChatAnthropic
@@ -39,6 +46,7 @@ class BabyFlowOrchestrator:
                 anthropic_api_key=os.getenv("ANTHROPIC_API_KEY"),
                 temperature=0.3
             )
+            self.model_name = os.getenv("ANTHROPIC_MODEL", "claude-3-haiku-20240307")
             print(f"✅ Using Anthropic Claude: {os.getenv('ANTHROPIC_MODEL', 'claude-3-haiku-20240307')}")
         else:
             raise ValueError(f"Unsupported LLM provider: {llm_provider}. Use 'anthropic' or 'mistral'")
@@ -47,6 +55,9 @@ class BabyFlowOrchestrator:
             database_reader_tool,
             database_writer_tool,
             end_sleep_tool,
+            session_tool,
+            distribution_tool,
+            prediction_tool,
             time_calculator_tool,
             activity_validator_tool
         ]
@@ -84,14 +95,12 @@ class BabyFlowOrchestrator:
         3. Вызывай необходимые инструменты
         4. Формируй краткий ответ для мамы
         
-        Текущее время: {current_time}
-        Часовой пояс: Москва (UTC+3)
-        
         ТИПЫ СОБЫТИЙ и КАК ИХ ЗАПИСЫВАТЬ:
-        - "спит", "уснул", "заснул" → database_writer_tool с activity_type="sleep"
-        - "проснулся", "встал" → сначала database_reader_tool найти открытый сон, потом end_sleep_tool БЕЗ указания времени
+        - "спит", "уснул", "заснул" → session_tool с kind="sleep", action="start"
+        - "проснулся", "встал" → session_tool с kind="sleep", action="stop" БЕЗ указания времени
         - "покушал", "поел", "покормила" → database_writer_tool с activity_type="feeding"
-        - "гуляем", "на прогулке" → database_writer_tool с activity_type="walk"
+        - "гуляем", "на прогулке" → session_tool с kind="walk", action="start"
+        - "вернулись с прогулки", "пришли домой" → session_tool с kind="walk", action="stop"
         - "покакал", "какал" → database_writer_tool с activity_type="diaper", type="poop"
         - "пописал", "писал" → database_writer_tool с activity_type="diaper", type="pee"
         - "памперс", "подгузник" → database_writer_tool с activity_type="diaper"
@@ -101,10 +110,14 @@ class BabyFlowOrchestrator:
         
         ПРАВИЛА ИСПОЛЬЗОВАНИЯ ИНСТРУМЕНТОВ:
         1. database_writer_tool принимает параметры: activity_type ("sleep"/"feeding"/"walk"), child_id, и время
-        2. Для записи начала сна используй: activity_type="sleep" и data с child_id и start_time
-        3. Для завершения сна: сначала database_reader_tool найти открытый сон, потом end_sleep_tool
+        2. Начало и конец сна или прогулки - один вызов session_tool; время передавай, только если мама его назвала
+        3. Если session_tool вернул already_in_progress - сон/прогулка уже идет, not_found - нечего завершать; так и ответь
         4. Если время не указано - используй текущее время
         5. child_id всегда передавай из контекста сообщения
+        6. Вопросы "какое обычно окно бодрствования", "как часто ест", "сколько обычно спит" → distribution_tool,
+           отвечай медианой (p50) и обычным диапазоном p10-p90; историю через database_reader_tool для этого не читай
+        7. Вопросы "когда следующий сон", "когда проснется", "когда кормить" → prediction_tool;
+           время переведи в часовой пояс мамы и скажи, что это примерная оценка по обычному режиму
         
         ВАЖНО: 
         - Отвечай кратко и по-русски
@@ -124,15 +137,23 @@ class BabyFlowOrchestrator:
         - "💊 Записала лекарство: Нурофен 5мл"
         - "😊 Отметила настроение: веселое"
         - "😢 Записала, что малыш капризничает"
-        """.format(current_time=datetime.now(pytz.timezone('Europe/Moscow')).strftime("%Y-%m-%d %H:%M"))
+        """
 
-    def process_message(self, message: str, child_id: int = 1) -> Dict[str, Any]:
+    def process_message(self, message: str, child_id: int = 1, message_key: Optional[str] = None,
+                        timezone: Optional[str] = None) -> Dict[str, Any]:
         """
-        Обрабатывает сообщение от пользователя
+        Обрабатывает сообщение от пользователя.
+        message_key - идентификатор сообщения (tg:чат:сообщение): из него строятся ключи
+        идемпотентности записей, и повторная обработка того же сообщения не дублирует их.
+        timezone - часовой пояс мамы: время в сообщении и ответе понимается в нем
         """
+        begin_message(message_key, timezone)
+        # Текущее время - в каждом сообщении: системный промпт собирается один раз при старте
+        now = datetime.now(user_timezone())
         enriched_input = f"""
         Сообщение от мамы: "{message}"
         ID ребенка для записи: {child_id}
+        Текущее время мамы: {now:%Y-%m-%d %H:%M} (часовой пояс {now.tzinfo.zone}, UTC{now:%z})
         
         Используй reasoning:
         1. Определи тип события
@@ -141,8 +162,10 @@ class BabyFlowOrchestrator:
         4. Верни результат
         """
 
+        # Вызовы модели и токены этого сообщения - в метрики (metrics.py)
+        llm_metrics = LLMMetricsCallback(self.provider, self.model_name)
         try:
-            result = self.executor.invoke({"input": enriched_input})
+            result = self.executor.invoke({"input": enriched_input}, config={"callbacks": [llm_metrics]})
             return {
                 "success": True,
                 "response": result.get("output", "Записано"),
@@ -154,6 +177,8 @@ class BabyFlowOrchestrator:
                 "response": f"Ошибка обработки: {str(e)}",
                 "error": str(e)
             }
+        finally:
+            llm_metrics.observe_request()
 
     def _extract_reasoning(self, result: Dict) -> str:
         """Извлекает reasoning из результата для отладки"""
@@ -2,14 +2,58 @@
 Tools для мультиагентной системы
 """
 import os
-import requests
+import contextvars
 from datetime import datetime, timedelta
 from typing import Dict, Optional, Any
 from langchain.tools import tool
 import pytz
+from http_cache import ETagCache
+import http_client
 
 ACTIVITY_SERVICE_URL = os.getenv("ACTIVITY_SERVICE_URL", "http://localhost:8003")
 
+# Окно и размер выборки "последних активностей": вся история ребенка в контекст не нужна
+READER_HISTORY_DAYS = 3
+READER_LIMIT = 200
+
+# Чтения активностей перепроверяются по ETag вместо повторной загрузки
+activity_cache = ETagCache()
+
+# Ключи идемпотентности записей текущего сообщения: повтор обработки того же сообщения
+# (или повтор запроса после таймаута) не создает дублей в дневнике
+_message_keys = contextvars.ContextVar("message_keys", default=None)
+
+# Часовой пояс мамы (users.timezone): "утром", "вчера" и "сегодня" считаются в нем
+DEFAULT_TIMEZONE = "Europe/Moscow"
+_timezone = contextvars.ContextVar("timezone", default=DEFAULT_TIMEZONE)
+
+
+def begin_message(message_key: Optional[str], timezone: Optional[str] = None):
+    """Задает основу ключей записей, сделанных при обработке одного сообщения (например, tg:чат:сообщение),
+    и пояс, в котором понимается время из сообщения"""
+    _message_keys.set({"base": message_key, "counts": {}} if message_key else None)
+    _timezone.set(timezone if timezone in pytz.all_timezones_set else DEFAULT_TIMEZONE)
+
+
+def user_timezone():
+    return pytz.timezone(_timezone.get())
+
+
+def _wall_time(moment: datetime, hour: int, minute: int = 0) -> datetime:
+    """Час и минута по часам мамы в день moment; смещение пояса - на этот день, а не на сегодня"""
+    naive = moment.replace(tzinfo=None, hour=hour, minute=minute, second=0, microsecond=0)
+    return user_timezone().localize(naive)
+
+
+def _write_key(name: str) -> str:
+    """Ключ записи: сообщение, вид записи и ее номер среди записей этого вида в сообщении"""
+    keys = _message_keys.get()
+    if keys is None:
+        return http_client.new_key()
+    keys["counts"][name] = keys["counts"].get(name, 0) + 1
+    return f"{keys['base']}:{name}:{keys['counts'][name]}"
+
+
 @tool
 def database_reader_tool(child_id: int, activity_type: str = "all") -> Dict:
     """
@@ -17,16 +61,24 @@ def database_reader_tool(child_id: int, activity_type: str = "all") -> Dict:
     """
     try:
         if activity_type == "open_sleep":
-            response = requests.get(f"{ACTIVITY_SERVICE_URL}/activities/sleep/{child_id}/open")
+            response = http_client.get(f"{ACTIVITY_SERVICE_URL}/activities/sleep/{child_id}/open")
             if response.status_code == 200:
                 return response.json()
             return None
         elif activity_type == "today":
-            response = requests.get(f"{ACTIVITY_SERVICE_URL}/activities/child/{child_id}/today")
+            response = activity_cache.get(f"{ACTIVITY_SERVICE_URL}/activities/child/{child_id}/today")
             return response.json()
         else:
-            response = requests.get(f"{ACTIVITY_SERVICE_URL}/activities/child/{child_id}")
-            return response.json()
+            # Начало окна округлено до суток, чтобы URL не менялся между вызовами и работал кэш.
+            # Страница берется с конца ленты: если окно не влезает в READER_LIMIT, отбрасываются
+            # самые старые записи, а не свежие; модели лента отдается по порядку времени
+            since = _wall_time(datetime.now(user_timezone()) - timedelta(days=READER_HISTORY_DAYS), 0)
+            response = activity_cache.get(
+                f"{ACTIVITY_SERVICE_URL}/activities/child/{child_id}/timeline",
+                params={"from": since.isoformat(), "limit": READER_LIMIT, "order": "desc"}
+            )
+            entries = response.json()
+            return entries[::-1] if isinstance(entries, list) else entries
     except Exception as e:
         return {"error": str(e)}
 
@@ -49,17 +101,17 @@ def database_writer_tool(activity_type: str, data: Dict) -> Dict:
         if "sleep" in activity_type.lower() or "сон" in activity_type.lower():
             if 'start_time' not in data:
                 data['start_time'] = current_time
-            response = requests.post(f"{ACTIVITY_SERVICE_URL}/activities/sleep/", json=data)
+            response = http_client.post(f"{ACTIVITY_SERVICE_URL}/activities/sleep/", json=data, idempotency_key=_write_key("sleep"))
         elif "feeding" in activity_type.lower() or "корм" in activity_type.lower():
             if 'time' not in data:
                 data['time'] = current_time
             if 'type' not in data:
                 data['type'] = 'unknown'
-            response = requests.post(f"{ACTIVITY_SERVICE_URL}/activities/feeding/", json=data)
+            response = http_client.post(f"{ACTIVITY_SERVICE_URL}/activities/feeding/", json=data, idempotency_key=_write_key("feeding"))
         elif "walk" in activity_type.lower() or "прогул" in activity_type.lower():
             if 'start_time' not in data:
                 data['start_time'] = current_time
-            response = requests.post(f"{ACTIVITY_SERVICE_URL}/activities/walk/", json=data)
+            response = http_client.post(f"{ACTIVITY_SERVICE_URL}/activities/walk/", json=data, idempotency_key=_write_key("walk"))
         elif "diaper" in activity_type.lower() or "подгуз" in activity_type.lower() or "пописал" in activity_type.lower() or "покакал" in activity_type.lower():
             if 'time' not in data:
                 data['time'] = current_time
@@ -71,24 +123,27 @@ def database_writer_tool(activity_type: str, data: Dict) -> Dict:
                     data['type'] = 'pee'
                 else:
                     data['type'] = 'both'
-            response = requests.post(f"{ACTIVITY_SERVICE_URL}/activities/diaper/", json=data)
+            response = http_client.post(f"{ACTIVITY_SERVICE_URL}/activities/diaper/", json=data, idempotency_key=_write_key("diaper"))
         elif "temperature" in activity_type.lower() or "температур" in activity_type.lower() or "градус" in activity_type.lower():
             if 'time' not in data:
                 data['time'] = current_time
-            response = requests.post(f"{ACTIVITY_SERVICE_URL}/activities/temperature/", json=data)
+            response = http_client.post(f"{ACTIVITY_SERVICE_URL}/activities/temperature/", json=data, idempotency_key=_write_key("temperature"))
         elif "medication" in activity_type.lower() or "лекарств" in activity_type.lower() or "таблет" in activity_type.lower():
             if 'time' not in data:
                 data['time'] = current_time
-            response = requests.post(f"{ACTIVITY_SERVICE_URL}/activities/medication/", json=data)
+            response = http_client.post(f"{ACTIVITY_SERVICE_URL}/activities/medication/", json=data, idempotency_key=_write_key("medication"))
         elif "mood" in activity_type.lower() or "настроен" in activity_type.lower():
             if 'time' not in data:
                 data['time'] = current_time
-            response = requests.post(f"{ACTIVITY_SERVICE_URL}/activities/mood/", json=data)
+            response = http_client.post(f"{ACTIVITY_SERVICE_URL}/activities/mood/", json=data, idempotency_key=_write_key("mood"))
         else:
             return {"error": f"Unknown activity type: {activity_type}"}
 
         if response.status_code == 200:
             return response.json()
+        if response.status_code == 422 and "Idempotency-Key" in str(response.json().get("detail")):
+            # Это сообщение уже обрабатывалось и запись сделана, повтор лишь вычислил ее иначе
+            return {"status": "already_recorded"}
         return {"error": f"Status code: {response.status_code}"}
     except Exception as e:
         return {"error": str(e)}
@@ -101,11 +156,10 @@ def end_sleep_tool(sleep_id: int, end_time: str) -> Dict:
     try:
         # Убедимся что end_time в правильном формате
         if not end_time:
-            moscow_tz = pytz.timezone('Europe/Moscow')
-            end_time = datetime.now(moscow_tz).isoformat()
+            end_time = datetime.now(user_timezone()).isoformat()
 
-        response = requests.put(
-            f"{ACTIVITY_SERVICE_URL}/activities/sleep/{sleep_id}/end?end_time={end_time}"
+        response = http_client.put(
+            f"{ACTIVITY_SERVICE_URL}/activities/sleep/{sleep_id}/end", params={"end_time": end_time}
         )
         if response.status_code == 200:
             return response.json()
@@ -113,14 +167,75 @@ def end_sleep_tool(sleep_id: int, end_time: str) -> Dict:
     except Exception as e:
         return {"error": str(e)}
 
+@tool
+def session_tool(child_id: int, kind: str, action: str, time: str = "") -> Dict:
+    """
+    Начинает или завершает сон/прогулку одним запросом, без поиска открытой сессии
+    kind: "sleep" или "walk"
+    action: "start" или "stop"
+    time: время в ISO формате; пусто - сейчас
+    """
+    try:
+        payload = {("start_time" if action == "start" else "end_time"): time} if time else None
+        response = http_client.post(
+            f"{ACTIVITY_SERVICE_URL}/children/{child_id}/sessions/{kind}/{action}", json=payload,
+            idempotency_key=_write_key(f"{kind}-{action}")
+        )
+        if response.status_code == 200:
+            return response.json()
+        if response.status_code == 409:
+            return {"error": "already_in_progress", "detail": response.json().get("detail")}
+        if response.status_code == 404:
+            return {"error": "not_found", "detail": response.json().get("detail")}
+        return {"error": f"Status code: {response.status_code}"}
+    except Exception as e:
+        return {"error": str(e)}
+
+@tool
+def distribution_tool(child_id: int, days: int = 30) -> Dict:
+    """
+    Типичные интервалы за последние days дней, посчитанные сервером:
+    sleep_duration - длительность сна, wake_window - бодрствование между снами,
+    feeding_interval - промежуток между кормлениями.
+    Для каждого: count, p10/p50/p90 (медиана - p50), min/max/avg в минутах
+    """
+    try:
+        response = activity_cache.get(
+            f"{ACTIVITY_SERVICE_URL}/analytics/child/{child_id}/distributions", params={"days": days}
+        )
+        if response.status_code == 200:
+            data = response.json()
+            # Гистограмма нужна графикам, в контекст модели хватает перцентилей
+            for metric in ("sleep_duration", "wake_window", "feeding_interval"):
+                data[metric].pop("histogram", None)
+            return data
+        return {"error": f"Status code: {response.status_code}"}
+    except Exception as e:
+        return {"error": str(e)}
+
+@tool
+def prediction_tool(child_id: int) -> Dict:
+    """
+    Прогноз следующего сна и кормления по обычным интервалам ребенка.
+    sleep: asleep (спит ли сейчас), expected_wake, next_sleep; feeding: last, next.
+    Время в ISO (UTC), интервалы в минутах; null - данных пока мало
+    """
+    try:
+        response = activity_cache.get(f"{ACTIVITY_SERVICE_URL}/analytics/child/{child_id}/predict")
+        if response.status_code == 200:
+            return response.json()
+        return {"error": f"Status code: {response.status_code}"}
+    except Exception as e:
+        return {"error": str(e)}
+
 @tool
 def time_calculator_tool(time_expression: str = "сейчас") -> str:
     """
     Преобразует относительное время в абсолютное ISO формат
     Примеры: "5 минут назад", "час назад", "утром", "вчера вечером"
     """
-    moscow_tz = pytz.timezone('Europe/Moscow')
-    now = datetime.now(moscow_tz)
+    zone = user_timezone()
+    now = datetime.now(zone)
 
     if not time_expression or time_expression == "":
         time_expression = "сейчас"
@@ -143,32 +258,32 @@ def time_calculator_tool(time_expression: str = "сейчас") -> str:
     # Обработка частей дня
     if any(word in time_expression for word in ["утром", "утра"]):
         if "вчера" in time_expression or "позавчера" in time_expression:
-            result = base_date.replace(hour=8, minute=0, second=0, microsecond=0)
+            result = _wall_time(base_date, 8)
         elif now.hour >= 12:  # Если сейчас после полудня, "утром" = сегодня утром
-            result = now.replace(hour=8, minute=0, second=0, microsecond=0)
+            result = _wall_time(now, 8)
         else:
             result = now  # Если сейчас утро, то "утром" = сейчас
     elif any(word in time_expression for word in ["днем", "в обед", "обед"]):
         if "вчера" in time_expression or "позавчера" in time_expression:
-            result = base_date.replace(hour=13, minute=0, second=0, microsecond=0)
+            result = _wall_time(base_date, 13)
         elif now.hour >= 15:
-            result = now.replace(hour=13, minute=0, second=0, microsecond=0)
+            result = _wall_time(now, 13)
         else:
             result = now
     elif any(word in time_expression for word in ["вечером", "вечера"]):
         if "вчера" in time_expression or "позавчера" in time_expression:
-            result = base_date.replace(hour=19, minute=0, second=0, microsecond=0)
+            result = _wall_time(base_date, 19)
         elif now.hour >= 21:
-            result = now.replace(hour=19, minute=0, second=0, microsecond=0)
+            result = _wall_time(now, 19)
         else:
             result = now
     elif any(word in time_expression for word in ["ночью", "ночь"]):
         if "вчера" in time_expression:
-            result = base_date.replace(hour=23, minute=0, second=0, microsecond=0)
+            result = _wall_time(base_date, 23)
         elif "позавчера" in time_expression:
-            result = base_date.replace(hour=23, minute=0, second=0, microsecond=0)
+            result = _wall_time(base_date, 23)
         else:
-            result = now.replace(hour=2, minute=0, second=0, microsecond=0)
+            result = _wall_time(now, 2)
 
     # Обработка относительного времени "X назад"
     elif "назад" in time_expression:
@@ -203,14 +318,14 @@ def time_calculator_tool(time_expression: str = "сейчас") -> str:
         if ":" in time_part:
             try:
                 time_obj = datetime.strptime(time_part.split()[0], "%H:%M")
-                result = base_date.replace(hour=time_obj.hour, minute=time_obj.minute, second=0, microsecond=0)
+                result = _wall_time(base_date, time_obj.hour, time_obj.minute)
             except:
                 result = now
         # Обработка "в 2 часа", "в 14 часов"
         elif "час" in time_part:
             hour = extract_number(time_part)
             if hour > 0 and hour <= 24:
-                result = base_date.replace(hour=hour, minute=0, second=0, microsecond=0)
+                result = _wall_time(base_date, hour)
             else:
                 result = now
         else:
@@ -236,13 +351,14 @@ def time_calculator_tool(time_expression: str = "сейчас") -> str:
         if time_pattern:
             hour, minute = int(time_pattern.group(1)), int(time_pattern.group(2))
             if 0 <= hour <= 23 and 0 <= minute <= 59:
-                result = base_date.replace(hour=hour, minute=minute, second=0, microsecond=0)
+                result = _wall_time(base_date, hour, minute)
             else:
                 result = now
         else:
             result = now
 
-    return result.isoformat()
+    # После сложения с timedelta смещение осталось от now: переводим в смещение получившегося момента
+    return zone.normalize(result).isoformat()
 
 def extract_number(text: str) -> int:
     """Извлекает число из текста"""
@@ -296,7 +412,7 @@ def relative_time_tool(event_type: str, time_offset: str, child_id: int) -> str:
         else:
             return datetime.now(pytz.UTC).isoformat()
 
-        response = requests.get(f"{ACTIVITY_SERVICE_URL}{endpoint}")
+        response = activity_cache.get(f"{ACTIVITY_SERVICE_URL}{endpoint}")
         if response.status_code != 200:
             return datetime.now(pytz.UTC).isoformat()
 
@@ -0,0 +1,98 @@
+-- Проверка планов горячих запросов: каждый должен идти через составной индекс (child_id, время).
+-- Засевает тестовые данные внутри транзакции и откатывает их, поэтому безопасна для любой базы.
+--
+--   docker-compose exec postgres psql -U babyflow -d babyflow -v ON_ERROR_STOP=1 -f /checks/index_usage.sql
+
+BEGIN;
+
+INSERT INTO users (telegram_id) SELECT -g FROM generate_series(1, 200) g;
+INSERT INTO children (user_id, name, birth_date)
+SELECT id, 'plan-check', DATE '2024-01-01' FROM users WHERE telegram_id < 0;
+
+INSERT INTO sleep_activities (child_id, start_time, end_time, duration_minutes)
+SELECT c.id, now() - g * INTERVAL '3 hours', now() - g * INTERVAL '3 hours' + INTERVAL '90 minutes', 90
+FROM children c, generate_series(1, 300) g WHERE c.name = 'plan-check';
+INSERT INTO feeding_activities (child_id, time, type, amount_ml)
+SELECT c.id, now() - g * INTERVAL '3 hours', 'смесь', 120
+FROM children c, generate_series(1, 300) g WHERE c.name = 'plan-check';
+INSERT INTO walk_activities (child_id, start_time, end_time, duration_minutes)
+SELECT c.id, now() - g * INTERVAL '1 day', now() - g * INTERVAL '1 day' + INTERVAL '1 hour', 60
+FROM children c, generate_series(1, 60) g WHERE c.name = 'plan-check';
+INSERT INTO diaper_activities (child_id, time, type)
+SELECT c.id, now() - g * INTERVAL '3 hours', 'pee'
+FROM children c, generate_series(1, 300) g WHERE c.name = 'plan-check';
+INSERT INTO temperature_activities (child_id, time, temperature)
+SELECT c.id, now() - g * INTERVAL '1 day', 36.6
+FROM children c, generate_series(1, 60) g WHERE c.name = 'plan-check';
+INSERT INTO medication_activities (child_id, time, medication_name)
+SELECT c.id, now() - g * INTERVAL '1 day', 'plan-check'
+FROM children c, generate_series(1, 60) g WHERE c.name = 'plan-check';
+INSERT INTO mood_activities (child_id, time, mood)
+SELECT c.id, now() - g * INTERVAL '1 day', 'спокойное'
+FROM children c, generate_series(1, 60) g WHERE c.name = 'plan-check';
+-- Одна открытая сессия сна и прогулки на ребенка
+INSERT INTO sleep_activities (child_id, start_time)
+SELECT id, now() FROM children WHERE name = 'plan-check';
+INSERT INTO walk_activities (child_id, start_time)
+SELECT id, now() FROM children WHERE name = 'plan-check';
+
+ANALYZE sleep_activities, feeding_activities, walk_activities, diaper_activities,
+    temperature_activities, medication_activities, mood_activities;
+
+DO $$
+DECLARE
+    probe_child INTEGER;
+    check_case RECORD;
+    plan TEXT;
+    partition_index TEXT;
+BEGIN
+    SELECT min(id) INTO probe_child FROM children WHERE name = 'plan-check';
+
+    FOR check_case IN
+        SELECT * FROM (VALUES
+            ('sleep_activities', 'start_time', 'idx_sleep_child_start_time'),
+            ('feeding_activities', 'time', 'idx_feeding_child_time'),
+            ('walk_activities', 'start_time', 'idx_walk_child_start_time'),
+            ('diaper_activities', 'time', 'idx_diaper_child_time'),
+            ('temperature_activities', 'time', 'idx_temperature_child_time'),
+            ('medication_activities', 'time', 'idx_medication_child_time'),
+            ('mood_activities', 'time', 'idx_mood_child_time')
+        ) AS t(table_name, time_column, index_name)
+    LOOP
+        EXECUTE format(
+            'EXPLAIN (FORMAT JSON) SELECT * FROM %I WHERE child_id = %s AND %I >= now() - INTERVAL ''1 day''',
+            check_case.table_name, probe_child, check_case.time_column
+        ) INTO plan;
+        -- У секционированных таблиц текущий месяц должен читаться по индексу своей секции;
+        -- пустые будущие секции планировщик вправе просмотреть последовательно
+        IF EXISTS (SELECT 1 FROM pg_class WHERE relname = check_case.table_name AND relkind = 'p') THEN
+            partition_index := format('%s_%s_child_id_time_idx', check_case.table_name,
+                                      to_char(now() AT TIME ZONE 'Europe/Moscow', 'YYYY_MM'));
+            IF position(partition_index IN plan) = 0 THEN
+                RAISE EXCEPTION '% не использует %: %', check_case.table_name, partition_index, plan;
+            END IF;
+        ELSIF position(check_case.index_name IN plan) = 0 THEN
+            RAISE EXCEPTION '% не использует %: %', check_case.table_name, check_case.index_name, plan;
+        END IF;
+    END LOOP;
+
+    EXECUTE format(
+        'EXPLAIN (FORMAT JSON) SELECT * FROM sleep_activities WHERE child_id = %s AND end_time IS NULL',
+        probe_child
+    ) INTO plan;
+    IF position('uq_sleep_open' IN plan) = 0 THEN
+        RAISE EXCEPTION 'поиск открытого сна не использует uq_sleep_open: %', plan;
+    END IF;
+
+    EXECUTE format(
+        'EXPLAIN (FORMAT JSON) SELECT * FROM walk_activities WHERE child_id = %s AND end_time IS NULL',
+        probe_child
+    ) INTO plan;
+    IF position('uq_walk_open' IN plan) = 0 THEN
+        RAISE EXCEPTION 'поиск открытой прогулки не использует uq_walk_open: %', plan;
+    END IF;
+
+    RAISE NOTICE 'Все планы используют составные индексы';
+END $$;
+
+ROLLBACK;
@@ -7,7 +7,7 @@ CREATE TABLE IF NOT EXISTS users (
     username VARCHAR(255),
     first_name VARCHAR(255),
     last_name VARCHAR(255),
-    timezone VARCHAR(50) DEFAULT 'Europe/Moscow',
+    timezone VARCHAR(50) NOT NULL DEFAULT 'Europe/Moscow',
     language VARCHAR(10) DEFAULT 'ru',
     created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP,
     updated_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
@@ -52,9 +52,14 @@ CREATE TABLE IF NOT EXISTS sleep_activities (
     updated_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
 );
 
+-- Точечные активности (кормление, подгузники, температура, лекарства, настроение) секционированы
+-- по месяцам поля time, см. create_activity_partition в конце файла. Сон и прогулки остаются
+-- обычными таблицами: уникальный индекс открытой сессии невозможен на секционированной таблице
+-- без ключа секционирования.
+
 -- Активности: Кормление
 CREATE TABLE IF NOT EXISTS feeding_activities (
-    id SERIAL PRIMARY KEY,
+    id SERIAL,
     child_id INTEGER NOT NULL REFERENCES children(id) ON DELETE CASCADE,
     conversation_id INTEGER REFERENCES conversations(id),
     time TIMESTAMP WITH TIME ZONE NOT NULL,
@@ -65,8 +70,9 @@ CREATE TABLE IF NOT EXISTS feeding_activities (
     side VARCHAR(20), -- левая/правая для ГВ
     notes TEXT,
     created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP,
-    updated_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
-);
+    updated_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (id, time)
+) PARTITION BY RANGE (time);
 
 -- Активности: Прогулки
 CREATE TABLE IF NOT EXISTS walk_activities (
@@ -85,7 +91,7 @@ CREATE TABLE IF NOT EXISTS walk_activities (
 
 -- Активности: Подгузники
 CREATE TABLE IF NOT EXISTS diaper_activities (
-    id SERIAL PRIMARY KEY,
+    id SERIAL,
     child_id INTEGER NOT NULL REFERENCES children(id) ON DELETE CASCADE,
     conversation_id INTEGER REFERENCES conversations(id),
     time TIMESTAMP WITH TIME ZONE NOT NULL,
@@ -94,12 +100,13 @@ CREATE TABLE IF NOT EXISTS diaper_activities (
     color VARCHAR(50), -- цвет
     notes TEXT,
     created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP,
-    updated_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
-);
+    updated_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (id, time)
+) PARTITION BY RANGE (time);
 
 -- Активности: Температура
 CREATE TABLE IF NOT EXISTS temperature_activities (
-    id SERIAL PRIMARY KEY,
+    id SERIAL,
     child_id INTEGER NOT NULL REFERENCES children(id) ON DELETE CASCADE,
     conversation_id INTEGER REFERENCES conversations(id),
     time TIMESTAMP WITH TIME ZONE NOT NULL,
@@ -107,12 +114,13 @@ CREATE TABLE IF NOT EXISTS temperature_activities (
     measurement_type VARCHAR(50), -- подмышка, лоб, ректально
     notes TEXT,
     created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP,
-    updated_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
-);
+    updated_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (id, time)
+) PARTITION BY RANGE (time);
 
 -- Активности: Лекарства
 CREATE TABLE IF NOT EXISTS medication_activities (
-    id SERIAL PRIMARY KEY,
+    id SERIAL,
     child_id INTEGER NOT NULL REFERENCES children(id) ON DELETE CASCADE,
     conversation_id INTEGER REFERENCES conversations(id),
     time TIMESTAMP WITH TIME ZONE NOT NULL,
@@ -120,12 +128,13 @@ CREATE TABLE IF NOT EXISTS medication_activities (
     dosage VARCHAR(100), -- 5мл, 1 таблетка, 2 капли
     notes TEXT,
     created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP,
-    updated_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
-);
+    updated_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (id, time)
+) PARTITION BY RANGE (time);
 
 -- Активности: Настроение
 CREATE TABLE IF NOT EXISTS mood_activities (
-    id SERIAL PRIMARY KEY,
+    id SERIAL,
     child_id INTEGER NOT NULL REFERENCES children(id) ON DELETE CASCADE,
     conversation_id INTEGER REFERENCES conversations(id),
     time TIMESTAMP WITH TIME ZONE NOT NULL,
@@ -133,9 +142,74 @@ CREATE TABLE IF NOT EXISTS mood_activities (
     intensity INTEGER, -- 1-5 шкала интенсивности
     notes TEXT,
     created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP,
+    updated_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (id, time)
+) PARTITION BY RANGE (time);
+
+-- Дневные агрегаты по ребенку: обновляются в той же транзакции, что и запись активности,
+-- аналитика читает их вместо сырых таблиц. День считается в часовом поясе владельца (users.timezone).
+CREATE TABLE IF NOT EXISTS child_daily_rollups (
+    child_id INTEGER NOT NULL REFERENCES children(id) ON DELETE CASCADE,
+    day DATE NOT NULL,
+    sleep_count INTEGER NOT NULL DEFAULT 0,
+    sleep_minutes INTEGER NOT NULL DEFAULT 0,
+    feeding_count INTEGER NOT NULL DEFAULT 0,
+    feeding_ml INTEGER NOT NULL DEFAULT 0,
+    feeding_ml_count INTEGER NOT NULL DEFAULT 0, -- кормления с указанным объемом, для среднего
+    feeding_by_type JSONB NOT NULL DEFAULT '{}',
+    diaper_count INTEGER NOT NULL DEFAULT 0,
+    diaper_by_type JSONB NOT NULL DEFAULT '{}',
+    walk_count INTEGER NOT NULL DEFAULT 0,
+    walk_minutes INTEGER NOT NULL DEFAULT 0,
+    temperature_count INTEGER NOT NULL DEFAULT 0,
+    temperature_sum DECIMAL(8,1) NOT NULL DEFAULT 0,
+    temperature_min DECIMAL(3,1),
+    temperature_max DECIMAL(3,1),
+    PRIMARY KEY (child_id, day)
+);
+
+-- Версия данных ребенка: растет при каждой записи, из нее строится ETag чтений
+CREATE TABLE IF NOT EXISTS child_data_versions (
+    child_id INTEGER PRIMARY KEY REFERENCES children(id) ON DELETE CASCADE,
+    version BIGINT NOT NULL DEFAULT 0,
+    updated_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
+);
+
+-- Ключи идемпотентности создающих запросов и их ответы (см. activity-service/idempotency.py)
+CREATE TABLE IF NOT EXISTS idempotency_keys (
+    key VARCHAR(255) PRIMARY KEY,
+    endpoint VARCHAR(255) NOT NULL,
+    request_hash VARCHAR(64) NOT NULL,
+    response JSONB,
+    status_code INTEGER,
+    created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
+);
+CREATE INDEX IF NOT EXISTS idx_idempotency_keys_created_at ON idempotency_keys (created_at);
+
+-- Параметры прогноза следующего сна и кормления (см. activity-service/predictions.py).
+-- Обновляются при записи; отсутствующая строка подбирается заново при первом чтении.
+CREATE TABLE IF NOT EXISTS child_prediction_models (
+    child_id INTEGER PRIMARY KEY REFERENCES children(id) ON DELETE CASCADE,
+    state JSONB NOT NULL,
     updated_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
 );
 
+-- Задания импорта истории из CSV/JSON и их прогресс (см. activity-service/imports.py)
+CREATE TABLE IF NOT EXISTS import_jobs (
+    id SERIAL PRIMARY KEY,
+    child_id INTEGER NOT NULL REFERENCES children(id) ON DELETE CASCADE,
+    format VARCHAR(10) NOT NULL,
+    status VARCHAR(20) NOT NULL DEFAULT 'pending',
+    total_rows INTEGER,
+    validated_rows INTEGER NOT NULL DEFAULT 0,
+    inserted_rows INTEGER NOT NULL DEFAULT 0,
+    failed_rows INTEGER NOT NULL DEFAULT 0,
+    error TEXT,
+    error_file TEXT,
+    created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP,
+    finished_at TIMESTAMP WITH TIME ZONE
+);
+
 -- Группы (для семейных чатов)
 CREATE TABLE IF NOT EXISTS groups (
     id SERIAL PRIMARY KEY,
@@ -154,31 +228,48 @@ CREATE TABLE IF NOT EXISTS user_groups (
 );
 
 -- Индексы для производительности
+CREATE INDEX idx_children_user_id ON children(user_id);
 CREATE INDEX idx_conversations_user_id ON conversations(user_id);
 CREATE INDEX idx_conversations_child_id ON conversations(child_id);
 CREATE INDEX idx_conversations_timestamp ON conversations(timestamp);
 
-CREATE INDEX idx_sleep_child_id ON sleep_activities(child_id);
+-- Составные индексы (child_id, время): все горячие запросы фильтруют по ребенку и диапазону времени
+CREATE INDEX idx_sleep_child_start_time ON sleep_activities(child_id, start_time);
 CREATE INDEX idx_sleep_start_time ON sleep_activities(start_time);
+-- Не больше одного открытого сна на ребенка; по нему же ищется открытый сон
+CREATE UNIQUE INDEX uq_sleep_open ON sleep_activities(child_id) WHERE end_time IS NULL;
 
-CREATE INDEX idx_feeding_child_id ON feeding_activities(child_id);
+CREATE INDEX idx_feeding_child_time ON feeding_activities(child_id, time);
 CREATE INDEX idx_feeding_time ON feeding_activities(time);
 
-CREATE INDEX idx_walk_child_id ON walk_activities(child_id);
+CREATE INDEX idx_walk_child_start_time ON walk_activities(child_id, start_time);
 CREATE INDEX idx_walk_start_time ON walk_activities(start_time);
+-- Не больше одной открытой прогулки на ребенка
+CREATE UNIQUE INDEX uq_walk_open ON walk_activities(child_id) WHERE end_time IS NULL;
 
-CREATE INDEX idx_diaper_child_id ON diaper_activities(child_id);
+CREATE INDEX idx_diaper_child_time ON diaper_activities(child_id, time);
 CREATE INDEX idx_diaper_time ON diaper_activities(time);
 
-CREATE INDEX idx_temperature_child_id ON temperature_activities(child_id);
+CREATE INDEX idx_temperature_child_time ON temperature_activities(child_id, time);
 CREATE INDEX idx_temperature_time ON temperature_activities(time);
 
-CREATE INDEX idx_medication_child_id ON medication_activities(child_id);
+CREATE INDEX idx_medication_child_time ON medication_activities(child_id, time);
 CREATE INDEX idx_medication_time ON medication_activities(time);
 
-CREATE INDEX idx_mood_child_id ON mood_activities(child_id);
+CREATE INDEX idx_mood_child_time ON mood_activities(child_id, time);
 CREATE INDEX idx_mood_time ON mood_activities(time);
 
+-- Сложение счетчиков вида {"pee": 2, "poop": 1}
+CREATE OR REPLACE FUNCTION jsonb_add_counts(a JSONB, b JSONB)
+RETURNS JSONB AS $$
+    SELECT COALESCE(jsonb_object_agg(key, total), '{}'::jsonb)
+    FROM (
+        SELECT key, SUM(value::integer) AS total
+        FROM (SELECT * FROM jsonb_each_text(a) UNION ALL SELECT * FROM jsonb_each_text(b)) counts
+        GROUP BY key
+    ) totals
+$$ LANGUAGE sql IMMUTABLE;
+
 -- Функция для автообновления updated_at
 CREATE OR REPLACE FUNCTION update_updated_at_column()
 RETURNS TRIGGER AS $$
@@ -214,4 +305,156 @@ CREATE TRIGGER update_medication_updated_at BEFORE UPDATE ON medication_activiti
     FOR EACH ROW EXECUTE FUNCTION update_updated_at_column();
 
 CREATE TRIGGER update_mood_updated_at BEFORE UPDATE ON mood_activities
-    FOR EACH ROW EXECUTE FUNCTION update_updated_at_column();
\ No newline at end of file
+    FOR EACH ROW EXECUTE FUNCTION update_updated_at_column();
+
+-- Лента изменений (GET /changes): NOTIFY activity_changes после вставки и изменения активностей,
+-- одно уведомление на ребенка за оператор. Триггер с таблицей переходов - только на одно событие
+-- Аргументы триггера: тип активности, колонка времени, колонка конца (или '')
+CREATE OR REPLACE FUNCTION notify_activity_changes()
+RETURNS TRIGGER AS $$
+DECLARE
+    change RECORD;
+BEGIN
+    FOR change IN
+        SELECT child_id, max(total) AS total,
+               jsonb_agg(jsonb_build_object('id', id, 'time', row_data -> TG_ARGV[1],
+                                            'end_time', row_data -> TG_ARGV[2]) ORDER BY id)
+                   FILTER (WHERE position <= 20) AS rows
+        FROM (
+            SELECT n.child_id, n.id, to_jsonb(n) AS row_data,
+                   row_number() OVER (PARTITION BY n.child_id ORDER BY n.id) AS position,
+                   count(*) OVER (PARTITION BY n.child_id) AS total
+            FROM changed_rows n
+        ) changed
+        GROUP BY child_id
+    LOOP
+        PERFORM pg_notify('activity_changes', json_build_object(
+            'child_id', change.child_id, 'type', TG_ARGV[0], 'op', lower(TG_OP),
+            'count', change.total, 'rows', change.rows
+        )::text);
+    END LOOP;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER notify_sleep_insert AFTER INSERT ON sleep_activities REFERENCING NEW TABLE AS changed_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION notify_activity_changes('sleep', 'start_time', 'end_time');
+
+CREATE TRIGGER notify_sleep_update AFTER UPDATE ON sleep_activities REFERENCING NEW TABLE AS changed_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION notify_activity_changes('sleep', 'start_time', 'end_time');
+
+CREATE TRIGGER notify_feeding_insert AFTER INSERT ON feeding_activities REFERENCING NEW TABLE AS changed_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION notify_activity_changes('feeding', 'time', '');
+
+CREATE TRIGGER notify_feeding_update AFTER UPDATE ON feeding_activities REFERENCING NEW TABLE AS changed_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION notify_activity_changes('feeding', 'time', '');
+
+CREATE TRIGGER notify_walk_insert AFTER INSERT ON walk_activities REFERENCING NEW TABLE AS changed_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION notify_activity_changes('walk', 'start_time', 'end_time');
+
+CREATE TRIGGER notify_walk_update AFTER UPDATE ON walk_activities REFERENCING NEW TABLE AS changed_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION notify_activity_changes('walk', 'start_time', 'end_time');
+
+CREATE TRIGGER notify_diaper_insert AFTER INSERT ON diaper_activities REFERENCING NEW TABLE AS changed_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION notify_activity_changes('diaper', 'time', '');
+
+CREATE TRIGGER notify_diaper_update AFTER UPDATE ON diaper_activities REFERENCING NEW TABLE AS changed_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION notify_activity_changes('diaper', 'time', '');
+
+CREATE TRIGGER notify_temperature_insert AFTER INSERT ON temperature_activities REFERENCING NEW TABLE AS changed_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION notify_activity_changes('temperature', 'time', '');
+
+CREATE TRIGGER notify_temperature_update AFTER UPDATE ON temperature_activities REFERENCING NEW TABLE AS changed_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION notify_activity_changes('temperature', 'time', '');
+
+CREATE TRIGGER notify_medication_insert AFTER INSERT ON medication_activities REFERENCING NEW TABLE AS changed_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION notify_activity_changes('medication', 'time', '');
+
+CREATE TRIGGER notify_medication_update AFTER UPDATE ON medication_activities REFERENCING NEW TABLE AS changed_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION notify_activity_changes('medication', 'time', '');
+
+CREATE TRIGGER notify_mood_insert AFTER INSERT ON mood_activities REFERENCING NEW TABLE AS changed_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION notify_activity_changes('mood', 'time', '');
+
+CREATE TRIGGER notify_mood_update AFTER UPDATE ON mood_activities REFERENCING NEW TABLE AS changed_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION notify_activity_changes('mood', 'time', '');
+
+-- Помесячные секции точечных активностей. Границы месяца - по Москве, а дни
+-- child_daily_rollups - по поясу владельца (users.timezone), поэтому у детей
+-- из других поясов крайний день месяца может лежать в двух секциях.
+-- Секция DEFAULT принимает строки вне созданных месяцев; при создании секции
+-- строки ее месяца переносятся из DEFAULT.
+CREATE TABLE IF NOT EXISTS activity_archives (
+    partition_name VARCHAR(100) PRIMARY KEY,
+    table_name VARCHAR(100) NOT NULL,
+    range_start TIMESTAMP WITH TIME ZONE NOT NULL,
+    range_end TIMESTAMP WITH TIME ZONE NOT NULL,
+    row_count BIGINT NOT NULL,
+    path TEXT NOT NULL,
+    archived_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE OR REPLACE FUNCTION create_activity_partition(parent TEXT, month DATE)
+RETURNS TEXT AS $$
+DECLARE
+    new_partition TEXT := format('%s_%s', parent, to_char(month, 'YYYY_MM'));
+    range_start TIMESTAMPTZ := date_trunc('month', month::timestamp) AT TIME ZONE 'Europe/Moscow';
+    range_end TIMESTAMPTZ := (date_trunc('month', month::timestamp) + INTERVAL '1 month') AT TIME ZONE 'Europe/Moscow';
+BEGIN
+    IF to_regclass(new_partition) IS NOT NULL
+       OR EXISTS (SELECT 1 FROM activity_archives a WHERE a.partition_name = new_partition) THEN
+        RETURN NULL;
+    END IF;
+
+    EXECUTE format('CREATE TABLE %I (LIKE %I INCLUDING DEFAULTS INCLUDING CONSTRAINTS)', new_partition, parent);
+    EXECUTE format(
+        'WITH moved AS (DELETE FROM %I WHERE time >= $1 AND time < $2 RETURNING *) INSERT INTO %I SELECT * FROM moved',
+        parent || '_default', new_partition
+    ) USING range_start, range_end;
+    EXECUTE format('ALTER TABLE %I ATTACH PARTITION %I FOR VALUES FROM (%L) TO (%L)',
+                   parent, new_partition, range_start, range_end);
+    RETURN new_partition;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Секции на текущий и months_ahead следующих месяцев, а также на месяцы,
+-- строки которых успели попасть в DEFAULT. Возвращает созданные секции.
+CREATE OR REPLACE FUNCTION ensure_activity_partitions(months_ahead INTEGER DEFAULT 3)
+RETURNS SETOF TEXT AS $$
+DECLARE
+    parent TEXT;
+    month DATE;
+    created TEXT;
+BEGIN
+    FOREACH parent IN ARRAY ARRAY['feeding_activities', 'diaper_activities', 'temperature_activities',
+                                  'medication_activities', 'mood_activities'] LOOP
+        FOR month IN
+            SELECT date_trunc('month', now() AT TIME ZONE 'Europe/Moscow')::date + make_interval(months => n)
+            FROM generate_series(0, months_ahead) n
+        LOOP
+            created := create_activity_partition(parent, month);
+            IF created IS NOT NULL THEN
+                RETURN NEXT created;
+            END IF;
+        END LOOP;
+
+        FOR month IN EXECUTE format(
+            'SELECT DISTINCT date_trunc(''month'', time AT TIME ZONE ''Europe/Moscow'')::date FROM %I',
+            parent || '_default'
+        ) LOOP
+            created := create_activity_partition(parent, month);
+            IF created IS NOT NULL THEN
+                RETURN NEXT created;
+            END IF;
+        END LOOP;
+    END LOOP;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TABLE IF NOT EXISTS feeding_activities_default PARTITION OF feeding_activities DEFAULT;
+CREATE TABLE IF NOT EXISTS diaper_activities_default PARTITION OF diaper_activities DEFAULT;
+CREATE TABLE IF NOT EXISTS temperature_activities_default PARTITION OF temperature_activities DEFAULT;
+CREATE TABLE IF NOT EXISTS medication_activities_default PARTITION OF medication_activities DEFAULT;
+CREATE TABLE IF NOT EXISTS mood_activities_default PARTITION OF mood_activities DEFAULT;
+
+SELECT count(*) AS created_partitions FROM ensure_activity_partitions();
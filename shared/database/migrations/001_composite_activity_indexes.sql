@@ -0,0 +1,32 @@
+-- Составные индексы (child_id, время) для уже развернутых баз.
+-- init.sql выполняется только при первом старте контейнера, поэтому существующие базы
+-- обновляются этим файлом. CONCURRENTLY не блокирует запись, но не работает внутри
+-- транзакции: запускать через psql без -1 / --single-transaction.
+--
+--   docker-compose exec postgres psql -U babyflow -d babyflow -f /migrations/001_composite_activity_indexes.sql
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_sleep_child_start_time ON sleep_activities(child_id, start_time);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_sleep_open ON sleep_activities(child_id) WHERE end_time IS NULL;
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_feeding_child_time ON feeding_activities(child_id, time);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_walk_child_start_time ON walk_activities(child_id, start_time);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_diaper_child_time ON diaper_activities(child_id, time);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_temperature_child_time ON temperature_activities(child_id, time);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_medication_child_time ON medication_activities(child_id, time);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_mood_child_time ON mood_activities(child_id, time);
+
+-- Одноколоночные индексы по child_id покрываются ведущей колонкой составных
+DROP INDEX CONCURRENTLY IF EXISTS idx_sleep_child_id;
+DROP INDEX CONCURRENTLY IF EXISTS idx_feeding_child_id;
+DROP INDEX CONCURRENTLY IF EXISTS idx_walk_child_id;
+DROP INDEX CONCURRENTLY IF EXISTS idx_diaper_child_id;
+DROP INDEX CONCURRENTLY IF EXISTS idx_temperature_child_id;
+DROP INDEX CONCURRENTLY IF EXISTS idx_medication_child_id;
+DROP INDEX CONCURRENTLY IF EXISTS idx_mood_child_id;
+
+ANALYZE sleep_activities;
+ANALYZE feeding_activities;
+ANALYZE walk_activities;
+ANALYZE diaper_activities;
+ANALYZE temperature_activities;
+ANALYZE medication_activities;
+ANALYZE mood_activities;
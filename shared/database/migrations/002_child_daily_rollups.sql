@@ -0,0 +1,35 @@
+-- Таблица дневных агрегатов для аналитики.
+-- После применения заполнить ее по существующим данным:
+--
+--   docker-compose exec postgres psql -U babyflow -d babyflow -f /migrations/002_child_daily_rollups.sql
+--   docker-compose exec activity-service python rollups.py rebuild
+
+CREATE TABLE IF NOT EXISTS child_daily_rollups (
+    child_id INTEGER NOT NULL REFERENCES children(id) ON DELETE CASCADE,
+    day DATE NOT NULL,
+    sleep_count INTEGER NOT NULL DEFAULT 0,
+    sleep_minutes INTEGER NOT NULL DEFAULT 0,
+    feeding_count INTEGER NOT NULL DEFAULT 0,
+    feeding_ml INTEGER NOT NULL DEFAULT 0,
+    feeding_ml_count INTEGER NOT NULL DEFAULT 0,
+    feeding_by_type JSONB NOT NULL DEFAULT '{}',
+    diaper_count INTEGER NOT NULL DEFAULT 0,
+    diaper_by_type JSONB NOT NULL DEFAULT '{}',
+    walk_count INTEGER NOT NULL DEFAULT 0,
+    walk_minutes INTEGER NOT NULL DEFAULT 0,
+    temperature_count INTEGER NOT NULL DEFAULT 0,
+    temperature_sum DECIMAL(8,1) NOT NULL DEFAULT 0,
+    temperature_min DECIMAL(3,1),
+    temperature_max DECIMAL(3,1),
+    PRIMARY KEY (child_id, day)
+);
+
+CREATE OR REPLACE FUNCTION jsonb_add_counts(a JSONB, b JSONB)
+RETURNS JSONB AS $$
+    SELECT COALESCE(jsonb_object_agg(key, total), '{}'::jsonb)
+    FROM (
+        SELECT key, SUM(value::integer) AS total
+        FROM (SELECT * FROM jsonb_each_text(a) UNION ALL SELECT * FROM jsonb_each_text(b)) counts
+        GROUP BY key
+    ) totals
+$$ LANGUAGE sql IMMUTABLE;
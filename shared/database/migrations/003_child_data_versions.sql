@@ -0,0 +1,10 @@
+-- Версии данных детей для ETag / If-None-Match на чтениях.
+-- Отсутствующая строка означает версию 0, заполнять таблицу не нужно.
+--
+--   docker-compose exec postgres psql -U babyflow -d babyflow -f /migrations/003_child_data_versions.sql
+
+CREATE TABLE IF NOT EXISTS child_data_versions (
+    child_id INTEGER PRIMARY KEY REFERENCES children(id) ON DELETE CASCADE,
+    version BIGINT NOT NULL DEFAULT 0,
+    updated_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
+);
@@ -0,0 +1,42 @@
+-- Не больше одной открытой сессии сна и прогулки на ребенка.
+--
+-- Перед созданием уникальных индексов лишние открытые сессии закрываются: каждая,
+-- кроме последней, завершается временем начала следующей открытой сессии того же
+-- ребенка (новый сон не мог начаться, пока не кончился предыдущий). Запускать через
+-- psql без -1 / --single-transaction (CONCURRENTLY), затем пересчитать агрегаты:
+--
+--   docker-compose exec postgres psql -U babyflow -d babyflow -f /migrations/004_unique_open_sessions.sql
+--   docker-compose exec activity-service python rollups.py rebuild
+--
+-- Если между закрытием дублей и построением индекса успел появиться новый дубль,
+-- индекс не построится (останется INVALID): файл можно просто запустить повторно.
+
+WITH ordered AS (
+    SELECT id, lead(start_time) OVER (PARTITION BY child_id ORDER BY start_time, id) AS next_start
+    FROM sleep_activities
+    WHERE end_time IS NULL
+)
+UPDATE sleep_activities s
+SET end_time = o.next_start,
+    duration_minutes = trunc(extract(epoch FROM o.next_start - s.start_time) / 60)::integer
+FROM ordered o
+WHERE s.id = o.id AND o.next_start IS NOT NULL;
+
+WITH ordered AS (
+    SELECT id, lead(start_time) OVER (PARTITION BY child_id ORDER BY start_time, id) AS next_start
+    FROM walk_activities
+    WHERE end_time IS NULL
+)
+UPDATE walk_activities w
+SET end_time = o.next_start,
+    duration_minutes = trunc(extract(epoch FROM o.next_start - w.start_time) / 60)::integer
+FROM ordered o
+WHERE w.id = o.id AND o.next_start IS NOT NULL;
+
+DROP INDEX CONCURRENTLY IF EXISTS uq_sleep_open;
+CREATE UNIQUE INDEX CONCURRENTLY uq_sleep_open ON sleep_activities(child_id) WHERE end_time IS NULL;
+DROP INDEX CONCURRENTLY IF EXISTS uq_walk_open;
+CREATE UNIQUE INDEX CONCURRENTLY uq_walk_open ON walk_activities(child_id) WHERE end_time IS NULL;
+
+-- Обычный частичный индекс по открытому сну покрывается уникальным
+DROP INDEX CONCURRENTLY IF EXISTS idx_sleep_open;
@@ -0,0 +1,126 @@
+-- Помесячное секционирование точечных активностей (кормление, подгузники, температура,
+-- лекарства, настроение) на уже развернутой базе.
+--
+-- Каждая таблица пересоздается как секционированная по time, строки переносятся в
+-- помесячные секции. Миграция блокирует эти таблицы на время копирования: запускать
+-- в окно обслуживания, одной транзакцией:
+--
+--   docker-compose exec postgres psql -U babyflow -d babyflow -1 -v ON_ERROR_STOP=1 -f /migrations/005_partition_point_activities.sql
+--
+-- Сон и прогулки не секционируются: уникальный индекс открытой сессии (004) на
+-- секционированной таблице должен был бы включать ключ секционирования.
+
+CREATE TABLE IF NOT EXISTS activity_archives (
+    partition_name VARCHAR(100) PRIMARY KEY,
+    table_name VARCHAR(100) NOT NULL,
+    range_start TIMESTAMP WITH TIME ZONE NOT NULL,
+    range_end TIMESTAMP WITH TIME ZONE NOT NULL,
+    row_count BIGINT NOT NULL,
+    path TEXT NOT NULL,
+    archived_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE OR REPLACE FUNCTION create_activity_partition(parent TEXT, month DATE)
+RETURNS TEXT AS $$
+DECLARE
+    new_partition TEXT := format('%s_%s', parent, to_char(month, 'YYYY_MM'));
+    range_start TIMESTAMPTZ := date_trunc('month', month::timestamp) AT TIME ZONE 'Europe/Moscow';
+    range_end TIMESTAMPTZ := (date_trunc('month', month::timestamp) + INTERVAL '1 month') AT TIME ZONE 'Europe/Moscow';
+BEGIN
+    IF to_regclass(new_partition) IS NOT NULL
+       OR EXISTS (SELECT 1 FROM activity_archives a WHERE a.partition_name = new_partition) THEN
+        RETURN NULL;
+    END IF;
+
+    EXECUTE format('CREATE TABLE %I (LIKE %I INCLUDING DEFAULTS INCLUDING CONSTRAINTS)', new_partition, parent);
+    EXECUTE format(
+        'WITH moved AS (DELETE FROM %I WHERE time >= $1 AND time < $2 RETURNING *) INSERT INTO %I SELECT * FROM moved',
+        parent || '_default', new_partition
+    ) USING range_start, range_end;
+    EXECUTE format('ALTER TABLE %I ATTACH PARTITION %I FOR VALUES FROM (%L) TO (%L)',
+                   parent, new_partition, range_start, range_end);
+    RETURN new_partition;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Секции на текущий и months_ahead следующих месяцев, а также на месяцы,
+-- строки которых успели попасть в DEFAULT. Возвращает созданные секции.
+CREATE OR REPLACE FUNCTION ensure_activity_partitions(months_ahead INTEGER DEFAULT 3)
+RETURNS SETOF TEXT AS $$
+DECLARE
+    parent TEXT;
+    month DATE;
+    created TEXT;
+BEGIN
+    FOREACH parent IN ARRAY ARRAY['feeding_activities', 'diaper_activities', 'temperature_activities',
+                                  'medication_activities', 'mood_activities'] LOOP
+        FOR month IN
+            SELECT date_trunc('month', now() AT TIME ZONE 'Europe/Moscow')::date + make_interval(months => n)
+            FROM generate_series(0, months_ahead) n
+        LOOP
+            created := create_activity_partition(parent, month);
+            IF created IS NOT NULL THEN
+                RETURN NEXT created;
+            END IF;
+        END LOOP;
+
+        FOR month IN EXECUTE format(
+            'SELECT DISTINCT date_trunc(''month'', time AT TIME ZONE ''Europe/Moscow'')::date FROM %I',
+            parent || '_default'
+        ) LOOP
+            created := create_activity_partition(parent, month);
+            IF created IS NOT NULL THEN
+                RETURN NEXT created;
+            END IF;
+        END LOOP;
+    END LOOP;
+END;
+$$ LANGUAGE plpgsql;
+
+DO $$
+DECLARE
+    parent TEXT;
+    prefix TEXT;
+    legacy TEXT;
+    id_sequence TEXT;
+    month DATE;
+BEGIN
+    FOREACH parent IN ARRAY ARRAY['feeding_activities', 'diaper_activities', 'temperature_activities',
+                                  'medication_activities', 'mood_activities'] LOOP
+        IF EXISTS (SELECT 1 FROM pg_partitioned_table WHERE partrelid = parent::regclass) THEN
+            CONTINUE;
+        END IF;
+
+        prefix := split_part(parent, '_', 1);
+        legacy := parent || '_legacy';
+        EXECUTE format('LOCK TABLE %I IN ACCESS EXCLUSIVE MODE', parent);
+        id_sequence := pg_get_serial_sequence(parent, 'id');
+        EXECUTE format('ALTER TABLE %I RENAME TO %I', parent, legacy);
+        EXECUTE format('ALTER INDEX %I RENAME TO %I', parent || '_pkey', legacy || '_pkey');
+
+        EXECUTE format('CREATE TABLE %I (LIKE %I INCLUDING DEFAULTS INCLUDING CONSTRAINTS, PRIMARY KEY (id, time))
+                        PARTITION BY RANGE (time)', parent, legacy);
+        EXECUTE format('CREATE TABLE %I PARTITION OF %I DEFAULT', parent || '_default', parent);
+
+        FOR month IN EXECUTE format(
+            'SELECT DISTINCT date_trunc(''month'', time AT TIME ZONE ''Europe/Moscow'')::date FROM %I', legacy
+        ) LOOP
+            PERFORM create_activity_partition(parent, month);
+        END LOOP;
+
+        EXECUTE format('INSERT INTO %I SELECT * FROM %I', parent, legacy);
+        EXECUTE format('ALTER SEQUENCE %s OWNED BY %I.id', id_sequence, parent);
+        EXECUTE format('DROP TABLE %I', legacy);
+
+        EXECUTE format('ALTER TABLE %I ADD FOREIGN KEY (child_id) REFERENCES children(id) ON DELETE CASCADE', parent);
+        EXECUTE format('ALTER TABLE %I ADD FOREIGN KEY (conversation_id) REFERENCES conversations(id)', parent);
+
+        EXECUTE format('CREATE INDEX %I ON %I(child_id, time)', 'idx_' || prefix || '_child_time', parent);
+        EXECUTE format('CREATE INDEX %I ON %I(time)', 'idx_' || prefix || '_time', parent);
+        EXECUTE format('CREATE TRIGGER %I BEFORE UPDATE ON %I FOR EACH ROW EXECUTE FUNCTION update_updated_at_column()',
+                       'update_' || prefix || '_updated_at', parent);
+        EXECUTE format('ANALYZE %I', parent);
+    END LOOP;
+END $$;
+
+SELECT count(*) AS created_partitions FROM ensure_activity_partitions();
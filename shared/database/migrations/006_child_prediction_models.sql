@@ -0,0 +1,10 @@
+-- Параметры прогноза следующего сна и кормления.
+-- Таблица заполняется сама: строка ребенка подбирается по истории при первом запросе прогноза.
+--
+--   docker-compose exec postgres psql -U babyflow -d babyflow -f /migrations/006_child_prediction_models.sql
+
+CREATE TABLE IF NOT EXISTS child_prediction_models (
+    child_id INTEGER PRIMARY KEY REFERENCES children(id) ON DELETE CASCADE,
+    state JSONB NOT NULL,
+    updated_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
+);
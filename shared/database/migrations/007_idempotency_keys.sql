@@ -0,0 +1,13 @@
+-- Ключи идемпотентности создающих запросов (заголовок Idempotency-Key).
+-- Просроченные строки удаляет activity-service: python idempotency.py purge
+--
+--   docker-compose exec postgres psql -U babyflow -d babyflow -f /migrations/007_idempotency_keys.sql
+
+CREATE TABLE IF NOT EXISTS idempotency_keys (
+    key VARCHAR(255) PRIMARY KEY,
+    endpoint VARCHAR(255) NOT NULL,
+    request_hash VARCHAR(64) NOT NULL,
+    response JSONB,
+    created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
+);
+CREATE INDEX IF NOT EXISTS idx_idempotency_keys_created_at ON idempotency_keys (created_at);
@@ -0,0 +1,18 @@
+-- Задания импорта истории из CSV/JSON (POST /import/child/{id}) и их прогресс.
+--
+--   docker-compose exec postgres psql -U babyflow -d babyflow -f /migrations/008_import_jobs.sql
+
+CREATE TABLE IF NOT EXISTS import_jobs (
+    id SERIAL PRIMARY KEY,
+    child_id INTEGER NOT NULL REFERENCES children(id) ON DELETE CASCADE,
+    format VARCHAR(10) NOT NULL,
+    status VARCHAR(20) NOT NULL DEFAULT 'pending',
+    total_rows INTEGER,
+    validated_rows INTEGER NOT NULL DEFAULT 0,
+    inserted_rows INTEGER NOT NULL DEFAULT 0,
+    failed_rows INTEGER NOT NULL DEFAULT 0,
+    error TEXT,
+    error_file TEXT,
+    created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP,
+    finished_at TIMESTAMP WITH TIME ZONE
+);
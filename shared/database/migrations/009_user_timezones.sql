@@ -0,0 +1,12 @@
+-- Дни ребенка считаются в часовом поясе владельца (users.timezone): пояс читается вместе
+-- с версией ребенка соединением children -> users, дети пользователя выбираются по user_id.
+-- Пустой пояс - пояс по умолчанию. Если у кого-то из пользователей пояс уже не московский,
+-- после миграции агрегаты пересчитываются: python rollups.py rebuild.
+-- CONCURRENTLY не работает внутри транзакции: запускать без -1 / --single-transaction.
+--
+--   docker-compose exec postgres psql -U babyflow -d babyflow -f /migrations/009_user_timezones.sql
+
+UPDATE users SET timezone = 'Europe/Moscow' WHERE timezone IS NULL;
+ALTER TABLE users ALTER COLUMN timezone SET NOT NULL;
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_children_user_id ON children(user_id);
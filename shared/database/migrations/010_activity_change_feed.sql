@@ -0,0 +1,67 @@
+-- Лента изменений активностей (GET /changes): NOTIFY activity_changes после вставки и изменения.
+--
+-- Триггеры уровня оператора: одно уведомление на ребенка за оператор, а не на строку, поэтому
+-- пакетные записи и импорт через COPY шлют по одному уведомлению. В уведомлении - первые 20 строк
+-- (id и время), остальные только в count: полезная нагрузка NOTIFY ограничена 8000 байт.
+-- Переносы строк между секциями (ensure, restore) идут мимо родительских таблиц и уведомлений не шлют.
+--
+--   docker-compose exec postgres psql -U babyflow -d babyflow -f /migrations/010_activity_change_feed.sql
+
+-- Аргументы триггера: тип активности, колонка времени, колонка конца (или '')
+CREATE OR REPLACE FUNCTION notify_activity_changes()
+RETURNS TRIGGER AS $$
+DECLARE
+    change RECORD;
+BEGIN
+    FOR change IN
+        SELECT child_id, max(total) AS total,
+               jsonb_agg(jsonb_build_object('id', id, 'time', row_data -> TG_ARGV[1],
+                                            'end_time', row_data -> TG_ARGV[2]) ORDER BY id)
+                   FILTER (WHERE position <= 20) AS rows
+        FROM (
+            SELECT n.child_id, n.id, to_jsonb(n) AS row_data,
+                   row_number() OVER (PARTITION BY n.child_id ORDER BY n.id) AS position,
+                   count(*) OVER (PARTITION BY n.child_id) AS total
+            FROM changed_rows n
+        ) changed
+        GROUP BY child_id
+    LOOP
+        PERFORM pg_notify('activity_changes', json_build_object(
+            'child_id', change.child_id, 'type', TG_ARGV[0], 'op', lower(TG_OP),
+            'count', change.total, 'rows', change.rows
+        )::text);
+    END LOOP;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Триггер с таблицей переходов может быть только на одно событие: вставка и изменение - отдельно
+DO $$
+DECLARE
+    activity RECORD;
+BEGIN
+    FOR activity IN
+        SELECT * FROM (VALUES
+            ('sleep_activities', 'sleep', 'start_time', 'end_time'),
+            ('feeding_activities', 'feeding', 'time', ''),
+            ('walk_activities', 'walk', 'start_time', 'end_time'),
+            ('diaper_activities', 'diaper', 'time', ''),
+            ('temperature_activities', 'temperature', 'time', ''),
+            ('medication_activities', 'medication', 'time', ''),
+            ('mood_activities', 'mood', 'time', '')
+        ) AS t(table_name, activity_type, time_column, end_column)
+    LOOP
+        EXECUTE format('DROP TRIGGER IF EXISTS notify_%s_insert ON %I', activity.activity_type, activity.table_name);
+        EXECUTE format(
+            'CREATE TRIGGER notify_%s_insert AFTER INSERT ON %I REFERENCING NEW TABLE AS changed_rows '
+            'FOR EACH STATEMENT EXECUTE FUNCTION notify_activity_changes(%L, %L, %L)',
+            activity.activity_type, activity.table_name, activity.activity_type, activity.time_column, activity.end_column
+        );
+        EXECUTE format('DROP TRIGGER IF EXISTS notify_%s_update ON %I', activity.activity_type, activity.table_name);
+        EXECUTE format(
+            'CREATE TRIGGER notify_%s_update AFTER UPDATE ON %I REFERENCING NEW TABLE AS changed_rows '
+            'FOR EACH STATEMENT EXECUTE FUNCTION notify_activity_changes(%L, %L, %L)',
+            activity.activity_type, activity.table_name, activity.activity_type, activity.time_column, activity.end_column
+        );
+    END LOOP;
+END $$;
@@ -0,0 +1,6 @@
+-- Повтор запроса с Idempotency-Key получает код статуса первого ответа (202 у импорта),
+-- а не всегда 200. У ключей, сохраненных до миграции, код пустой и повторяется как 200.
+--
+--   docker-compose exec postgres psql -U babyflow -d babyflow -f /migrations/011_idempotency_status_code.sql
+
+ALTER TABLE idempotency_keys ADD COLUMN IF NOT EXISTS status_code INTEGER;
@@ -0,0 +1,6 @@
+#!/bin/bash
+# Основная база: разрешает потоковую репликацию по паролю (для postgres-replica).
+# Выполняется образом postgres только при создании нового тома; на существующей базе
+# добавьте строку в pg_hba.conf вручную и выполните SELECT pg_reload_conf().
+set -e
+echo "host replication all all scram-sha-256" >> "$PGDATA/pg_hba.conf"
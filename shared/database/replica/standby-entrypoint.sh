@@ -0,0 +1,19 @@
+#!/bin/bash
+# Реплика только для чтения: при пустом томе снимает копию основной базы
+# (pg_basebackup -R сам прописывает primary_conninfo и standby.signal), затем
+# запускает postgres в режиме hot standby.
+set -e
+PGDATA=${PGDATA:-/var/lib/postgresql/data}
+
+if [ ! -s "$PGDATA/PG_VERSION" ]; then
+    until pg_isready -h "$PRIMARY_HOST" -U "$POSTGRES_USER"; do
+        sleep 1
+    done
+    mkdir -p "$PGDATA"
+    chown postgres:postgres "$PGDATA"
+    gosu postgres env PGPASSWORD="$POSTGRES_PASSWORD" \
+        pg_basebackup -h "$PRIMARY_HOST" -U "$POSTGRES_USER" -D "$PGDATA" -X stream -R
+    chmod 0700 "$PGDATA"
+fi
+
+exec gosu postgres postgres -D "$PGDATA" -c hot_standby=on
@@ -1,7 +1,6 @@
 import os
 import asyncio
 import logging
-import requests
 from datetime import datetime
 import pytz
 from dotenv import load_dotenv
@@ -9,6 +8,10 @@ from aiogram import Bot, Dispatcher, types
 from aiogram.filters import CommandStart, Command
 from aiogram.types import Message, FSInputFile
 from chart_generator import create_sleep_chart, create_feeding_chart, create_activity_summary_chart
+from http_cache import ETagCache
+from change_feed import PUSH_CHANGES, follower as change_follower
+from metrics import HandlerMetricsMiddleware, start_metrics_server
+import http_client
 
 load_dotenv()
 
@@ -21,14 +24,43 @@ BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
 NLP_SERVICE_URL = os.getenv("NLP_SERVICE_URL", "http://localhost:8002")
 ACTIVITY_SERVICE_URL = os.getenv("ACTIVITY_SERVICE_URL", "http://localhost:8003")
 
+# Обработка сообщения в NLP идет через LLM и занимает секунды, ее таймаут чтения длиннее общего
+NLP_READ_TIMEOUT = float(os.getenv("NLP_READ_TIMEOUT", "60"))
+
 # Инициализация бота
 bot = Bot(token=BOT_TOKEN)
 dp = Dispatcher()
+# Время обработчиков по командам - в метрики на METRICS_PORT
+dp.message.middleware(HandlerMetricsMiddleware())
 
 # Временное хранилище для связи telegram_id с user_id и child_id
 # В продакшене использовать Redis или БД
 user_mapping = {}
 
+# Повторные /today, /stats, /week и /chart перепроверяют сохраненные ответы по ETag
+activity_cache = ETagCache()
+
+# Колонки, которые показывает /today: сервис читает из БД только их, поэтому здесь должен быть
+# каждый ключ, который читает обработчик /today
+TODAY_FIELDS = ("start_time,end_time,duration_minutes,time,type,amount_ml,food_name,location,consistency,"
+                "temperature,measurement_type,medication_name,dosage,mood,notes")
+
+# Пояс пользователя, пока он не загружен из activity-service
+DEFAULT_TIMEZONE = "Europe/Moscow"
+
+
+def remember_user(telegram_id: int, chat_id: int, user: dict, child: dict):
+    user_mapping[telegram_id] = {"user_id": user["id"], "child_id": child["id"],
+                                 "timezone": user.get("timezone") or DEFAULT_TIMEZONE}
+    # Записи ребенка, сделанные из других чатов, приходят в этот чат сами
+    change_follower.follow(chat_id, child["id"], user_mapping[telegram_id]["timezone"])
+
+
+def local_time(value: str, timezone: str) -> str:
+    """ЧЧ:ММ момента из ответа сервиса в поясе пользователя"""
+    moment = datetime.fromisoformat(value.replace('Z', '+00:00'))
+    return moment.astimezone(pytz.timezone(timezone)).strftime("%H:%M")
+
 
 @dp.message(CommandStart())
 async def start_handler(message: Message):
@@ -39,7 +71,7 @@ async def start_handler(message: Message):
 
     # Проверяем или создаем пользователя
     try:
-        response = requests.get(f"{ACTIVITY_SERVICE_URL}/users/telegram/{telegram_id}")
+        response = await http_client.get(f"{ACTIVITY_SERVICE_URL}/users/telegram/{telegram_id}")
         if response.status_code == 404:
             # Создаем нового пользователя
             user_data = {
@@ -47,7 +79,8 @@ async def start_handler(message: Message):
                 "username": username,
                 "first_name": first_name
             }
-            response = requests.post(f"{ACTIVITY_SERVICE_URL}/users/", json=user_data)
+            # Пользователь ищется по telegram_id, повтор создания безопасен
+            response = await http_client.post(f"{ACTIVITY_SERVICE_URL}/users/", json=user_data, idempotent=True)
             user = response.json()
             await message.answer(
                 f"👋 Привет, {first_name}!\n\n"
@@ -65,12 +98,12 @@ async def start_handler(message: Message):
         else:
             user = response.json()
             # Проверяем есть ли дети
-            children_response = requests.get(f"{ACTIVITY_SERVICE_URL}/children/user/{user['id']}")
+            children_response = await http_client.get(f"{ACTIVITY_SERVICE_URL}/children/user/{user['id']}")
             children = children_response.json()
 
             if children:
                 child = children[0]  # Берем первого ребенка
-                user_mapping[telegram_id] = {"user_id": user["id"], "child_id": child["id"]}
+                remember_user(telegram_id, message.chat.id, user, child)
                 await message.answer(
                     f"С возвращением, {first_name}!\n"
                     f"Записываю активности для: {child['name']}\n\n"
@@ -94,7 +127,7 @@ async def add_child_handler(message: Message):
 
     try:
         # Получаем user_id
-        response = requests.get(f"{ACTIVITY_SERVICE_URL}/users/telegram/{telegram_id}")
+        response = await http_client.get(f"{ACTIVITY_SERVICE_URL}/users/telegram/{telegram_id}")
         if response.status_code == 404:
             await message.answer("Сначала выполните /start")
             return
@@ -120,10 +153,13 @@ async def add_child_handler(message: Message):
             "birth_date": birth_date
         }
 
-        response = requests.post(f"{ACTIVITY_SERVICE_URL}/children/", json=child_data)
+        response = await http_client.post(
+            f"{ACTIVITY_SERVICE_URL}/children/", json=child_data,
+            idempotency_key=f"tg:{message.chat.id}:{message.message_id}:child"
+        )
         if response.status_code == 200:
             child = response.json()
-            user_mapping[telegram_id] = {"user_id": user["id"], "child_id": child["id"]}
+            remember_user(telegram_id, message.chat.id, user, child)
             await message.answer(
                 f"✅ Добавлен ребенок: {name}\n"
                 f"Дата рождения: {birth_date}\n\n"
@@ -136,6 +172,48 @@ async def add_child_handler(message: Message):
         await message.answer("Произошла ошибка. Проверьте формат команды.")
 
 
+@dp.message(Command("timezone"))
+async def timezone_handler(message: Message):
+    """Часовой пояс: по нему считаются дни, /today и статистика"""
+    telegram_id = message.from_user.id
+
+    try:
+        response = await http_client.get(f"{ACTIVITY_SERVICE_URL}/users/telegram/{telegram_id}")
+        if response.status_code == 404:
+            await message.answer("Сначала выполните /start")
+            return
+        user = response.json()
+
+        parts = message.text.split()
+        if len(parts) < 2:
+            await message.answer(
+                f"Ваш часовой пояс: {user.get('timezone') or DEFAULT_TIMEZONE}\n"
+                "Сменить: /timezone Область/Город\n"
+                "Пример: /timezone Asia/Yekaterinburg"
+            )
+            return
+
+        # Повтор той же смены пояса ничего не меняет
+        response = await http_client.put(
+            f"{ACTIVITY_SERVICE_URL}/users/{user['id']}/timezone", json={"timezone": parts[1]}, idempotent=True
+        )
+        if response.status_code == 400:
+            await message.answer("Не знаю такой пояс. Пример: /timezone Europe/Berlin")
+            return
+        if response.status_code != 200:
+            await message.answer("Не удалось сменить пояс, попробуйте позже 🙏")
+            return
+
+        user = response.json()
+        if telegram_id in user_mapping:
+            user_mapping[telegram_id]["timezone"] = user["timezone"]
+        change_follower.set_timezone(message.chat.id, user["timezone"])
+        await message.answer(f"✅ Часовой пояс: {user['timezone']}\nДни теперь считаются по нему.")
+    except Exception as e:
+        logger.error(f"Error in timezone_handler: {e}")
+        await message.answer("Произошла ошибка. Попробуйте позже.")
+
+
 @dp.message(Command("today"))
 async def today_handler(message: Message):
     """Показать активности за сегодня"""
@@ -146,9 +224,12 @@ async def today_handler(message: Message):
         return
 
     child_id = user_mapping[telegram_id]["child_id"]
+    timezone = user_mapping[telegram_id]["timezone"]
 
     try:
-        response = requests.get(f"{ACTIVITY_SERVICE_URL}/activities/child/{child_id}/today")
+        response = await activity_cache.get(
+            f"{ACTIVITY_SERVICE_URL}/activities/child/{child_id}/today", params={"fields": TODAY_FIELDS}
+        )
         if response.status_code != 200:
             await message.answer("Не могу получить данные, попробуйте позже 🙏")
             return
@@ -159,16 +240,11 @@ async def today_handler(message: Message):
         # Сон
         if data.get("sleep"):
             text += "😴 *Сон:*\n"
-            moscow_tz = pytz.timezone('Europe/Moscow')
             for sleep in data["sleep"]:
-                start_dt = datetime.fromisoformat(sleep["start_time"].replace('Z', '+00:00'))
-                start_moscow = start_dt.astimezone(moscow_tz)
-                start = start_moscow.strftime("%H:%M")
+                start = local_time(sleep["start_time"], timezone)
 
                 if sleep["end_time"]:
-                    end_dt = datetime.fromisoformat(sleep["end_time"].replace('Z', '+00:00'))
-                    end_moscow = end_dt.astimezone(moscow_tz)
-                    end = end_moscow.strftime("%H:%M")
+                    end = local_time(sleep["end_time"], timezone)
                     duration = sleep.get("duration_minutes", 0)
                     hours = duration // 60
                     minutes = duration % 60
@@ -183,11 +259,8 @@ async def today_handler(message: Message):
         # Кормление
         if data.get("feeding"):
             text += "\n🍼 *Кормления:*\n"
-            moscow_tz = pytz.timezone('Europe/Moscow')
             for feed in data["feeding"]:
-                time_dt = datetime.fromisoformat(feed["time"].replace('Z', '+00:00'))
-                time_moscow = time_dt.astimezone(moscow_tz)
-                time = time_moscow.strftime("%H:%M")
+                time = local_time(feed["time"], timezone)
                 text += f"• {time}"
                 if feed.get("amount_ml"):
                     text += f" - {feed['amount_ml']}мл"
@@ -198,15 +271,10 @@ async def today_handler(message: Message):
         # Прогулки
         if data.get("walks"):
             text += "\n🚶 *Прогулки:*\n"
-            moscow_tz = pytz.timezone('Europe/Moscow')
             for walk in data["walks"]:
-                start_dt = datetime.fromisoformat(walk["start_time"].replace('Z', '+00:00'))
-                start_moscow = start_dt.astimezone(moscow_tz)
-                start = start_moscow.strftime("%H:%M")
+                start = local_time(walk["start_time"], timezone)
                 if walk["end_time"]:
-                    end_dt = datetime.fromisoformat(walk["end_time"].replace('Z', '+00:00'))
-                    end_moscow = end_dt.astimezone(moscow_tz)
-                    end = end_moscow.strftime("%H:%M")
+                    end = local_time(walk["end_time"], timezone)
                     text += f"• {start} - {end}"
                     if walk.get("location"):
                         text += f" ({walk['location']})"
@@ -217,11 +285,8 @@ async def today_handler(message: Message):
         # Подгузники
         if data.get("diapers"):
             text += "\n🚼 *Подгузники:*\n"
-            moscow_tz = pytz.timezone('Europe/Moscow')
             for diaper in data["diapers"]:
-                time_dt = datetime.fromisoformat(diaper["time"].replace('Z', '+00:00'))
-                time_moscow = time_dt.astimezone(moscow_tz)
-                time = time_moscow.strftime("%H:%M")
+                time = local_time(diaper["time"], timezone)
 
                 if diaper["type"] == "poop":
                     emoji = "💩"
@@ -238,11 +303,8 @@ async def today_handler(message: Message):
         # Температура
         if data.get("temperatures"):
             text += "\n🌡️ *Температура:*\n"
-            moscow_tz = pytz.timezone('Europe/Moscow')
             for temp in data["temperatures"]:
-                time_dt = datetime.fromisoformat(temp["time"].replace('Z', '+00:00'))
-                time_moscow = time_dt.astimezone(moscow_tz)
-                time = time_moscow.strftime("%H:%M")
+                time = local_time(temp["time"], timezone)
 
                 text += f"• {time} - {temp['temperature']}°C"
                 if temp.get("measurement_type"):
@@ -252,11 +314,8 @@ async def today_handler(message: Message):
         # Лекарства
         if data.get("medications"):
             text += "\n💊 *Лекарства:*\n"
-            moscow_tz = pytz.timezone('Europe/Moscow')
             for med in data["medications"]:
-                time_dt = datetime.fromisoformat(med["time"].replace('Z', '+00:00'))
-                time_moscow = time_dt.astimezone(moscow_tz)
-                time = time_moscow.strftime("%H:%M")
+                time = local_time(med["time"], timezone)
 
                 text += f"• {time} - {med['medication_name']}"
                 if med.get("dosage"):
@@ -266,7 +325,6 @@ async def today_handler(message: Message):
         # Настроение
         if data.get("moods"):
             text += "\n😊 *Настроение:*\n"
-            moscow_tz = pytz.timezone('Europe/Moscow')
             mood_emojis = {
                 "веселое": "😄",
                 "спокойное": "😌",
@@ -276,9 +334,7 @@ async def today_handler(message: Message):
                 "плохое": "😔"
             }
             for mood_entry in data["moods"]:
-                time_dt = datetime.fromisoformat(mood_entry["time"].replace('Z', '+00:00'))
-                time_moscow = time_dt.astimezone(moscow_tz)
-                time = time_moscow.strftime("%H:%M")
+                time = local_time(mood_entry["time"], timezone)
 
                 mood = mood_entry["mood"]
                 emoji = mood_emojis.get(mood.lower(), "😊")
@@ -312,7 +368,7 @@ async def stats_handler(message: Message):
     child_id = user_mapping[telegram_id]["child_id"]
 
     try:
-        response = requests.get(f"{ACTIVITY_SERVICE_URL}/analytics/child/{child_id}/stats?days=7")
+        response = await activity_cache.get(f"{ACTIVITY_SERVICE_URL}/analytics/child/{child_id}/stats?days=7")
         if response.status_code != 200:
             await message.answer("Не могу получить статистику, попробуйте позже 🙏")
             return
@@ -386,7 +442,7 @@ async def week_handler(message: Message):
     child_id = user_mapping[telegram_id]["child_id"]
 
     try:
-        response = requests.get(f"{ACTIVITY_SERVICE_URL}/analytics/child/{child_id}/daily?days=7")
+        response = await activity_cache.get(f"{ACTIVITY_SERVICE_URL}/analytics/child/{child_id}/daily?days=7")
         if response.status_code != 200:
             await message.answer("Не могу получить данные, попробуйте позже 🙏")
             return
@@ -427,8 +483,8 @@ async def chart_handler(message: Message):
 
     try:
         # Получаем данные
-        stats_response = requests.get(f"{ACTIVITY_SERVICE_URL}/analytics/child/{child_id}/stats?days=7")
-        daily_response = requests.get(f"{ACTIVITY_SERVICE_URL}/analytics/child/{child_id}/daily?days=7")
+        stats_response = await activity_cache.get(f"{ACTIVITY_SERVICE_URL}/analytics/child/{child_id}/stats?days=7")
+        daily_response = await activity_cache.get(f"{ACTIVITY_SERVICE_URL}/analytics/child/{child_id}/daily?days=7")
 
         if stats_response.status_code != 200 or daily_response.status_code != 200:
             await message.answer("Не могу получить данные для графиков 😔")
@@ -499,6 +555,7 @@ async def help_handler(message: Message):
 *Команды:*
 /start - начать работу
 /add_child - добавить малыша
+/timezone - часовой пояс
 /today - что было сегодня
 /stats - статистика за неделю
 /week - активности за неделю
@@ -541,14 +598,14 @@ async def message_handler(message: Message):
     if telegram_id not in user_mapping:
         # Пытаемся загрузить из БД
         try:
-            response = requests.get(f"{ACTIVITY_SERVICE_URL}/users/telegram/{telegram_id}")
+            response = await http_client.get(f"{ACTIVITY_SERVICE_URL}/users/telegram/{telegram_id}")
             if response.status_code == 200:
                 user = response.json()
-                children_response = requests.get(f"{ACTIVITY_SERVICE_URL}/children/user/{user['id']}")
+                children_response = await http_client.get(f"{ACTIVITY_SERVICE_URL}/children/user/{user['id']}")
                 children = children_response.json()
                 if children:
                     child = children[0]
-                    user_mapping[telegram_id] = {"user_id": user["id"], "child_id": child["id"]}
+                    remember_user(telegram_id, message.chat.id, user, child)
                 else:
                     await message.answer("Сначала добавьте ребенка через /add_child")
                     return
@@ -560,17 +617,26 @@ async def message_handler(message: Message):
             return
 
     child_id = user_mapping[telegram_id]["child_id"]
+    # Пользователь мог написать из нового чата (например, семейного)
+    change_follower.follow(message.chat.id, child_id, user_mapping[telegram_id]["timezone"])
 
-    # Отправляем в NLP service
+    # Отправляем в NLP service; записи этого сообщения в этот же чат не пушатся
     try:
         nlp_data = {
             "message": message.text,
             "child_id": child_id,
             "user_id": user_mapping[telegram_id]["user_id"],
-            "telegram_chat_id": message.chat.id
+            "timezone": user_mapping[telegram_id]["timezone"],
+            "telegram_chat_id": message.chat.id,
+            "telegram_message_id": message.message_id
         }
 
-        response = requests.post(f"{NLP_SERVICE_URL}/process", json=nlp_data)
+        # Без повторов: повтор запустил бы агента заново, пока первая попытка еще идет на сервере
+        with change_follower.writing(message.chat.id, child_id):
+            response = await http_client.post(
+                f"{NLP_SERVICE_URL}/process", json=nlp_data,
+                timeout=(http_client.CONNECT_TIMEOUT, NLP_READ_TIMEOUT)
+            )
 
         if response.status_code == 200:
             result = response.json()
@@ -588,6 +654,9 @@ async def message_handler(message: Message):
 async def main():
     """Главная функция"""
     logger.info("Starting bot...")
+    start_metrics_server()
+    if PUSH_CHANGES:
+        asyncio.create_task(change_follower.run(bot))
     await dp.start_polling(bot)
 
 
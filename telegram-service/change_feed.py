@@ -0,0 +1,188 @@
+"""
+Пуш записей в чаты по ленте изменений activity-service (GET /changes, server-sent events).
+
+Бот следит за детьми чатов, в которых ими пользовались, и присылает в эти чаты новые
+и измененные записи сразу после коммита, без опроса /today. Чат, из которого запись
+только что сделана, свою же запись не получает: ответ на сообщение он уже увидел.
+
+Подписка одна на все отслеживаемые дети (пачками по MAX_CHILDREN_PER_STREAM); при появлении
+нового ребенка поток переоткрывается. Закрытый сервисом поток открывается заново сразу,
+разрыв - с паузой. Уведомления - по возможности: полные данные показывает /today.
+"""
+import asyncio
+import json
+import logging
+import os
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Dict
+
+import aiohttp
+import pytz
+
+logger = logging.getLogger(__name__)
+
+ACTIVITY_SERVICE_URL = os.getenv("ACTIVITY_SERVICE_URL", "http://localhost:8003")
+PUSH_CHANGES = os.getenv("PUSH_CHANGES", "1") == "1"
+
+# Столько детей в одном потоке принимает GET /changes
+MAX_CHILDREN_PER_STREAM = 1000
+# Сколько секунд после ответа чату его собственные записи не присылаются
+ECHO_SECONDS = 5
+# Пауза перед переподключением: RECONNECT_BACKOFF, 2x, ... до RECONNECT_MAX
+RECONNECT_BACKOFF = 1
+RECONNECT_MAX = 60
+# Новые дети в первые секунды после старта приходят пачкой: потоки переоткрываются раз в паузу
+RESTART_DELAY = 1
+# Сервис шлет keepalive раз в 15 секунд: без данных дольше - соединение мертвое
+READ_TIMEOUT = 60
+
+# Тип активности -> (эмодзи, название, начало сессии, конец сессии)
+ACTIVITY_LABELS = {
+    "sleep": ("😴", "сон", "Малыш уснул", "Малыш проснулся"),
+    "walk": ("🚶", "прогулка", "Вышли гулять", "Вернулись с прогулки"),
+    "feeding": ("🍼", "кормление", None, None),
+    "diaper": ("🚼", "подгузник", None, None),
+    "temperature": ("🌡️", "температура", None, None),
+    "medication": ("💊", "лекарство", None, None),
+    "mood": ("😊", "настроение", None, None),
+}
+
+
+def _local_time(value: str, timezone: str) -> str:
+    moment = datetime.fromisoformat(value.replace('Z', '+00:00'))
+    return moment.astimezone(pytz.timezone(timezone)).strftime("%H:%M")
+
+
+def render_change(change: dict, timezone: str) -> str:
+    """Текст уведомления об изменении: одна строка на запись, для больших пачек - число"""
+    emoji, name, started, finished = ACTIVITY_LABELS.get(change["type"], ("📝", change["type"], None, None))
+    rows = change.get("rows") or []
+    if change["count"] > 3:
+        verb = "Изменено" if change["op"] == "update" else "Добавлено"
+        return f"{emoji} {verb} записей ({name}): {change['count']}"
+
+    lines = []
+    for row in rows:
+        if started and row.get("end_time"):
+            if change["op"] == "update":
+                lines.append(f"{emoji} {finished} в {_local_time(row['end_time'], timezone)}")
+            else:
+                lines.append(f"{emoji} {name.capitalize()}: {_local_time(row['time'], timezone)} - "
+                             f"{_local_time(row['end_time'], timezone)}")
+        elif started and change["op"] == "insert":
+            lines.append(f"{emoji} {started} в {_local_time(row['time'], timezone)}")
+        else:
+            verb = "Изменена запись" if change["op"] == "update" else "Новая запись"
+            lines.append(f"{emoji} {verb}: {name} в {_local_time(row['time'], timezone)}")
+    return "\n".join(lines)
+
+
+class ChangeFollower:
+    """Дети, за которыми следят чаты, и потоки изменений по ним"""
+
+    def __init__(self):
+        # child_id -> {chat_id: часовой пояс чата}
+        self._chats: Dict[int, Dict[int, str]] = defaultdict(dict)
+        # (chat_id, child_id) -> момент, до которого изменения этого чата не присылаются
+        self._echo_until: Dict[tuple, float] = {}
+        self._writing: Dict[tuple, int] = defaultdict(int)
+        self._children_changed = asyncio.Event()
+
+    def follow(self, chat_id: int, child_id: int, timezone: str):
+        new_child = child_id not in self._chats
+        self._chats[child_id][chat_id] = timezone
+        if new_child:
+            self._children_changed.set()
+
+    def set_timezone(self, chat_id: int, timezone: str):
+        for chats in self._chats.values():
+            if chat_id in chats:
+                chats[chat_id] = timezone
+
+    @contextmanager
+    def writing(self, chat_id: int, child_id: int):
+        """Пока чат пишет ребенку (и ECHO_SECONDS после), его записи в этот чат не присылаются"""
+        key = (chat_id, child_id)
+        self._writing[key] += 1
+        try:
+            yield
+        finally:
+            self._writing[key] -= 1
+            if not self._writing[key]:
+                del self._writing[key]
+            self._echo_until[key] = time.monotonic() + ECHO_SECONDS
+
+    def _is_echo(self, chat_id: int, child_id: int) -> bool:
+        key = (chat_id, child_id)
+        if key in self._writing:
+            return True
+        until = self._echo_until.get(key)
+        if until is None:
+            return False
+        if until < time.monotonic():
+            del self._echo_until[key]
+            return False
+        return True
+
+    async def _deliver(self, bot, change: dict):
+        child_id = change["child_id"]
+        for chat_id, timezone in list(self._chats.get(child_id, {}).items()):
+            if self._is_echo(chat_id, child_id):
+                continue
+            try:
+                await bot.send_message(chat_id, render_change(change, timezone))
+            except Exception as e:
+                logger.warning(f"Change push to chat {chat_id} failed: {e}")
+
+    async def _stream(self, session: aiohttp.ClientSession, bot, child_ids: list):
+        backoff = RECONNECT_BACKOFF
+        while True:
+            try:
+                async with session.get(f"{ACTIVITY_SERVICE_URL}/changes",
+                                       params={"child_ids": ",".join(map(str, child_ids))}) as response:
+                    response.raise_for_status()
+                    event = None
+                    async for raw_line in response.content:
+                        line = raw_line.decode().rstrip("\r\n")
+                        if line.startswith("event: "):
+                            event = line[len("event: "):]
+                        elif line.startswith("data: ") and event == "change":
+                            await self._deliver(bot, json.loads(line[len("data: "):]))
+                        elif line.startswith("data: ") and event == "ready":
+                            backoff = RECONNECT_BACKOFF
+                        # reset: пропущенные изменения не присылаются, /today покажет все
+                    if event == "reconnect":
+                        # Сервис закрывает поток по времени жизни: переподключаемся сразу
+                        continue
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning(f"Change feed stream failed: {e}")
+            await asyncio.sleep(backoff)
+            backoff = min(backoff * 2, RECONNECT_MAX)
+
+    async def run(self, bot):
+        """Держит потоки по всем отслеживаемым детям; новый ребенок - потоки переоткрываются"""
+        timeout = aiohttp.ClientTimeout(total=None, sock_read=READ_TIMEOUT)
+        async with aiohttp.ClientSession(timeout=timeout) as session:
+            while True:
+                await self._children_changed.wait()
+                await asyncio.sleep(RESTART_DELAY)
+                self._children_changed.clear()
+                child_ids = sorted(self._chats)
+                streams = [
+                    asyncio.create_task(self._stream(session, bot, child_ids[start:start + MAX_CHILDREN_PER_STREAM]))
+                    for start in range(0, len(child_ids), MAX_CHILDREN_PER_STREAM)
+                ]
+                try:
+                    await self._children_changed.wait()
+                finally:
+                    for stream in streams:
+                        stream.cancel()
+                    await asyncio.gather(*streams, return_exceptions=True)
+
+
+follower = ChangeFollower()
@@ -0,0 +1,44 @@
+"""
+Кэш GET-запросов к activity-service с перепроверкой по ETag
+"""
+import threading
+from collections import OrderedDict
+
+import requests
+
+import http_client
+
+
+class ETagCache:
+    """
+    Хранит последние ответы по URL. Повторный запрос уходит с If-None-Match,
+    и на 304 возвращается сохраненный ответ без повторной передачи тела.
+    """
+
+    def __init__(self, max_entries: int = 256):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    async def get(self, url: str, params: dict = None, **kwargs) -> requests.Response:
+        key = (url, tuple(sorted((params or {}).items())))
+        with self._lock:
+            cached = self._entries.get(key)
+
+        headers = dict(kwargs.pop("headers", None) or {})
+        if cached is not None:
+            headers["If-None-Match"] = cached.headers["ETag"]
+
+        response = await http_client.get(url, params=params, headers=headers, **kwargs)
+        if response.status_code == 304 and cached is not None:
+            with self._lock:
+                self._entries.move_to_end(key)
+            return cached
+
+        if response.status_code == 200 and "ETag" in response.headers:
+            with self._lock:
+                self._entries[key] = response
+                self._entries.move_to_end(key)
+                while len(self._entries) > self.max_entries:
+                    self._entries.popitem(last=False)
+        return response
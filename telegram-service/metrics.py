@@ -0,0 +1,61 @@
+"""
+Метрики Prometheus бота на отдельном HTTP-порту METRICS_PORT (GET /metrics).
+
+  telegram_handler_duration_seconds{command, outcome} - время обработчика
+  telegram_handlers_in_progress{command}              - обработчики в работе
+
+command - команда без / (start, today, ...) или message для обычного текста: обработчик
+текста ждет nlp-service, его время - то, что видит родитель в чате.
+"""
+import os
+import time
+from typing import Any, Awaitable, Callable, Dict
+
+from aiogram import BaseMiddleware
+from aiogram.types import Message
+from prometheus_client import Gauge, Histogram, start_http_server
+
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9100"))
+
+# Команды бота; остальные "/..." считаются одной меткой, чтобы число рядов не росло
+COMMANDS = ("start", "add_child", "timezone", "today", "stats", "week", "chart", "help")
+
+HANDLER_DURATION = Histogram(
+    "telegram_handler_duration_seconds", "Telegram handler latency", ["command", "outcome"],
+    buckets=(0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60)
+)
+HANDLERS_IN_PROGRESS = Gauge("telegram_handlers_in_progress", "Telegram handlers being run", ["command"])
+
+
+def command_label(message: Message) -> str:
+    text = message.text or ""
+    if not text.startswith("/"):
+        return "message"
+    # /today@babyflow_bot в группах
+    parts = text[1:].split(maxsplit=1)
+    command = parts[0].split("@", 1)[0] if parts else ""
+    return command if command in COMMANDS else "other"
+
+
+class HandlerMetricsMiddleware(BaseMiddleware):
+    """Middleware обработчиков сообщений: время и число одновременно работающих по команде"""
+
+    async def __call__(self, handler: Callable[[Message, Dict[str, Any]], Awaitable[Any]], event: Message,
+                       data: Dict[str, Any]) -> Any:
+        command = command_label(event)
+        in_progress = HANDLERS_IN_PROGRESS.labels(command)
+        outcome = "error"
+        started = time.perf_counter()
+        in_progress.inc()
+        try:
+            result = await handler(event, data)
+            outcome = "ok"
+            return result
+        finally:
+            HANDLER_DURATION.labels(command, outcome).observe(time.perf_counter() - started)
+            in_progress.dec()
+
+
+def start_metrics_server():
+    """HTTP-сервер /metrics в отдельном потоке"""
+    start_http_server(METRICS_PORT)